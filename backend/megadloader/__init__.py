@@ -3,6 +3,7 @@ import functools
 import logging
 import re
 import threading
+import typing
 
 logger = logging.getLogger('megadloader')
 MEGA_API_KEY = 'vIJE2YwK'
@@ -38,40 +39,108 @@ def threadlocal(func):
     return wrapper
 
 
-link_re = re.compile(r'Link:\s*(.*)')
-key_re = re.compile(r'Key:\s*(.*)')
-m_re = re.compile(r'M:\s*(.*)')
-k_re = re.compile(r'K:\s*(.*)')
+_B64 = r'[A-Za-z0-9+/]+=*'
+_PATH = (
+    r'(?:#F?![\w-]+(?:![\w-]+)?'
+    r'|(?:folder|file)/[\w-]+(?:#[\w-]+)?(?:/(?:folder|file)/[\w-]+)*)'
+)
+
+mega_url_re = re.compile(
+    r'https?://(?:www\.)?mega(?:\.co)?\.nz/(?P<path>' + _PATH + ')'
+)
+
+# every format we understand, so a paste is scanned once, left to right;
+# the lookahead on their first letters skips most text without trying each
+link_re = re.compile(
+    r'(?=[LMah])(?:'
+    r'\bLink:[ \t]*(?P<link>' + _B64 + r')\s+Key:[ \t]*(?P<key>' + _B64 + ')'
+    r'|\bM:[ \t]*(?P<m>\S+)\s+K:[ \t]*(?P<k>\S+)'
+    # "https://mega" in base64
+    r'|(?P<b64>aHR0cHM6Ly9tZWdh[A-Za-z0-9+/]*=*)'
+    r'|(?P<url>' + mega_url_re.pattern + '))'
+)
 
 
 def decode_url(url: str):
-    url = url.strip()
+    """The first mega link in `url`, normalized, or None."""
+    return next(iter_urls(url), None)
+
+
+def iter_urls(text: str) -> typing.Iterator[str]:
+    """Yield every mega link in `text`, normalized, in order."""
+    for match in link_re.finditer(text):
+        url = _match_url(match)
+        if url:
+            yield url
+
+
+def extract_urls(text: str) -> typing.List[typing.Tuple[str, str]]:
+    """Find the links in pasted `text`, and the lines without one.
+
+    Returns (text, url) pairs in order: the text of each link with its
+    url, and each non-blank line without a link with None.
+    """
+    entries = []
+    pos = 0
+    for match in link_re.finditer(text):
+        gap = text[pos:match.start()]
+        entries.extend(_unmatched_lines(gap, pos == 0, True))
+        entries.append((match.group(0), _match_url(match)))
+        pos = match.end()
+
+    entries.extend(_unmatched_lines(text[pos:], pos == 0, False))
+    return entries
+
+
+def is_file_url(url: str):
+    """Whether `url` links to a single file rather than a folder."""
+    return '#F!' not in url and '/folder/' not in url
+
+
+def _unmatched_lines(gap: str, at_start, before_match):
+    lines = gap.split('\n')
+    if not at_start:
+        # the rest of the previous link's line
+        lines = lines[1:]
+    if before_match:
+        # the start of the next link's line
+        lines = lines[:-1]
+
+    return [(line.strip(), None) for line in lines if line.strip()]
+
+
+def _match_url(match) -> typing.Optional[str]:
+    if match.group('url'):
+        return _normalize_url(match.group('url'))
+
+    if match.group('b64'):
+        return _normalize_url(_b64decode(match.group('b64')))
+
+    if match.group('link'):
+        link = _b64decode(match.group('link'))
+        key = _b64decode(match.group('key'))
+        if link and key:
+            return _normalize_url(link + key)
+        return None
+
+    url = match.group('m')
+    if '://' not in url:
+        if 'mega' not in url:
+            url = 'mega.nz/' + url.lstrip('/')
+        url = 'https://' + url
+
+    return _normalize_url(url + match.group('k'))
+
+
+def _normalize_url(url: typing.Optional[str]) -> typing.Optional[str]:
+    match = url and mega_url_re.match(url)
+    if match:
+        return 'https://mega.nz/' + match.group('path')
+
 
+def _b64decode(value: str) -> typing.Optional[str]:
     try:
-        tmp = base64.b64decode(url)
-        url = tmp.decode('ascii')
-    except:
-        pass
-
-    link = link_re.search(url)
-    key = key_re.search(url)
-
-    if link and key:
-        link = base64.b64decode(link.group(1))
-        key = base64.b64decode(key.group(1))
-        url = link + key
-        url = url.decode('ascii')
-
-    m = m_re.search(url)
-    k = k_re.search(url)
-    if m and k:
-        m = m.group(1)
-        k = k.group(1)
-        if 'mega.nz' not in m:
-            m = 'mega.nz/' + m
-        if '://' not in m:
-            m = 'https://' + m
-        url = m + k
-
-    if url.startswith('https://mega'):
-        return url
+        value = base64.b64decode(value + '=' * (-len(value) % 4))
+        return value.decode('ascii')
+    except (ValueError, UnicodeDecodeError):
+        return None
@@ -0,0 +1,82 @@
+import json
+import logging
+import os
+import re
+import time
+import typing
+
+folder_url_res = [
+    re.compile(r'#F!([\w-]+)'),
+    re.compile(r'/folder/([\w-]+)'),
+]
+handle_re = re.compile(r'[\w-]+')
+
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def folder_handle(url: str) -> typing.Optional[str]:
+    for folder_url_re in folder_url_res:
+        match = folder_url_re.search(url)
+        if match:
+            return match.group(1)
+
+
+class FolderCache:
+    """Fetched folder trees on disk, one JSON file per public folder handle.
+
+    Each entry describes one file: its path inside the folder, name, size,
+    base64 handle and the serialized, authorized node that can be
+    downloaded without logging in to the folder again.
+    """
+
+    def __init__(self, directory, ttl):
+        self.log = logging.getLogger('cache')
+        self.directory = directory
+        self.ttl = ttl
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, handle):
+        if not handle_re.fullmatch(handle):
+            raise ValueError(f'invalid folder handle: {handle!r}')
+
+        return os.path.join(self.directory, f'{handle}.json')
+
+    def get(self, handle) -> typing.Optional[typing.List[dict]]:
+        path = self._path(handle)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            self.log.warning(f'ignoring corrupt cache for {handle}')
+            return None
+
+        if time.time() - data['created'] > self.ttl:
+            return None
+
+        return data['entries']
+
+    def put(self, handle, entries: typing.List[dict]):
+        path = self._path(handle)
+        tmp_path = f'{path}.tmp'
+
+        with open(tmp_path, 'w') as f:
+            json.dump({'created': time.time(), 'entries': entries}, f)
+        os.replace(tmp_path, path)
+
+    def invalidate(self, handle):
+        try:
+            os.unlink(self._path(handle))
+        except FileNotFoundError:
+            pass
+
+
+def folder_cache_from_settings(settings) -> typing.Optional[FolderCache]:
+    cache_dir = settings.get('cache_dir')
+    if not cache_dir:
+        return None
+
+    ttl = float(settings.get('folder_cache_ttl', DEFAULT_TTL))
+    return FolderCache(os.path.join(cache_dir, 'folders'), ttl)
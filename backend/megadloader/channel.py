@@ -0,0 +1,127 @@
+import logging
+import multiprocessing.connection
+import os
+import threading
+import typing
+
+CHANNEL_KEY_ENV = 'MEGADLOADER_CHANNEL_KEY'
+
+Handler = typing.Callable[[dict], None]
+
+
+def _read_messages(connection, handler: Handler, log):
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            break
+
+        try:
+            handler(message)
+        except Exception:
+            log.exception(f'failed to handle {message}')
+
+    connection.close()
+
+
+class ChannelServer:
+    """Web-process end of the link to the processor subprocesses.
+
+    Each processor connects once and then streams messages (dicts) that are
+    handed to `handler`; `broadcast` sends a message to every processor.
+    """
+
+    def __init__(self, handler: Handler):
+        self.log = logging.getLogger('channel')
+        self.handler = handler
+        self.authkey = os.urandom(16)
+
+        self._listener = multiprocessing.connection.Listener(
+            family='AF_UNIX', authkey=self.authkey,
+        )
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._connections = []
+
+        thread = threading.Thread(
+            target=self._accept, name='ChannelServer', daemon=True,
+        )
+        thread.start()
+
+    @property
+    def address(self):
+        return self._listener.address
+
+    @property
+    def env(self):
+        return {CHANNEL_KEY_ENV: self.authkey.hex()}
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except multiprocessing.AuthenticationError:
+                self.log.exception('failed to accept processor connection')
+                continue
+            except OSError:
+                break
+
+            with self._lock:
+                self._connections.append(connection)
+
+            thread = threading.Thread(
+                target=self._read, args=(connection,), daemon=True,
+            )
+            thread.start()
+
+    def _read(self, connection):
+        _read_messages(connection, self.handler, self.log)
+
+        with self._lock:
+            self._connections.remove(connection)
+
+    def broadcast(self, message: dict):
+        with self._lock:
+            connections = list(self._connections)
+
+        with self._send_lock:
+            for connection in connections:
+                try:
+                    connection.send(message)
+                except OSError:
+                    self.log.warning('failed to send to processor')
+
+    def close(self):
+        self._listener.close()
+
+
+class ChannelClient:
+    """Processor end of the link; safe to `send` from any thread."""
+
+    def __init__(self, address, authkey: bytes):
+        self.log = logging.getLogger('channel')
+        self._lock = threading.Lock()
+        self._connection = multiprocessing.connection.Client(
+            address, family='AF_UNIX', authkey=authkey,
+        )
+
+    @classmethod
+    def from_env(cls, address):
+        authkey = bytes.fromhex(os.environ[CHANNEL_KEY_ENV])
+        return cls(address, authkey)
+
+    def listen(self, handler: Handler):
+        thread = threading.Thread(
+            target=_read_messages,
+            args=(self._connection, handler, self.log),
+            name='ChannelClient',
+            daemon=True,
+        )
+        thread.start()
+
+    def send(self, message: dict):
+        try:
+            with self._lock:
+                self._connection.send(message)
+        except OSError:
+            self.log.warning('lost connection to web process')
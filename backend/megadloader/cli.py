@@ -1,8 +1,10 @@
 import click
+import configparser
 import mega
 import os
 
-from megadloader import MEGA_API_KEY
+from megadloader import MEGA_API_KEY, extract_urls
+from megadloader.db import Db, configure_db
 from megadloader.processor import (
     FileNodeDownloader,
     UrlProcessor,
@@ -34,5 +36,38 @@ def one_shot(url, dest):
         file_listener.wait()
 
 
+@cli.command()
+@click.argument('source', type=click.File('r'), default='-')
+@click.option(
+    '--config', default='app.ini',
+    type=click.Path(exists=True, dir_okay=False),
+)
+@click.option('--app-name', default='main')
+@click.option('--category')
+def import_urls(source, config, app_name, category):
+    """Queue every mega link in SOURCE (a file, or - for stdin).
+
+    Running processors pick the new urls up within their idle timeout.
+    """
+    parser = configparser.ConfigParser()
+    parser.read(config)
+    configure_db(parser[f'app:{app_name}'])
+
+    entries = extract_urls(source.read())
+
+    db = Db()
+    urls = iter(db.add_urls([url for _, url in entries if url], category))
+    for line, mega_url in entries:
+        line = line.replace('\n', ' ')
+        if not mega_url:
+            click.echo(f'invalid\t{line}')
+            continue
+
+        url, created = next(urls)
+        click.echo(f'{"added" if created else "exists"}\t{url.id}\t{line}')
+
+    db.dispose()
+
+
 if __name__ == '__main__':
     cli()
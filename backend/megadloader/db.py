@@ -1,25 +1,145 @@
 import logging
 import mega
+import re
 import sqlalchemy
+import sqlalchemy.event
+import sqlalchemy.exc
 import sqlalchemy.ext.declarative
 import sqlalchemy.orm
+import sqlalchemy.schema
+import time
 import typing
 
-from megadloader.models import Base, Url, UrlStatus, File, Category
+from megadloader.metrics import REGISTRY
+from megadloader.tracing import trace_methods
+from megadloader.models import (
+    Base,
+    Category,
+    File,
+    FileChange,
+    LimitScope,
+    Revision,
+    TransferLimit,
+    Url,
+    UrlMove,
+    UrlStatus,
+    UrlSummary,
+)
 
 DBSession = sqlalchemy.orm.scoped_session(
     sqlalchemy.orm.sessionmaker(),
 )
 
+COMMIT_SECONDS = REGISTRY.histogram(
+    'megadloader_db_commit_seconds',
+    'Time taken to flush and commit a database transaction.',
+)
+
+
+@sqlalchemy.event.listens_for(DBSession.session_factory, 'before_commit')
+def _commit_started(session):
+    session.info['commit_started'] = time.perf_counter()
+
+
+@sqlalchemy.event.listens_for(DBSession.session_factory, 'after_commit')
+def _commit_finished(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+
+# applied to every new SQLite connection; each can be overridden with a
+# `sqlite.<pragma>` setting, or disabled by setting it to nothing
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': '5000',
+    'mmap_size': str(256 * 1024 * 1024),
+    'cache_size': '-16000',
+}
+
+pragma_value_re = re.compile(r'-?\w+')
+
 
 def configure_db(settings):
     engine = sqlalchemy.engine_from_config(settings, 'db.')
+    if engine.dialect.name == 'sqlite':
+        _configure_sqlite(engine, settings)
 
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
     Base.metadata.create_all()
 
+    _migrate(engine)
+
+
+def _configure_sqlite(engine, settings):
+    pragmas = {}
+    for name, default in SQLITE_PRAGMAS.items():
+        value = settings.get(f'sqlite.{name}', default).strip()
+        if not value:
+            continue
+
+        if not pragma_value_re.fullmatch(value):
+            raise ValueError(f'invalid value for sqlite.{name}: {value!r}')
+
+        pragmas[name] = value
+
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+
+
+REVISION_ID = 1
+
+# ids per `IN (...)`, under SQLite's limit on bound parameters per statement
+BATCH_SIZE = 500
 
+
+def _migrate(engine):
+    """Bring databases created by older versions up to the current models.
+
+    `create_all` only creates missing tables, so columns and indexes added
+    to existing tables since are created here.
+    """
+    log = logging.getLogger('db')
+    inspector = sqlalchemy.inspect(engine)
+
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+
+                log.info(f'adding column {table.name}.{column.name}')
+                ddl = sqlalchemy.schema.CreateColumn(column) \
+                    .compile(dialect=engine.dialect)
+                conn.execute(f'ALTER TABLE {table.name} ADD COLUMN {ddl}')
+
+            existing = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+
+                log.info(f'creating index {index.name}')
+                try:
+                    index.create(conn)
+                except sqlalchemy.exc.IntegrityError:
+                    log.error(f'duplicate rows prevent creating {index.name}')
+
+        revisions = Revision.__table__
+        revision = conn.execute(
+            revisions.select().where(revisions.c.id == REVISION_ID),
+        ).first()
+        if revision is None:
+            conn.execute(revisions.insert().values(id=REVISION_ID, value=0))
+
+
+@trace_methods
 class Db:
     def __init__(self):
         self.log = logging.getLogger('db')
@@ -31,108 +151,636 @@ class Db:
             return model
 
         self.log.info(f'creating url {url} @ {category}')
-        model = Url(url=url, category=category)
+        model = Url(
+            url=url, category=category, version=self._next_version(),
+            position=self._next_position(),
+        )
         self.session.add(model)
-        self.session.commit()
+        try:
+            self.session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # added by someone else since we looked
+            self.session.rollback()
+            return self.session.query(Url).filter(Url.url == url).one()
+
         return model
 
-    def get_next_url(self) -> typing.Optional[Url]:
-        url = self.session.query(Url) \
-            .filter(Url.status.in_([
-                UrlStatus.idle.value,
-                UrlStatus.processing.value,
-            ])) \
-            .first()
-        if not url:
-            return
+    def add_urls(
+        self, urls, category=None,
+    ) -> typing.List[typing.Tuple[Url, bool]]:
+        """Add many urls in one transaction.
+
+        Returns a (model, created) pair for each of `urls`, in order; urls
+        that are already queued, or repeated, are looked up instead.
+        """
+        unique = list(dict.fromkeys(urls))
+
+        existing = {}
+        for start in range(0, len(unique), BATCH_SIZE):
+            batch = unique[start:start + BATCH_SIZE]
+            q = self.session.query(Url).filter(Url.url.in_(batch))
+            existing.update((model.url, model) for model in q)
+
+        new = [url for url in unique if url not in existing]
+        created = {}
+        if new:
+            self.log.info(f'creating {len(new)} urls @ {category}')
+            version = self._next_version()
+            position = self._next_position()
+            created = {
+                url: Url(
+                    url=url, category=category, version=version,
+                    position=position + offset,
+                )
+                for offset, url in enumerate(new)
+            }
+            self.session.add_all(created.values())
+            try:
+                self.session.commit()
+            except sqlalchemy.exc.IntegrityError:
+                # some were added by someone else since we looked
+                self.session.rollback()
+                return self.add_urls(urls, category)
+
+        results = []
+        for url in urls:
+            if url in created:
+                results.append((created.pop(url), True))
+                existing[url] = results[-1][0]
+            else:
+                results.append((existing[url], False))
+
+        return results
+
+    def claim_next_url(
+        self, processor_id, lease_duration, exclude=(),
+    ) -> typing.Optional[Url]:
+        """Claim the next url for `processor_id`, for `lease_duration` seconds.
+
+        Idle urls can be claimed, and so can processing ones whose lease
+        has expired or that the same processor id had, e.g. before a
+        restart; paused urls can't. Urls are claimed in queue order. The
+        claim is a single UPDATE, so two processors never get the same url.
+        """
+        now = time.time()
+        urls = Url.__table__
+        candidate = sqlalchemy.select([urls.c.id]) \
+            .where(urls.c.paused == sqlalchemy.false()) \
+            .where(sqlalchemy.or_(
+                urls.c.status == UrlStatus.idle.value,
+                sqlalchemy.and_(
+                    urls.c.status == UrlStatus.processing.value,
+                    sqlalchemy.or_(
+                        urls.c.lease_expires.is_(None),
+                        urls.c.lease_expires < now,
+                        urls.c.processor_id == processor_id,
+                    ),
+                ),
+            )) \
+            .order_by(Url.queue_position, urls.c.id) \
+            .limit(1)
+        if exclude:
+            candidate = candidate.where(urls.c.id.notin_(list(exclude)))
+
+        # don't bump the version unless there's something to claim
+        if self.session.execute(candidate).first() is None:
+            self.session.rollback()
+            return None
+
+        version = self._next_version()
+        result = self.session.execute(
+            urls.update()
+            .where(urls.c.id == candidate.as_scalar())
+            .values(
+                status=UrlStatus.processing.value,
+                processor_id=processor_id,
+                lease_expires=now + lease_duration,
+                version=version,
+            ),
+        )
+        self.session.commit()
+
+        if not result.rowcount:
+            # taken by someone else since we looked
+            return None
+
+        return self.session.query(Url) \
+            .filter(Url.version == version) \
+            .filter(Url.processor_id == processor_id) \
+            .one()
+
+    def renew_leases(
+        self, processor_id, url_ids, lease_duration,
+    ) -> typing.Set[int]:
+        """Extend our leases on `url_ids`; returns the ids we've lost."""
+        url_ids = set(url_ids)
+        if not url_ids:
+            return set()
+
+        q = self.session.query(Url) \
+            .filter(Url.id.in_(list(url_ids))) \
+            .filter(Url.status == UrlStatus.processing.value) \
+            .filter(Url.processor_id == processor_id)
+        renewed = q.update(
+            {Url.lease_expires: time.time() + lease_duration},
+            synchronize_session=False,
+        )
+        self.session.commit()
 
-        return url
+        if renewed == len(url_ids):
+            return set()
+
+        return url_ids - {url_id for url_id, in q.with_entities(Url.id)}
+
+    def next_lease_expiry(self) -> typing.Optional[float]:
+        """When the first lease on a processing url runs out, if any."""
+        expires = self.session.query(sqlalchemy.func.min(Url.lease_expires)) \
+            .filter(Url.status == UrlStatus.processing.value) \
+            .scalar()
+        self.session.rollback()
+        return expires
+
+    def release_urls(self):
+        """Put every url still marked as processing back in the queue."""
+        self.session.query(Url) \
+            .filter(Url.status == UrlStatus.processing.value) \
+            .update({
+                Url.status: UrlStatus.idle.value,
+                Url.lease_expires: None,
+                Url.version: self._next_version(),
+            }, synchronize_session=False)
+        self.session.commit()
 
     def get_url(self, url_id) -> Url:
         url = self.session.query(Url).get(url_id)
         if url:
             return url
 
-    def get_urls(self) -> typing.List[Url]:
-        urls = self.session.query(Url).all()
+    def count_urls(self) -> typing.Dict[str, int]:
+        """The number of urls with each status."""
+        counts = dict(
+            self.session.query(Url.status, sqlalchemy.func.count(Url.id))
+            .group_by(Url.status)
+        )
+        return {
+            status.value: counts.get(status.value, 0) for status in UrlStatus
+        }
+
+    def get_urls(self, since=None, summary=False) -> typing.List[Url]:
+        if summary:
+            return self._get_url_summaries(since)
+
+        q = self.session.query(Url)
+        if since is not None:
+            q = q.filter(Url.version > since)
+
+        urls = q.all()
         return urls
 
+    def _get_url_summaries(self, since=None) -> typing.List[UrlSummary]:
+        """Every url with its file aggregates, in one grouped query.
+
+        With `since`, only urls that changed or have a file that changed.
+        """
+        func = sqlalchemy.func
+        q = self.session.query(
+            Url,
+            func.count(File.id),
+            func.sum(sqlalchemy.case([(File.is_finished, 1)], else_=0)),
+            func.coalesce(func.sum(File.transferred_bytes), 0),
+            func.coalesce(func.sum(File.total_bytes), 0),
+            func.sum(sqlalchemy.case([(File.is_processing, 1)], else_=0)),
+        ) \
+            .outerjoin(Url.files) \
+            .group_by(Url.id) \
+            .order_by(Url.queue_position, Url.id)
+
+        if since is not None:
+            q = q.having(sqlalchemy.or_(
+                Url.version > since,
+                func.max(File.version) > since,
+            ))
+
+        return [UrlSummary(*row) for row in q]
+
+    def get_url_ids(self) -> typing.List[int]:
+        q = self.session.query(Url.id).order_by(Url.queue_position, Url.id)
+        return [url_id for url_id, in q]
+
+    def _next_position(self) -> int:
+        """A queue position behind every url, for a new or moved one."""
+        last = self.session.query(sqlalchemy.func.max(Url.queue_position)) \
+            .scalar()
+        return (last or 0) + 1
+
+    def move_url(self, url_model: Url, move: UrlMove) -> typing.List[Url]:
+        """Move a url to either end of the queue, or past its neighbour.
+
+        Returns the urls whose position changed.
+        """
+        position = url_model.queue_position
+        version = self._next_version()
+        moved = [url_model]
+        q = self.session.query(Url).filter(Url.id != url_model.id)
+
+        if move == UrlMove.top:
+            first = q.with_entities(
+                sqlalchemy.func.min(Url.queue_position),
+            ).scalar()
+            if first is not None and first < position:
+                url_model.position = first - 1
+        elif move == UrlMove.bottom:
+            url_model.position = self._next_position()
+        else:
+            if move == UrlMove.up:
+                q = q.filter(Url.queue_position < position) \
+                    .order_by(Url.queue_position.desc())
+            else:
+                q = q.filter(Url.queue_position > position) \
+                    .order_by(Url.queue_position)
+
+            neighbour = q.first()
+            if neighbour is not None:
+                url_model.position, neighbour.position = \
+                    neighbour.queue_position, position
+                neighbour.version = version
+                moved.append(neighbour)
+
+        url_model.version = version
+        self.session.commit()
+        return moved
+
+    def set_url_paused(self, url_model: Url, paused: bool):
+        url_model.paused = paused
+        url_model.version = self._next_version()
+
+        self.session.commit()
+
     def delete_url(self, url_model: Url):
         for file in url_model.files:
             self.session.delete(file)
 
+        self.session.query(TransferLimit) \
+            .filter(TransferLimit.scope == LimitScope.url.value) \
+            .filter(TransferLimit.key == str(url_model.id)) \
+            .delete(synchronize_session=False)
+
         self.session.delete(url_model)
+        self._next_version()
         self.session.commit()
 
+    def get_version(self) -> int:
+        return self.session.query(Revision.value) \
+            .filter(Revision.id == REVISION_ID) \
+            .scalar()
+
+    def _next_version(self) -> int:
+        """Bump the change counter; the caller stamps it on changed rows.
+
+        The UPDATE takes SQLite's write lock, so versions are handed out in
+        commit order even with the web app and processor writing at once.
+        """
+        q = self.session.query(Revision) \
+            .filter(Revision.id == REVISION_ID)
+        q.update(
+            {Revision.value: Revision.value + 1},
+            synchronize_session=False,
+        )
+        return self.get_version()
+
     def update_url(
         self, url_model: Url, processor_id, status: UrlStatus, error_msg=None,
-    ):
-        url_model.processor_id = processor_id
-        url_model.status = status.value
-        url_model.message = error_msg
+    ) -> bool:
+        values = {
+            Url.processor_id: processor_id,
+            Url.status: status.value,
+            Url.message: error_msg,
+            Url.version: self._next_version(),
+        }
+        if status != UrlStatus.processing:
+            values[Url.lease_expires] = None
+
+        return self._update_url_row(url_model, values)
+
+    def _update_url_row(self, url_model: Url, values: dict) -> bool:
+        """Write `values` to a url's row; False if it's been deleted.
+
+        Processors write through an UPDATE rather than their copy of the
+        url, so one deleted by the web app in the meantime is no error.
+        """
+        url_id, = sqlalchemy.inspect(url_model).identity
+        updated = self.session.query(Url) \
+            .filter(Url.id == url_id) \
+            .update(values, synchronize_session=False)
+        self.session.commit()
+        return bool(updated)
+
+    def request_sync(self, url_model: Url):
+        url_model.sync = True
+        url_model.status = UrlStatus.idle.value
+        url_model.message = None
+        url_model.version = self._next_version()
 
         self.session.commit()
 
+    def finish_sync(
+        self, url_model: Url, added, changed, removed, unchanged,
+    ) -> bool:
+        return self._update_url_row(url_model, {
+            Url.sync: False,
+            Url.sync_added: added,
+            Url.sync_changed: changed,
+            Url.sync_removed: removed,
+            Url.sync_unchanged: unchanged,
+            Url.version: self._next_version(),
+        })
+
+    def finish_indexing(self, url_model: Url) -> bool:
+        return self._update_url_row(url_model, {Url.indexed: True})
+
     def dispose(self):
         self.session.close()
 
     def create_file(self, url_model: Url, file_node: mega.MegaNode, fname):
-        file_handle = file_node.getBase64Handle()
-        files = self.session.query(File) \
-            .filter(File.file_handle == file_handle) \
+        return self.create_files(url_model, [(fname, file_node)])[0]
+
+    def create_files(
+        self, url_model: Url,
+        nodes: typing.List[typing.Tuple[str, mega.MegaNode]],
+    ) -> typing.List[File]:
+        """File rows for (fname, node) pairs, inserting new ones together.
+
+        Returned in the same order as `nodes`.
+        """
+        handles = [node.getBase64Handle() for _, node in nodes]
+        existing = {
+            file.file_handle: file
+            for file in self.session.query(File)
+                .filter(File.url_id == url_model.id)
+                .filter(File.file_handle.in_(handles))
+        }
+
+        version = None
+        dirty = False
+        file_models = []
+        for (fname, node), file_handle in zip(nodes, handles):
+            serialized = node.serialize()
+            file_model = existing.get(file_handle)
+            if file_model is None:
+                if version is None:
+                    version = self._next_version()
+
+                self.log.info(f'creating file from {fname}')
+                file_model = existing[file_handle] = File(
+                    url_id=url_model.id,
+                    path=fname,
+                    total_bytes=node.getSize(),
+                    file_handle=file_handle,
+                    node=serialized,
+                    version=version,
+                )
+                self.session.add(file_model)
+            elif file_model.node != serialized:
+                # created before nodes were stored, or the node changed
+                file_model.node = serialized
+                dirty = True
+
+            file_models.append(file_model)
+
+        if version is None and not dirty:
+            return file_models
+
+        try:
+            self.session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            # some were added by someone else since we looked
+            self.session.rollback()
+            return self.create_files(url_model, nodes)
+
+        return file_models
+
+    def sync_files(
+        self, url_model: Url,
+        nodes: typing.List[typing.Tuple[str, mega.MegaNode]],
+    ) -> typing.List[typing.Tuple[File, FileChange]]:
+        """File rows for (fname, node) pairs, diffed by file handle.
+
+        New nodes are inserted as in `create_files`; rows whose node has
+        moved or changed size are reset so the file is downloaded again.
+        """
+        handles = [node.getBase64Handle() for _, node in nodes]
+        q = self.session.query(File.file_handle) \
+            .filter(File.url_id == url_model.id) \
+            .filter(File.file_handle.in_(handles))
+        known = {file_handle for file_handle, in q}
+
+        version = None
+        changes = []
+        file_models = self.create_files(url_model, nodes)
+        for (fname, node), file_model in zip(nodes, file_models):
+            if file_model.file_handle not in known:
+                changes.append((file_model, FileChange.added))
+                continue
+
+            size = node.getSize()
+            if file_model.path == fname and file_model.total_bytes == size:
+                changes.append((file_model, FileChange.unchanged))
+                continue
+
+            if version is None:
+                version = self._next_version()
+
+            self.log.info(f'{fname} changed, downloading it again')
+            file_model.path = fname
+            file_model.total_bytes = size
+            file_model.transferred_bytes = 0
+            file_model.is_processing = False
+            file_model.is_finished = False
+            file_model.version = version
+            changes.append((file_model, FileChange.changed))
+
+        if version is not None:
+            self.session.commit()
+
+        return changes
+
+    def remove_missing_files(self, url_model: Url, file_handles) -> int:
+        """Delete the url's file rows whose handle is not in `file_handles`.
+
+        Files already downloaded are left on disk.
+        """
+        q = self.session.query(File.id, File.file_handle) \
             .filter(File.url_id == url_model.id)
-        for file in files:
-            return file
-
-        self.log.info(f'creating file from {fname}')
-        file_model = File(
-            url_id=url_model.id,
-            path=fname,
-            total_bytes=file_node.getSize(),
-            file_handle=file_handle,
-        )
-
-        self.session.add(file_model)
+        file_ids = [
+            file_id
+            for file_id, file_handle in q
+            if file_handle not in file_handles
+        ]
+        if not file_ids:
+            return 0
+
+        for start in range(0, len(file_ids), BATCH_SIZE):
+            batch = file_ids[start:start + BATCH_SIZE]
+            self.session.query(File) \
+                .filter(File.id.in_(batch)) \
+                .delete(synchronize_session=False)
+
+        self._next_version()
         self.session.commit()
-        return file_model
+        self.session.expire(url_model, ['files'])
+        return len(file_ids)
 
     def reset_file(self, file_model: File):
         file_model.is_processing = False
         file_model.is_finished = False
+        file_model.version = self._next_version()
+
+        self.session.commit()
+
+    def reset_files(self, file_ids: typing.List[int]) -> typing.Set[int]:
+        """Reset many files at once; returns the ids of their urls."""
+        url_ids = set()
+        version = self._next_version()
+        for start in range(0, len(file_ids), BATCH_SIZE):
+            q = self.session.query(File) \
+                .filter(File.id.in_(file_ids[start:start + BATCH_SIZE]))
+            url_ids.update(
+                url_id for url_id, in q.with_entities(File.url_id).distinct()
+            )
+            q.update({
+                File.is_processing: False,
+                File.is_finished: False,
+                File.transferred_bytes: 0,
+                File.version: version,
+            }, synchronize_session='fetch')
 
         self.session.commit()
+        return url_ids
 
     def mark_file_status(self, file_id, is_processing):
         file_model = self.get_file(file_id)
 
         file_model.is_processing = is_processing
+        file_model.version = self._next_version()
 
         self.session.commit()
+        return file_model
+
+    def update_files_progress(
+        self, progress: typing.Dict[int, dict],
+    ) -> typing.List[File]:
+        """Apply column values per file id, all in one transaction."""
+        if not progress:
+            return []
 
-    def update_file_node(self, file_model: File, transfer):
-        file_model.start_time = transfer.getStartTime()
-        file_model.transferred_bytes = transfer.getTransferredBytes()
-        file_model.num_retry = transfer.getNumRetry()
-        file_model.max_retries = transfer.getMaxRetries()
-        file_model.mean_speed = transfer.getMeanSpeed()
-        file_model.is_finished = transfer.isFinished()
-        file_model.state = transfer.getState()
+        version = self._next_version()
+        files = self.session.query(File) \
+            .filter(File.id.in_(list(progress))) \
+            .all()
+        for file_model in files:
+            for name, value in progress[file_model.id].items():
+                setattr(file_model, name, value)
+            file_model.version = version
 
         self.session.commit()
+        return files
 
-    def get_files(self, url_id=None):
+    def get_files(self, url_id=None, since=None, offset=None, limit=None):
         q = self.session.query(File)
         if url_id:
             q = q.filter(File.url_id == url_id)
+        if since is not None:
+            q = q.filter(File.version > since)
+        if offset is not None or limit is not None:
+            q = q.order_by(File.id).offset(offset).limit(limit)
 
         files = q.all()
         return files
 
+    def get_finished_files(self) -> typing.List[typing.Tuple[int, str, int]]:
+        """(id, path, total_bytes) of every finished file."""
+        return self.session.query(File.id, File.path, File.total_bytes) \
+            .filter(File.is_finished) \
+            .all()
+
+    def get_unfinished_files_of_done_urls(self) -> typing.List[int]:
+        """Ids of unfinished files whose url is done all the same."""
+        q = self.session.query(File.id) \
+            .join(Url, File.url_id == Url.id) \
+            .filter(Url.status == UrlStatus.done.value) \
+            .filter(File.is_finished.isnot(True))
+        return [file_id for file_id, in q]
+
+    def get_unfinished_file_paths(self) -> typing.List[str]:
+        q = self.session.query(File.path) \
+            .filter(sqlalchemy.or_(
+                File.is_processing,
+                File.is_finished.isnot(True),
+            ))
+        return [path for path, in q]
+
+    def get_pending_files(
+        self, url_id, after=0, limit=100,
+    ) -> typing.List[typing.Tuple[int, str, typing.Optional[str]]]:
+        """(id, path, node) of a url's unfinished files, a page at a time.
+
+        Pages follow each other by id: pass the last id of a page as
+        `after` to get the next one.
+        """
+        q = self.session.query(File.id, File.path, File.node) \
+            .filter(File.url_id == url_id) \
+            .filter(File.id > after) \
+            .filter(File.is_finished.isnot(True)) \
+            .order_by(File.id) \
+            .limit(limit)
+        page = q.all()
+        # don't hold a read transaction open between pages
+        self.session.rollback()
+        return page
+
+    def get_files_by_id(self, file_ids) -> typing.List[File]:
+        return self.session.query(File) \
+            .filter(File.id.in_(list(file_ids))) \
+            .order_by(File.id) \
+            .all()
+
+    def count_files(self, url_id) -> int:
+        return self.session.query(File).filter(File.url_id == url_id).count()
+
     def get_file(self, file_id):
         file_model = self.session.query(File).get(file_id)
         if file_model:
             return file_model
 
+    def get_limits(self) -> typing.List[TransferLimit]:
+        return self.session.query(TransferLimit).all()
+
+    def set_limit(
+        self, scope: LimitScope, key, values: typing.Optional[dict],
+    ) -> typing.Optional[TransferLimit]:
+        """Replace the limit for (scope, key); without `values`, delete it."""
+        limit = self.session.query(TransferLimit) \
+            .filter(TransferLimit.scope == scope.value) \
+            .filter(TransferLimit.key == key) \
+            .first()
+
+        if values is None:
+            if limit is not None:
+                self.session.delete(limit)
+                self.session.commit()
+            return None
+
+        if limit is None:
+            limit = TransferLimit(scope=scope.value, key=key)
+            self.session.add(limit)
+
+        limit.max_speed = values.get('max_speed')
+        limit.share = values.get('share')
+        limit.max_transfers = values.get('max_transfers')
+
+        self.session.commit()
+        return limit
+
     def create_category(self, *, name):
         category = Category(
             name=name,
@@ -0,0 +1,107 @@
+import enum
+import json
+import queue
+import threading
+import typing
+
+RESYNC_EVENT = {'type': 'resync'}
+
+
+class Subscription:
+    """Events queued for one client.
+
+    A client that falls more than `max_pending` events behind is told to
+    resync from /api/status instead of buffering without bound.
+    """
+
+    def __init__(self, max_pending):
+        self._queue = queue.Queue(max_pending)
+
+    def put(self, event: dict):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._clear()
+            self._queue.put_nowait(RESYNC_EVENT)
+
+    def _clear(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def get(self, timeout) -> typing.Optional[dict]:
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    """Fans events out to subscribers, at most `max_subscriptions` at once.
+
+    Each subscriber is a streaming response holding one of the server's
+    threads for as long as it's connected, so they're capped below the
+    number of threads to leave some for the other requests.
+    """
+
+    def __init__(self, max_pending=1000, max_subscriptions=None):
+        self.max_pending = max_pending
+        self.max_subscriptions = max_subscriptions
+
+        self._lock = threading.Lock()
+        self._subscriptions: typing.Set[Subscription] = set()
+
+    def publish(self, event: dict):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def subscribe(self) -> typing.Optional[Subscription]:
+        """A new subscription, or None if there are too many already."""
+        subscription = Subscription(self.max_pending)
+
+        with self._lock:
+            if self.max_subscriptions is not None and \
+                    len(self._subscriptions) >= self.max_subscriptions:
+                return None
+
+            self._subscriptions.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+
+def _json_default(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+
+    return value.__json__(None)
+
+
+def format_sse(event: dict) -> bytes:
+    data = json.dumps(event, default=_json_default)
+    return f'data: {data}\n\n'.encode('utf-8')
+
+
+def stream_events(
+    bus: EventBus, subscription: Subscription, keepalive=15,
+) -> typing.Iterator[bytes]:
+    try:
+        yield b'retry: 3000\n\n'
+
+        while True:
+            event = subscription.get(keepalive)
+            if event is None:
+                yield b': keepalive\n\n'
+                continue
+
+            yield format_sse(event)
+    finally:
+        bus.unsubscribe(subscription)
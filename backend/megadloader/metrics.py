@@ -0,0 +1,226 @@
+"""Counters, gauges and histograms, exposed in Prometheus' text format.
+
+Every process has its own `REGISTRY`. The processors send snapshots of
+theirs to the web process, which serves them at /metrics next to its own,
+labelled with the processor they came from.
+"""
+import bisect
+import math
+import threading
+import typing
+
+# seconds; from a fast db commit up to a large file
+DEFAULT_BUCKETS = (
+    .001, .005, .01, .05, .1, .5, 1, 5, 10, 30, 60, 300, 1800, 3600,
+)
+
+# (sample name, labels, value); what a family's samples are snapshotted as
+Sample = typing.Tuple[str, typing.Dict[str, str], float]
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key) -> typing.Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> typing.List[Sample]:
+        with self._lock:
+            return [
+                (self.name, self._labels(key), value)
+                for key, value in self._values.items()
+            ]
+
+    def snapshot(self) -> dict:
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'description': self.description,
+            'samples': self.samples(),
+        }
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+        self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket plus +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self) -> typing.List[Sample]:
+        with self._lock:
+            values = [
+                (key, list(counts)) for key, counts in self._values.items()
+            ]
+
+        samples = []
+        for key, counts in values:
+            labels = self._labels(key)
+            total = 0
+            for bound, count in zip([*self.buckets, math.inf], counts):
+                total += count
+                samples.append(
+                    (f'{self.name}_bucket', {**labels, 'le': bound}, total),
+                )
+
+            samples.append((f'{self.name}_sum', labels, counts[-1]))
+            samples.append((f'{self.name}_count', labels, total))
+
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: typing.Dict[str, Metric] = {}
+
+    def _register(self, metric: Metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description, labelnames=()) -> Counter:
+        return self._register(Counter(name, description, labelnames))
+
+    def gauge(self, name, description, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, description, labelnames))
+
+    def histogram(
+        self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(
+            Histogram(name, description, labelnames, buckets),
+        )
+
+    def snapshot(self) -> typing.List[dict]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return [metric.snapshot() for metric in metrics]
+
+
+REGISTRY = Registry()
+
+
+class RemoteMetrics:
+    """The latest snapshot each processor has sent to the web process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots: typing.Dict[str, typing.List[dict]] = {}
+
+    def update(self, source, snapshot: typing.List[dict]):
+        with self._lock:
+            self._snapshots[source] = snapshot
+
+    def snapshot(self, label, sources=None) -> typing.List[dict]:
+        """Every family sent by `sources` (default: all), labelled."""
+        with self._lock:
+            snapshots = list(self._snapshots.items())
+
+        return [
+            {
+                **family,
+                'samples': [
+                    (name, {label: source, **labels}, value)
+                    for name, labels, value in family['samples']
+                ],
+            }
+            for source, snapshot in snapshots
+            if sources is None or source in sources
+            for family in snapshot
+        ]
+
+
+def render(snapshot: typing.Iterable[dict]) -> str:
+    """Prometheus' text exposition format for snapshotted families.
+
+    Families with the same name, e.g. from different processes, are merged.
+    """
+    families = {}
+    for family in snapshot:
+        merged = families.setdefault(family['name'], {**family, 'samples': []})
+        merged['samples'].extend(family['samples'])
+
+    lines = []
+    for name, family in families.items():
+        description = _escape(family['description'], quotes=False)
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {family["kind"]}')
+        for sample_name, labels, value in family['samples']:
+            lines.append(
+                f'{sample_name}{_format_labels(labels)} {_format(value)}',
+            )
+
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ''
+
+    labels = ','.join(
+        f'{name}="{_escape(_format(value))}"'
+        for name, value in labels.items()
+    )
+    return f'{{{labels}}}'
+
+
+def _format(value) -> str:
+    if isinstance(value, str):
+        return value
+
+    if value == math.inf:
+        return '+Inf'
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return repr(value)
+
+
+def _escape(value: str, quotes=True) -> str:
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    if quotes:
+        value = value.replace('"', '\\"')
+    return value
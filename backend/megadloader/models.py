@@ -1,17 +1,24 @@
 import enum
+import sqlalchemy
 import sqlalchemy.ext.declarative
+import sqlalchemy.ext.hybrid
+import time
 
 from sqlalchemy import (
     BigInteger,
     Boolean,
     Column,
+    Float,
     ForeignKey,
+    Index,
     Integer,
     String,
     Text,
 )
 from sqlalchemy.orm import relationship
 
+from megadloader import is_file_url
+
 Base = sqlalchemy.ext.declarative.declarative_base()
 
 
@@ -22,8 +29,31 @@ class UrlStatus(enum.Enum):
     done = 'DONE'
 
 
+class LimitScope(enum.Enum):
+    everything = 'global'
+    category = 'category'
+    url = 'url'
+
+
+class UrlMove(enum.Enum):
+    top = 'top'
+    up = 'up'
+    down = 'down'
+    bottom = 'bottom'
+
+
+class FileChange(enum.Enum):
+    added = 'added'
+    changed = 'changed'
+    unchanged = 'unchanged'
+
+
 class Url(Base):
     __tablename__ = 'urls'
+    __table_args__ = (
+        Index('ix_urls_url', 'url', unique=True),
+        Index('ix_urls_status', 'status'),
+    )
 
     id = Column(Integer, primary_key=True)
     category = Column(String(250), nullable=True)
@@ -31,46 +61,133 @@ class Url(Base):
 
     processor_id = Column(String(250), default='')
     status = Column(String(20), default=UrlStatus.idle.value)
+    # while processing, the owning processor renews this (a unix time);
+    # once it has passed, any processor may claim the url
+    lease_expires = Column(Float, nullable=True)
     message = Column(Text(), default='')
+    version = Column(BigInteger, nullable=False, default=0, server_default='0')
+
+    # urls are claimed in `queue_position` order, and paused ones not at
+    # all; rows from before positions existed are ordered by id
+    position = Column(BigInteger, nullable=True)
+    paused = Column(Boolean, nullable=False, default=False, server_default='0')
+
+    # every file has a row with its node: the next run downloads what's
+    # left from those instead of walking the folder again
+    indexed = Column(
+        Boolean, nullable=False, default=False, server_default='0',
+    )
+
+    # re-fetch the tree on the next run and only download what changed;
+    # the counts are those of the last completed sync
+    sync = Column(Boolean, nullable=False, default=False, server_default='0')
+    sync_added = Column(Integer, nullable=True)
+    sync_changed = Column(Integer, nullable=True)
+    sync_removed = Column(Integer, nullable=True)
+    sync_unchanged = Column(Integer, nullable=True)
 
     files = relationship('File')
 
-    def get_status(self, processor_id):
-        if self.status == UrlStatus.processing:
-            if self.processor_id != processor_id:
-                return UrlStatus.idle
+    def get_status(self, processor_ids):
+        if self.status == UrlStatus.processing.value:
+            if self.processor_id not in processor_ids or self.lease_expired:
+                return UrlStatus.idle.value
         return self.status
 
+    @sqlalchemy.ext.hybrid.hybrid_property
+    def queue_position(self):
+        return self.id if self.position is None else self.position
+
+    @queue_position.expression
+    def queue_position(cls):
+        return sqlalchemy.func.coalesce(cls.position, cls.id)
+
     @property
-    def is_file(self):
-        index = self.url.index('#')
-        if index == -1:
-            return False
+    def lease_expired(self):
+        return self.lease_expires is None or self.lease_expires < time.time()
 
-        return self.url[index + 1] != 'F'
+    @property
+    def is_file(self):
+        return is_file_url(self.url)
 
-    def __json__(self, request):
-        status = self.get_status(request.processor_id)
+    def summary_json(self, request):
+        status = self.get_status(request.processor_ids)
 
         return {
             'queue_id': str(self.id),
-            'files': [f for f in self.files],
             'status': status,
             'url': self.url,
             'error_msg': self.message,
+            'version': self.version,
+            'position': self.queue_position,
+            'paused': self.paused,
+            'sync': self.sync,
+            'last_sync': self.last_sync_json(),
+        }
+
+    def last_sync_json(self):
+        if self.sync_added is None:
+            return None
+
+        return {
+            'added': self.sync_added,
+            'changed': self.sync_changed,
+            'removed': self.sync_removed,
+            'unchanged': self.sync_unchanged,
+        }
+
+    def __json__(self, request):
+        return {
+            **self.summary_json(request),
+            'files': [f for f in self.files],
             'transferred_size': sum((f.transferred_bytes for f in self.files)),
             'total_size': sum((f.total_bytes for f in self.files)),
         }
 
 
+class UrlSummary:
+    """A Url with aggregates over its files, as computed by Db.get_urls."""
+
+    def __init__(
+        self, url: Url, file_count, finished_count, transferred_size,
+        total_size, active_count,
+    ):
+        self.url = url
+        self.file_count = file_count
+        self.finished_count = finished_count
+        self.transferred_size = transferred_size
+        self.total_size = total_size
+        self.active_count = active_count
+
+    def __json__(self, request):
+        return {
+            **self.url.summary_json(request),
+            'file_count': self.file_count,
+            'finished_count': self.finished_count,
+            'transferred_size': self.transferred_size,
+            'total_size': self.total_size,
+            'active_count': self.active_count,
+        }
+
+
 class File(Base):
     __tablename__ = 'files'
+    __table_args__ = (
+        Index(
+            'ix_files_url_id_file_handle', 'url_id', 'file_handle',
+            unique=True,
+        ),
+        # a url's files in id order, for paging through them
+        Index('ix_files_url_id', 'url_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     url_id = Column(Integer, ForeignKey('urls.id'))
     url = relationship('Url', back_populates='files')
     path = Column(String(1024), nullable=False)
     file_handle = Column(String(1024), nullable=False)
+    # MegaNode.serialize(), enough to download the file without a login
+    node = Column(Text, nullable=True)
 
     is_processing = Column(Boolean, default=False)
 
@@ -81,6 +198,7 @@ class File(Base):
     mean_speed = Column(BigInteger, nullable=True)
     is_finished = Column(Boolean, default=False)
     state = Column(Integer, nullable=True)
+    version = Column(BigInteger, nullable=False, default=0, server_default='0')
 
     @property
     def status(self):
@@ -108,6 +226,46 @@ class File(Base):
             'is_finished': self.is_finished,
             'state': self.state,
             'status': self.status,
+            'version': self.version,
+        }
+
+
+class Revision(Base):
+    """Single-row, monotonically increasing change counter.
+
+    Every write to a Url or File stamps the row with the next value, so
+    clients can ask for everything changed since a value they've seen.
+    """
+    __tablename__ = 'revisions'
+
+    id = Column(Integer, primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+class TransferLimit(Base):
+    """Download limits for all transfers, a category or a single url.
+
+    `max_speed` (bytes per second) is only used in the global scope, where
+    the SDK enforces it; `share` and `max_transfers` are applied by the
+    processor's scheduler to a category's or url's transfers.
+    """
+    __tablename__ = 'transfer_limits'
+    __table_args__ = (
+        Index('ix_transfer_limits_scope_key', 'scope', 'key', unique=True),
+    )
+
+    id = Column(Integer, primary_key=True)
+    scope = Column(String(20), nullable=False)
+    key = Column(String(250), nullable=False, default='')
+
+    max_speed = Column(BigInteger, nullable=True)
+    share = Column(Integer, nullable=True)
+    max_transfers = Column(Integer, nullable=True)
+
+    def __json__(self, request):
+        return {
+            'share': self.share,
+            'max_transfers': self.max_transfers,
         }
 
 
@@ -1,4 +1,6 @@
 import click
+import collections
+import concurrent.futures
 import configparser
 import datetime
 import enum
@@ -8,27 +10,81 @@ import mega
 import multiprocessing
 import os
 import queue
+import signal
+import sqlalchemy
+import sqlalchemy.orm.exc
 import threading
 import time
 import typing
 import uuid
 
 from megadloader import (
+    is_file_url,
     suppress_errors,
     threadlocal,
     MEGA_API_KEY,
 )
+from megadloader.cache import (
+    FolderCache,
+    folder_cache_from_settings,
+    folder_handle,
+)
+from megadloader.channel import ChannelClient
 from megadloader.db import Db, configure_db
-from megadloader.models import File, Url, UrlStatus
+from megadloader.metrics import REGISTRY
+from megadloader.models import File, FileChange, LimitScope, Url, UrlStatus
+from megadloader.queues import ClassLimit, FairQueue, TransferOrder
+from megadloader.tracing import TRACER, Profiler, traced
 
 MegaHandle = int
 
+DOWNLOADED_BYTES = REGISTRY.counter(
+    'megadloader_downloaded_bytes_total',
+    'Bytes received by transfers.',
+)
+FILES_DOWNLOADED = REGISTRY.counter(
+    'megadloader_files_downloaded_total',
+    'Transfers that ended, by whether the file is complete.',
+    ['result'],
+)
+ACTIVE_TRANSFERS = REGISTRY.gauge(
+    'megadloader_active_transfers',
+    'Transfers in progress.',
+)
+PENDING_FILES = REGISTRY.gauge(
+    'megadloader_pending_files',
+    'Indexed files waiting for a transfer slot.',
+)
+TRANSFER_SECONDS = REGISTRY.histogram(
+    'megadloader_file_transfer_seconds',
+    'Time from starting the transfer of a file until it ended.',
+)
+INDEX_SECONDS = REGISTRY.histogram(
+    'megadloader_url_index_seconds',
+    'Time taken to walk the folder or file behind a url.',
+)
+CHECK_SECONDS = REGISTRY.histogram(
+    'megadloader_file_check_seconds',
+    'Time taken by each startup check of the destination.',
+    ['check'],
+)
+STATE_SECONDS = REGISTRY.counter(
+    'megadloader_processor_state_seconds_total',
+    'Time the processor spent in each state.',
+    ['state'],
+)
+
 
 @click.command()
 @click.option('--processor-id')
 @click.option('--config', default='app.ini', type=click.Path(exists=True, dir_okay=False))
 @click.option('--app-name', default='main')
-def cli(processor_id, config, app_name):
+@click.option('--channel', help='address of the web process to report to')
+@click.option(
+    '--check-files/--no-check-files', default=True,
+    help='clean up and verify the destination on startup',
+)
+def cli(processor_id, config, app_name, channel, check_files):
     logging.config.fileConfig(config)
 
     if processor_id is None:
@@ -39,10 +95,54 @@ def cli(processor_id, config, app_name):
 
     settings = parser[f'app:{app_name}']
     destination = settings['destination']
+    trace_dir = settings.get('trace_dir', fallback='./trace')
 
     configure_db(settings)
 
-    processor = DownloadProcessor(destination, processor_id)
+    if channel:
+        channel = ChannelClient.from_env(channel)
+
+    processor = DownloadProcessor(
+        destination, processor_id,
+        channel=channel,
+        max_concurrent_transfers=settings.getint(
+            'max_concurrent_transfers', fallback=1,
+        ),
+        transfer_order=TransferOrder(
+            settings.get('transfer_order', fallback='fifo'),
+        ),
+        fast_lane_threshold=settings.getint(
+            'fast_lane_threshold', fallback=0,
+        ),
+        progress_flush_interval=settings.getfloat(
+            'progress_flush_interval', fallback=1,
+        ),
+        idle_timeout=settings.getfloat('idle_timeout', fallback=60),
+        max_pending_files=settings.getint('max_pending_files', fallback=1000),
+        index_batch_size=settings.getint('index_batch_size', fallback=100),
+        folder_cache=folder_cache_from_settings(settings),
+        verify_workers=settings.getint('verify_workers', fallback=8),
+        keep_partial_transfers=settings.getboolean(
+            'keep_partial_transfers', fallback=False,
+        ),
+        check_files=check_files,
+        processor_workers=settings.getint('processor_workers', fallback=1),
+        lease_duration=settings.getfloat('lease_duration', fallback=30),
+        metrics_interval=settings.getfloat('metrics_interval', fallback=5),
+        trace_dir=trace_dir,
+        profile_seconds=settings.getfloat('profile_seconds', fallback=30),
+    )
+
+    TRACER.configure(
+        os.path.join(trace_dir, f'processor-{processor_id}.jsonl'),
+        max_bytes=settings.getint('trace_max_bytes', fallback=10485760),
+        backup_count=settings.getint('trace_backup_count', fallback=3),
+        enabled=settings.getboolean('trace', fallback=False),
+    )
+    if hasattr(signal, 'SIGUSR1'):
+        # kill -USR1 toggles tracing, kill -USR2 takes a profile
+        signal.signal(signal.SIGUSR1, lambda *_: TRACER.toggle())
+        signal.signal(signal.SIGUSR2, lambda *_: processor.profiler.start())
 
     try:
         processor.run()
@@ -53,50 +153,191 @@ def cli(processor_id, config, app_name):
 class NodeWrapper:
     def __init__(
         self, node_id: uuid.UUID, path: str, file_node: mega.MegaNode,
-        file_model: File,
+        file_model: File, url_model: Url,
     ):
         self.node_id = node_id
         self.path = path
         self.file_model = file_model
         self.file_node = file_node
+        self.url_model = url_model
+        # the url may be deleted under us, and its model with it
+        self.url_id = _url_id(url_model)
+        self.started = None
+        self.listener: typing.Optional[FileListener] = None
+        # a paused transfer keeps its place in the SDK but not its slot
+        self.paused = False
+
+
+class SyncReport:
+    """What a sync of one url found, counted as its batches come in."""
+
+    def __init__(self):
+        self.file_handles = set()
+        self.counts = {change: 0 for change in FileChange}
+        self.removed = 0
+
+    def add(self, file_model: File, change: FileChange):
+        self.file_handles.add(file_model.file_handle)
+        self.counts[change] += 1
+
+    def __str__(self):
+        return (
+            f'{self.counts[FileChange.added]} added, '
+            f'{self.counts[FileChange.changed]} changed, '
+            f'{self.removed} removed, '
+            f'{self.counts[FileChange.unchanged]} unchanged'
+        )
+
+
+class IndexRun:
+    """One indexer thread's run over a url; its hand-overs carry it.
+
+    A url that's forgotten, e.g. cancelled, has its run cancelled, which
+    stops the thread; anything it handed over before then is dropped, as
+    is a run that's been replaced by a new one for the same url.
+    """
+
+    def __init__(self, url_id):
+        self.url_id = url_id
+        self.cancelled = threading.Event()
 
 
 class ProcessorStatus(enum.Enum):
     IDLE = 'idle'
-    REAPING = 'reaping'
-    SCANNING = 'scanning'
     INDEXING = 'indexing'
     DOWNLOADING = 'downloading'
 
 
-def set_processor_status(status):
-    def wrapper(func):
-        def inner(self, *args, **kwargs):
-            self.status = status
+class ProcessorUpdate(enum.Enum):
+    TRANSFER_FINISHED = 'transfer_finished'
+    FLUSH_PROGRESS = 'flush_progress'
+    WAKE = 'wake'
+    INDEXED = 'indexed'
+    VERIFIED = 'verified'
+    LIMITS = 'limits'
+    CONTROL = 'control'
+    RERUN = 'rerun'
 
-            try:
-                return func(self, *args, **kwargs)
-            finally:
-                self.status = ProcessorStatus.IDLE
 
-        return inner
+class TransferControl(enum.Enum):
+    pause = 'pause'
+    resume = 'resume'
+    cancel = 'cancel'
 
-    return wrapper
+
+# the class the queued files of a paused url wait in: it gets no slots
+HELD = ClassLimit(max_transfers=0)
 
 
 class DownloadProcessor(multiprocessing.Process):
+    def __init__(
+        self, destination, processor_id, max_concurrent_transfers=1,
+        transfer_order=TransferOrder.fifo, fast_lane_threshold=0,
+        channel: ChannelClient = None, progress_flush_interval=1,
+        idle_timeout=60, max_pending_files=1000, index_batch_size=100,
+        folder_cache: FolderCache = None, verify_workers=8,
+        keep_partial_transfers=False, check_files=True, processor_workers=1,
+        lease_duration=30, metrics_interval=5, trace_dir='./trace',
+        profile_seconds=30,
+    ):
         super().__init__(name='DownloadQueueProcessor', daemon=False)
 
-        self.api = mega.MegaApi('vIJE2YwK')
+        # folders are logged in to and walked on a separate instance, so
+        # switching folders never disturbs the transfers; it hands out
+        # authorized nodes, which any instance can download
+        self.api = mega.MegaApi(MEGA_API_KEY)
+        self.index_api = mega.MegaApi(MEGA_API_KEY)
         self.destination = destination
         self.event = threading.Event()
         self.log = logging.getLogger('processor')
-        self.status = ProcessorStatus.IDLE
+        self._status = ProcessorStatus.IDLE
+        self._status_since = time.monotonic()
         self.processor_id = processor_id
+        self.idle_timeout = idle_timeout
+        self.channel = channel
+        self.max_concurrent_transfers = max(1, max_concurrent_transfers)
         self._updates = queue.Queue()
 
-        self.current_file_id = None
-        self._files: typing.List[NodeWrapper] = []
+        if fast_lane_threshold and self.max_concurrent_transfers < 2:
+            self.log.warning('fast lane needs at least 2 transfer slots')
+            fast_lane_threshold = 0
+
+        self.current_url: typing.Optional[Url] = None
+        self._files = FairQueue(transfer_order, fast_lane_threshold)
+        self._transfers: typing.Dict[int, NodeWrapper] = {}
+        self._remaining: typing.Dict[int, int] = {}
+        # per url, the transfers that failed or were cancelled
+        self._incomplete: typing.Dict[int, int] = {}
+        self._fast_lane_file_id = None
+        self._class_limits: typing.Dict[typing.Hashable, ClassLimit] = {}
+        self._paused_urls: typing.Set[int] = set()
+
+        # urls being walked by an indexer thread, which hands batches of
+        # nodes over through a small bounded queue; it blocks once
+        # max_pending_files that can start are waiting to be downloaded
+        self.max_pending_files = max_pending_files
+        self.index_batch_size = index_batch_size
+        self.folder_cache = folder_cache
+        self._indexing: typing.Dict[int, Url] = {}
+        self._index_runs: typing.Dict[int, IndexRun] = {}
+        # folders are walked one at a time, as logging in to one switches
+        # index_api over to it
+        self._index_lock = threading.Lock()
+        self._indexed = queue.Queue(maxsize=2)
+        self._syncs: typing.Dict[int, SyncReport] = {}
+
+        # urls indexed by an earlier run: instead of walking the folder,
+        # the indexer thread pages through the rows of their unfinished
+        # files and hands over (file id, node) batches the same way
+        self._resuming: typing.Set[int] = set()
+
+        self.verify_workers = max(1, verify_workers)
+        self.keep_partial_transfers = keep_partial_transfers
+        self.check_files = check_files
+
+        # the global speed limit is split evenly between the workers, as
+        # each applies its share to its own SDK instance
+        self.processor_workers = max(1, processor_workers)
+
+        # urls are claimed for lease_duration seconds, and the leases of
+        # the ones being worked on are renewed well before they run out
+        self.lease_duration = lease_duration
+        self._last_heartbeat = time.monotonic()
+
+        # urls that had files reset by verification while they were being
+        # processed; they're queued again instead of being marked done
+        self._rerun_urls: typing.Set[int] = set()
+
+        # latest progress per transfer, written out every
+        # progress_flush_interval seconds rather than on every SDK update
+        self.progress_flush_interval = progress_flush_interval
+        self._progress: typing.Dict[int, dict] = {}
+        self._progress_states: typing.Dict[int, int] = {}
+        self._progress_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+        # the web app serves what we send every metrics_interval seconds
+        self.metrics_interval = metrics_interval
+        self._last_metrics = time.monotonic()
+
+        # profiles the main loop for a while when asked to, e.g. by signal
+        self.profiler = Profiler(
+            trace_dir, f'processor-{processor_id}', profile_seconds,
+        )
+
+    @property
+    def status(self) -> ProcessorStatus:
+        return self._status
+
+    @status.setter
+    def status(self, status: ProcessorStatus):
+        self._count_state_time()
+        self._status = status
+
+    def _count_state_time(self):
+        now = time.monotonic()
+        STATE_SECONDS.inc(now - self._status_since, state=self._status.value)
+        self._status_since = now
 
     @property
     @threadlocal
@@ -104,143 +345,920 @@ class DownloadProcessor(multiprocessing.Process):
         return Db()
 
     def get_files(self) -> typing.List[NodeWrapper]:
-        return self._files
+        return list(self._files)
 
     def run(self):
-        self.status = ProcessorStatus.SCANNING
+        if self.check_files:
+            thread = threading.Thread(
+                target=self._check_files, args=(time.time(),),
+                name='FileChecker', daemon=True,
+            )
+            thread.start()
 
-        self._clean_broken_transfers()
-        self._verify_files()
+        self._load_limits()
 
-        self.status = ProcessorStatus.IDLE
+        if self.channel is not None:
+            self.channel.listen(self._on_channel_message)
 
         while not self.event.is_set():
             try:
+                self.profiler.poll()
                 did_work = self._loop()
                 if not did_work:
-                    self.log.info('sleeping ... ')
-                    time.sleep(.1)
+                    # the web app wakes us up when it queues a url; the
+                    # timeout only catches urls added behind its back, or
+                    # another processor's lease running out
+                    self.log.debug('waiting for work ...')
+                    self._publish_metrics(force=True)
+                    self._wait_for_update(self._idle_wait())
                     continue
 
+                self._publish_metrics()
+
             except Exception:
-                self.log.error(f"PROCESSOR ERROR:")
+                self.log.exception('PROCESSOR ERROR:')
+                # a failed flush leaves the session unusable until then
+                self.db.session.rollback()
                 time.sleep(1)
 
         self.db.dispose()
 
-    @set_processor_status(ProcessorStatus.REAPING)
-    def _clean_broken_transfers(self):
+    def _check_files(self, started):
+        """Startup housekeeping, on its own thread while downloads start.
+
+        It runs alongside the main loop's states, so its time is reported
+        per check rather than as a processor state.
+        """
+        check_started = time.monotonic()
+        try:
+            self._clean_broken_transfers(started)
+        except Exception:
+            self.log.exception('failed to clean broken transfers')
+        CHECK_SECONDS.observe(time.monotonic() - check_started, check='clean')
+
+        check_started = time.monotonic()
+        self._verify_files()
+        CHECK_SECONDS.observe(time.monotonic() - check_started, check='verify')
+
+    def _clean_broken_transfers(self, started):
+        """Delete the SDK's temp files left behind by interrupted transfers.
+
+        Only the directories of unfinished files are looked at. Temp files
+        modified after `started` belong to this run and are left alone.
+        """
+        if self.keep_partial_transfers:
+            self.log.info('keeping partial transfers')
+            return
+
         self.log.info('start cleaning broken transfers')
 
-        for root, dirname, files in os.walk(self.destination):
-            for file in files:
-                if file.endswith('.mega'):
-                    if file.startswith('.getxfer.'):
-                        os.unlink(os.path.join(root, file))
+        directories = {
+            os.path.dirname(path)
+            for path in self.db.get_unfinished_file_paths()
+        }
+        removed = sum(
+            _remove_partial_transfers(directory, started)
+            for directory in directories
+        )
 
-        self.log.info('cleaning done')
+        self.log.info(f'cleaning done, removed {removed} partial transfers')
 
-    @set_processor_status(ProcessorStatus.SCANNING)
     def _verify_files(self):
+        """Find finished files that are missing or truncated on disk.
+
+        Runs on its own thread while downloads start. Each directory is
+        listed once, by a pool of workers, and the broken files are handed
+        to the main loop to reset, along with the unfinished files of urls
+        that are done, e.g. by an older version, so they're queued again.
+        """
         self.log.info('verifying files')
 
-        for url in self.db.get_urls():
-            done = True
+        directories = collections.defaultdict(list)
+        broken = []
+        try:
+            for file_id, path, total_bytes in self.db.get_finished_files():
+                directory, name = os.path.split(path)
+                directories[directory].append((file_id, name, total_bytes))
+
+            with concurrent.futures.ThreadPoolExecutor(
+                self.verify_workers,
+            ) as executor:
+                scans = {
+                    executor.submit(_file_sizes, directory): directory
+                    for directory in directories
+                }
+                for scan in concurrent.futures.as_completed(scans):
+                    directory = scans[scan]
+                    try:
+                        sizes = scan.result()
+                    except OSError:
+                        self.log.exception(f'failed to list {directory}')
+                        continue
+
+                    for file_id, name, total_bytes in directories[directory]:
+                        if sizes.get(name) != total_bytes:
+                            broken.append(file_id)
+
+            broken.extend(self.db.get_unfinished_files_of_done_urls())
+        except Exception:
+            self.log.exception('failed to verify files')
+        finally:
+            self.db.dispose()
+
+        self.log.info(f'done verifying files, {len(broken)} broken')
+        if broken:
+            self._updates.put((ProcessorUpdate.VERIFIED, broken))
+
+    def _reset_files(self, file_ids: typing.List[int]):
+        elsewhere = []
+        for url_id in self.db.reset_files(file_ids):
+            if url_id in self._active_url_ids():
+                self._rerun_urls.add(url_id)
+                continue
+
+            url_model = self.db.get_url(url_id)
+            if url_model is None:
+                # deleted since
+                continue
+
+            if url_model.status == UrlStatus.processing.value:
+                elsewhere.append(url_id)
+            else:
+                self._requeue_url(url_model)
+
+        if elsewhere:
+            # only the processors working on them know whether they're
+            # still running; the web app passes this on to all of them
+            self.publish({'type': 'rerun', 'url_ids': elsewhere})
+
+    def _rerun(self, url_ids: typing.List[int]):
+        """Download the reset files of urls another processor verified."""
+        for url_id in url_ids:
+            if url_id in self._active_url_ids():
+                self._rerun_urls.add(url_id)
+                continue
+
+            # or finished by us since
+            url_model = self.db.get_url(url_id)
+            if url_model is not None and \
+                    url_model.processor_id == self.processor_id:
+                self._requeue_url(url_model)
+
+    def _requeue_url(self, url_model: Url):
+        if url_model.status == UrlStatus.done.value:
+            self.log.info(f'resetting url {url_model.url}')
+            self._update_url(url_model, UrlStatus.idle)
+
+    @traced
+    def _loop(self):
+        self.log.info('looping through files')
 
-            for file in url.files:
-                full_path = os.path.join(self.destination, file.path)
-                if os.path.exists(full_path):
-                    continue
+        self._heartbeat()
+        did_work = self._take_indexed()
+        did_work = self._start_transfers() or did_work
+
+        if not self._indexing.keys() - self._paused_urls and \
+                self._running_transfers() < self.max_concurrent_transfers:
+            # slots left over, by this url or through its limits, or it's
+            # paused: take on the next url alongside it
+            url_model = self.db.claim_next_url(
+                self.processor_id, self.lease_duration,
+                exclude=self._active_url_ids(),
+            )
+            if url_model:
+                self.current_url = url_model
+                self._process_url(url_model)
+                return True
+
+        if self._transfers or self._indexing:
+            if self._transfers:
+                self.status = ProcessorStatus.DOWNLOADING
+            else:
+                self.status = ProcessorStatus.INDEXING
+
+            self._wait_for_update()
+            return True
 
-                print(f'--- resetting file {file.path}')
-                self.db.reset_file(file)
-                done = False
+        self.status = ProcessorStatus.IDLE
+        return did_work
 
-            if not done:
-                print(f'--- resetting url {url.url} ---')
-                self.db.update_url(url, self.processor_id, UrlStatus.idle)
+    def _active_url_ids(self) -> typing.Set[int]:
+        return {*self._indexing, *self._remaining}
 
-        self.log.info('done verifying files')
+    def _running_transfers(self) -> int:
+        return sum(
+            1 for wrapper in self._transfers.values() if not wrapper.paused
+        )
 
-    def _loop(self):
-        self.log.info('looping through files')
+    def _idle_wait(self):
+        timeout = self.idle_timeout
 
-        if self._files:
-            file = self._files.pop(0)
-            self.current_file_id = file.file_model.id
-            self._download_file(file)
-            file.current_file_id = None
+        profiling = self.profiler.remaining()
+        if profiling is not None:
+            # the profile is written by this thread once it's over
+            timeout = min(timeout, profiling)
 
-            if not self._files:
-                self.db.update_url(
-                    self.current_url, self.processor_id, UrlStatus.done,
-                )
-                self.current_url = None
-            return True
+        expires = self.db.next_lease_expiry()
+        if expires is None:
+            return timeout
+
+        # wake up when the lease runs out, in case its processor died
+        return max(1, min(timeout, expires - time.time()))
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        if now - self._last_heartbeat < self.lease_duration / 3:
+            return
+
+        self._last_heartbeat = now
+        lost = self.db.renew_leases(
+            self.processor_id, self._active_url_ids(), self.lease_duration,
+        )
+        for url_id in lost:
+            # we were too slow to renew it and someone else took over;
+            # its transfers are theirs to run now, and forgetting it stops
+            # its indexer thread too
+            self.log.warning(f'lost the lease on url {url_id}')
+            self._control_url_transfers(TransferControl.cancel, url_id)
+            self._forget_url(url_id)
+
+        if lost:
+            self._apply_limits()
+
+    def _start_transfers(self):
+        started = False
+
+        while self._files:
+            active = self._active_classes()
+            fast_lane = self._next_slot_is_fast_lane(active)
+            if fast_lane is None:
+                break
+
+            wrapper = self._files.pop(fast_lane, active)
+            if wrapper is None:
+                break
+
+            started = True
+
+            if wrapper.file_model.is_finished:
+                self.log.info(f'finished with {wrapper.file_model.path}')
+                self._file_done(wrapper)
+                continue
+
+            if fast_lane:
+                self._fast_lane_file_id = wrapper.file_model.id
+            self._download_file(wrapper)
+
+        return started
+
+    def _next_slot_is_fast_lane(self, active) -> typing.Optional[bool]:
+        """Which lane the next transfer goes in, or None if no slot is free.
+
+        With a fast lane configured, one slot is reserved for files under
+        the size threshold so they never wait behind large transfers.
+        """
+        slots = self.max_concurrent_transfers
+        running = self._running_transfers()
+        if not self._files.has_fast_lane:
+            return False if running < slots else None
+
+        fast_lane = self._transfers.get(self._fast_lane_file_id)
+        fast_lane_busy = fast_lane is not None and not fast_lane.paused
+        if running - fast_lane_busy < slots - 1:
+            return False
 
-        self.current_url = self.db.get_next_url()
-        if self.current_url:
-            self._process_url(self.current_url)
+        if not fast_lane_busy and self._files.has_small(active):
             return True
 
-        return False
+        return None
+
+    def _transfer_class(self, wrapper: NodeWrapper):
+        """Scheduling class of a transfer in the FairQueue.
+
+        Its url's if that has limits, else its category's if that has
+        limits, else the default class (None).
+        """
+        url_model = wrapper.url_model
+        for cls in [
+            (LimitScope.url, str(wrapper.url_id)),
+            (LimitScope.category, url_model.category),
+        ]:
+            if cls in self._files.limits:
+                return cls
+
+        return None
+
+    def _active_classes(self) -> typing.Dict[typing.Hashable, int]:
+        return collections.Counter(
+            self._transfer_class(wrapper)
+            for wrapper in self._transfers.values()
+            if not wrapper.paused
+        )
+
+    def _load_limits(self):
+        """Apply the limits stored in the db, as set through the web app."""
+        max_speed = 0
+        class_limits = {}
+        for limit in self.db.get_limits():
+            scope = LimitScope(limit.scope)
+            if scope == LimitScope.everything:
+                max_speed = limit.max_speed or 0
+            else:
+                class_limits[(scope, limit.key)] = ClassLimit(
+                    limit.share, limit.max_transfers,
+                )
+
+        if max_speed:
+            max_speed = max(1, max_speed // self.processor_workers)
+
+        self.log.info(f'download speed limit: {max_speed or "none"}')
+        self.api.setMaxDownloadSpeed(max_speed)
+
+        self._class_limits = class_limits
+        self._apply_limits()
+
+    def _apply_limits(self):
+        limits = dict(self._class_limits)
+        for url_id in self._paused_urls:
+            limits[(LimitScope.url, str(url_id))] = HELD
+
+        self._files.limits = limits
+        self._files.regroup(self._transfer_class)
+
+    def _wait_for_update(self, timeout=1):
+        next_flush = self._last_flush + self.progress_flush_interval
+        if self._progress:
+            timeout = min(timeout, max(0, next_flush - time.monotonic()))
+
+        try:
+            kind, payload = self._updates.get(timeout=timeout)
+        except queue.Empty:
+            kind, payload = None, None
+
+        if kind == ProcessorUpdate.TRANSFER_FINISHED:
+            self._finish_transfer(*payload)
+
+        if kind == ProcessorUpdate.INDEXED:
+            self._take_indexed()
+
+        if kind == ProcessorUpdate.VERIFIED:
+            self._reset_files(payload)
+
+        if kind == ProcessorUpdate.LIMITS:
+            self._load_limits()
+
+        if kind == ProcessorUpdate.CONTROL:
+            self._control(
+                TransferControl(payload['action']),
+                payload.get('url_id'), payload.get('file_id'),
+            )
+
+        if kind == ProcessorUpdate.RERUN:
+            self._rerun(payload)
+
+        if kind == ProcessorUpdate.FLUSH_PROGRESS or \
+                self._progress and time.monotonic() >= next_flush:
+            self._flush_progress()
+
+    @traced
+    def _finish_transfer(self, file_id, progress: typing.Optional[dict]):
+        wrapper = self._transfers.pop(file_id, None)
+        if wrapper is None:
+            return
+
+        if self._fast_lane_file_id == file_id:
+            self._fast_lane_file_id = None
+
+        with self._progress_lock:
+            self._progress.pop(file_id, None)
+            self._progress_states.pop(file_id, None)
+
+        if wrapper.started is not None:
+            TRANSFER_SECONDS.observe(time.monotonic() - wrapper.started)
+        finished = bool(progress and progress.get('is_finished'))
+        FILES_DOWNLOADED.inc(result='complete' if finished else 'incomplete')
+
+        final = {**(progress or {}), 'is_processing': False}
+        self._write_progress({file_id: final})
+        self.log.info('done downloading file')
+        if not finished and wrapper.url_id in self._remaining:
+            self._incomplete[wrapper.url_id] = \
+                self._incomplete.get(wrapper.url_id, 0) + 1
+        self._file_done(wrapper)
+
+    def _flush_progress(self):
+        with self._progress_lock:
+            progress, self._progress = self._progress, {}
+
+        self._last_flush = time.monotonic()
+        self._write_progress(progress)
+
+    def _write_progress(self, progress: typing.Dict[int, dict]):
+        for file_model in self.db.update_files_progress(progress):
+            self.publish_file(file_model)
+
+    def _file_done(self, wrapper: NodeWrapper):
+        url_id = wrapper.url_id
+        if url_id not in self._remaining:
+            # the url failed or was given up while this was downloading
+            return
+
+        self._remaining[url_id] -= 1
+        if self._remaining[url_id] > 0:
+            return
+
+        if url_id not in self._indexing:
+            self._finish_url(wrapper.url_model)
+
+    def _finish_url(self, url_model: Url):
+        url_id = _url_id(url_model)
+        self._remaining.pop(url_id, None)
+        incomplete = self._incomplete.pop(url_id, 0)
+        if url_id in self._rerun_urls:
+            self._rerun_urls.discard(url_id)
+            self._update_url(url_model, UrlStatus.idle)
+        elif incomplete:
+            # a sync downloads them again
+            self._update_url(
+                url_model, UrlStatus.error,
+                f'{incomplete} file(s) did not finish',
+            )
+        else:
+            self._update_url(url_model, UrlStatus.done)
+
+        if self.current_url is url_model:
+            self.current_url = None
+
+    def _fail_url(self, url_model: Url, error_msg):
+        self._forget_url(_url_id(url_model))
+        self._update_url(url_model, UrlStatus.error, error_msg)
+
+    def _forget_url(self, url_id):
+        """Drop everything still queued or tracked for a url."""
+        self._files.remove(lambda f: f.url_id == url_id)
+        self._indexing.pop(url_id, None)
+        run = self._index_runs.pop(url_id, None)
+        if run is not None:
+            run.cancelled.set()
+        self._syncs.pop(url_id, None)
+        self._resuming.discard(url_id)
+        self._rerun_urls.discard(url_id)
+        self._remaining.pop(url_id, None)
+        self._incomplete.pop(url_id, None)
+        self._paused_urls.discard(url_id)
+
+        if self.current_url is not None and \
+                _url_id(self.current_url) == url_id:
+            self.current_url = None
+
+    def _control(self, action: TransferControl, url_id=None, file_id=None):
+        """Pause, resume or cancel a transfer, or everything of a url.
+
+        Every processor is told; the one with the transfer or url acts on
+        it. A url's status and paused flag are the web app's to write.
+        """
+        if file_id is not None:
+            wrapper = self._transfers.get(file_id)
+            if wrapper is not None:
+                self._control_transfer(action, wrapper)
+            return
+
+        if url_id not in self._active_url_ids():
+            return
+
+        self._control_url_transfers(action, url_id)
+        if action == TransferControl.cancel:
+            self.log.info(f'cancelled url {url_id}')
+            self._forget_url(url_id)
+        elif action == TransferControl.pause:
+            self._paused_urls.add(url_id)
+        else:
+            self._paused_urls.discard(url_id)
+
+        self._apply_limits()
+
+    def _control_url_transfers(self, action: TransferControl, url_id):
+        for wrapper in list(self._transfers.values()):
+            if wrapper.url_id == url_id:
+                self._control_transfer(action, wrapper)
+
+    def _control_transfer(self, action: TransferControl, wrapper: NodeWrapper):
+        if wrapper.listener is None:
+            # failed to start; it's on its way out
+            return
+
+        self.log.info(f'{action.value} {wrapper.path}')
+        if action == TransferControl.cancel:
+            wrapper.listener.cancel(self.api)
+        else:
+            wrapper.paused = action == TransferControl.pause
+            wrapper.listener.pause(self.api, wrapper.paused)
+
+    def _on_channel_message(self, message: dict):
+        if message['type'] == 'wake':
+            self.wake()
+
+        if message['type'] == 'limits':
+            self._updates.put((ProcessorUpdate.LIMITS, None))
+
+        if message['type'] == 'control':
+            self._updates.put((ProcessorUpdate.CONTROL, message))
+
+        if message['type'] == 'rerun':
+            self._updates.put((ProcessorUpdate.RERUN, message['url_ids']))
+
+    def wake(self):
+        self._updates.put((ProcessorUpdate.WAKE, None))
+
+    def on_transfer_progress(self, file_id, progress: dict):
+        with self._progress_lock:
+            self._progress[file_id] = progress
+            state = self._progress_states.get(file_id)
+            self._progress_states[file_id] = progress['state']
+
+        if state is not None and state != progress['state']:
+            self._updates.put((ProcessorUpdate.FLUSH_PROGRESS, None))
+
+    def on_transfer_finish(self, file_id, progress: dict = None):
+        self._updates.put(
+            (ProcessorUpdate.TRANSFER_FINISHED, (file_id, progress)),
+        )
+
+    def publish(self, event: dict):
+        if self.channel is not None:
+            self.channel.send(event)
+
+    def _publish_metrics(self, force=False):
+        now = time.monotonic()
+        if self.channel is None or \
+                not force and now - self._last_metrics < self.metrics_interval:
+            return
+
+        self._last_metrics = now
+        self._count_state_time()
+        ACTIVE_TRANSFERS.set(len(self._transfers))
+        PENDING_FILES.set(len(self._files))
+
+        self.publish({
+            'type': 'metrics',
+            'processor_id': self.processor_id,
+            'metrics': REGISTRY.snapshot(),
+        })
+
+    def publish_file(self, file_model: File):
+        self.publish({'type': 'file', 'file': file_model.__json__(None)})
+
+    def _update_url(self, url_model: Url, status: UrlStatus, error_msg=None):
+        url_id = _url_id(url_model)
+        if not self.db.update_url(
+            url_model, self.processor_id, status, error_msg,
+        ):
+            self.log.info(f'url {url_id} is gone')
+            return
+
+        self.publish({
+            'type': 'url',
+            'queue_id': str(url_id),
+            'status': status.value,
+            'error_msg': error_msg,
+        })
+
+    def _mark_file_status(self, file_id, is_processing):
+        file_model = self.db.mark_file_status(file_id, is_processing)
+        self.publish_file(file_model)
 
     def stop(self):
-        listener = LogListener('logout')
-        self.api.logout(listener)
-        listener.wait()
+        for api in [self.index_api, self.api]:
+            listener = LogListener('logout')
+            api.logout(listener)
+            listener.wait()
 
         self.event.set()
+        self.wake()
 
     def _handle_listener_error(self, url_model, listener):
         if listener.error is not None:
             self.log.warning(f'got an error: {listener.error}')
 
-            self.db.update_url(
-                url_model, self.processor_id, UrlStatus.error,
-                str(listener.error),
+            self._update_url(
+                url_model, UrlStatus.error, str(listener.error),
             )
             return True
 
         return False
 
-    @set_processor_status(ProcessorStatus.INDEXING)
-    @suppress_errors
+    @traced
     def _process_url(self, url_model):
         self.log.info('processing url ...')
-        self.db.update_url(url_model, self.processor_id, UrlStatus.processing)
+        self._update_url(url_model, UrlStatus.processing)
 
-        processor = UrlProcessor(self.api)
-        results = processor.process(url_model.url)
-        for fname, node in results:
-            self._process_file_node(url_model, node, fname)
+        self._indexing[url_model.id] = url_model
+        run = self._index_runs[url_model.id] = IndexRun(url_model.id)
+        if url_model.sync:
+            self._syncs[url_model.id] = SyncReport()
 
-    def _process_file_node(self, url_model, node: mega.MegaNode, fname):
-        if url_model.category:
-            fname = os.path.join(url_model.category, fname)
-        fname = os.path.join(self.destination, fname)
+        if url_model.indexed and not url_model.sync:
+            self.log.info('resuming from the files left to download')
+            self._resuming.add(url_model.id)
+            target, args = self._resume_url, (run,)
+        else:
+            target = self._index_url
+            args = (run, url_model.url, url_model.sync)
 
-        file_model = self.db.create_file(url_model, node, fname)
-        wrapper = NodeWrapper(uuid.uuid4(), fname, node, file_model)
-        self._files.append(wrapper)
+        thread = threading.Thread(
+            target=target, args=args,
+            name=f'UrlIndexer-{url_model.id}',
+            daemon=True,
+        )
+        thread.start()
+
+    @traced
+    def _index_url(self, run: IndexRun, url, refresh=False):
+        """Walk `url` on an indexer thread, handing nodes over in batches.
+
+        The final hand-over has no nodes and carries the error, if any. A
+        walk that's cancelled stops without caching what it got so far.
+        """
+        error = None
+        started = time.monotonic()
+        try:
+            with self._index_lock:
+                processor = UrlProcessor(self.index_api, self.folder_cache)
+                batch = []
+                for fname, node in processor.process(url, refresh):
+                    if run.cancelled.is_set():
+                        return
+
+                    batch.append((fname, node))
+                    if len(batch) >= self.index_batch_size:
+                        self._hand_over(run, batch)
+                        batch = []
+
+            if batch:
+                self._hand_over(run, batch)
+        except Exception as e:
+            self.log.exception('failed to process url')
+            error = str(e) or repr(e)
+        finally:
+            INDEX_SECONDS.observe(time.monotonic() - started)
+            self._hand_over(run, None, error)
+
+    @traced
+    def _resume_url(self, run: IndexRun):
+        """Hand over the url's unfinished files, on an indexer thread.
+
+        Their nodes come from the rows, so nothing is logged in to or
+        walked; pages are only read as fast as the processor takes them.
+        """
+        error = None
+        try:
+            after = 0
+            while not self.event.is_set() and not run.cancelled.is_set():
+                page = self.db.get_pending_files(
+                    run.url_id, after, self.index_batch_size,
+                )
+                if not page:
+                    break
+
+                batch = []
+                for file_id, path, node in page:
+                    node = node and mega.MegaNode.unserialize(node)
+                    if not node:
+                        raise Exception(
+                            f'no usable node stored for {path}, '
+                            'sync the url to index it again',
+                        )
+                    batch.append((file_id, node))
+
+                self._hand_over(run, batch)
+                after = page[-1][0]
+        except Exception as e:
+            self.log.exception('failed to resume url')
+            error = str(e) or repr(e)
+        finally:
+            self.db.dispose()
+            self._hand_over(run, None, error)
+
+    def _hand_over(self, run: IndexRun, batch, error=None):
+        while not self.event.is_set() and not run.cancelled.is_set():
+            try:
+                self._indexed.put((run, batch, error), timeout=1)
+            except queue.Full:
+                continue
 
-    @set_processor_status(ProcessorStatus.DOWNLOADING)
-    @suppress_errors
-    def _download_file(self, wrapper: NodeWrapper):
-        if wrapper.file_model.is_finished:
-            self.log.info(f'finished with {wrapper.file_model.path}')
+            self._updates.put((ProcessorUpdate.INDEXED, None))
             return
 
-        self.db.mark_file_status(wrapper.file_model.id, True)
+    def _take_indexed(self):
+        took = False
+
+        # files held back, e.g. by a paused url, don't count: they'd stop
+        # the indexers of everything else
+        while self._files.count_startable() < self.max_pending_files:
+            try:
+                run, batch, error = self._indexed.get_nowait()
+            except queue.Empty:
+                break
 
-        file_listener = DbFileListener(wrapper.file_model.id, self)
-        downloader = FileNodeDownloader(self.api)
-        downloader.download(wrapper.path, wrapper.file_node, file_listener)
+            took = True
+            url_id = run.url_id
+            if self._index_runs.get(url_id) is not run:
+                # from a run that's been cancelled since
+                continue
 
-        file_listener.wait()
+            url_model = self._indexing[url_id]
 
-        self.db.mark_file_status(wrapper.file_model.id, False)
-        self.log.info('done downloading file')
+            try:
+                self._take_batch(url_model, batch, error)
+            except sqlalchemy.orm.exc.ObjectDeletedError:
+                # deleted by the web app; its cancel is on the way
+                self.db.session.rollback()
+                self.log.info(f'url {url_id} is gone')
+                self._forget_url(url_id)
+
+        return took
+
+    def _take_batch(self, url_model: Url, batch, error):
+        url_id = _url_id(url_model)
+        if batch is not None:
+            if url_id in self._resuming:
+                self._queue_pending_files(url_model, batch)
+            else:
+                self._process_file_nodes(url_model, batch)
+        elif error is not None:
+            self._fail_url(url_model, error)
+        else:
+            del self._indexing[url_id]
+            del self._index_runs[url_id]
+            report = self._syncs.pop(url_id, None)
+            if report is not None:
+                self._finish_sync(url_model, report)
+
+            if url_id in self._resuming:
+                self._resuming.discard(url_id)
+            else:
+                self.db.finish_indexing(url_model)
+
+            if not self._remaining.get(url_id):
+                self._finish_url(url_model)
+
+    def _process_file_nodes(self, url_model, batch):
+        paths = []
+        for fname, node in batch:
+            if url_model.category:
+                fname = os.path.join(url_model.category, fname)
+            paths.append((os.path.join(self.destination, fname), node))
+
+        url_id = _url_id(url_model)
+        report = self._syncs.get(url_id)
+        if report is None:
+            file_models = self.db.create_files(url_model, paths)
+            scheduled = [
+                (fname, node, file_model)
+                for (fname, node), file_model in zip(paths, file_models)
+            ]
+        else:
+            scheduled = self._sync_file_nodes(url_model, paths, report)
+
+        for fname, node, file_model in scheduled:
+            self.publish_file(file_model)
+            self._push_file(
+                NodeWrapper(uuid.uuid4(), fname, node, file_model, url_model),
+            )
+
+        self._remaining[url_id] = \
+            self._remaining.get(url_id, 0) + len(scheduled)
+
+    def _queue_pending_files(self, url_model, batch):
+        """Queue a batch of (file id, node) handed over by `_resume_url`."""
+        nodes = dict(batch)
+        file_models = self.db.get_files_by_id(nodes)
+        for file_model in file_models:
+            self._push_file(NodeWrapper(
+                uuid.uuid4(), file_model.path, nodes[file_model.id],
+                file_model, url_model,
+            ))
+
+        url_id = _url_id(url_model)
+        self._remaining[url_id] = \
+            self._remaining.get(url_id, 0) + len(file_models)
+
+    def _push_file(self, wrapper: NodeWrapper):
+        self._files.push(
+            wrapper, wrapper.file_model.total_bytes,
+            self._transfer_class(wrapper),
+        )
+
+    def _sync_file_nodes(self, url_model, paths, report: SyncReport):
+        """Diff a batch against the url's files and pick what to download.
+
+        Files that are unchanged and already finished are skipped.
+        """
+        scheduled = []
+        changes = self.db.sync_files(url_model, paths)
+        for (fname, node), (file_model, change) in zip(paths, changes):
+            report.add(file_model, change)
+            if change == FileChange.unchanged and file_model.is_finished:
+                continue
+
+            scheduled.append((fname, node, file_model))
+
+        return scheduled
+
+    def _finish_sync(self, url_model: Url, report: SyncReport):
+        report.removed = self.db.remove_missing_files(
+            url_model, report.file_handles,
+        )
+        self.db.finish_sync(
+            url_model,
+            added=report.counts[FileChange.added],
+            changed=report.counts[FileChange.changed],
+            removed=report.removed,
+            unchanged=report.counts[FileChange.unchanged],
+        )
+
+        self.log.info(f'synced {url_model.url}: {report}')
+        self.publish({
+            'type': 'url_synced',
+            'queue_id': str(url_model.id),
+            'last_sync': url_model.last_sync_json(),
+        })
+
+    @traced
+    def _download_file(self, wrapper: NodeWrapper):
+        file_id = wrapper.file_model.id
+
+        self._mark_file_status(file_id, True)
+        self._transfers[file_id] = wrapper
+        wrapper.started = time.monotonic()
+
+        file_listener = None
+        try:
+            if self.keep_partial_transfers:
+                file_listener = PartialFileListener(
+                    file_id, self, wrapper.path,
+                    wrapper.file_model.file_handle,
+                    wrapper.file_model.total_bytes,
+                )
+                downloader = ResumableDownloader(self.api)
+            else:
+                file_listener = DbFileListener(file_id, self)
+                downloader = FileNodeDownloader(self.api)
+
+            wrapper.listener = file_listener
+            downloader.download(wrapper.path, wrapper.file_node, file_listener)
+        except Exception:
+            self.log.exception(f'failed to start {wrapper.path}')
+            if isinstance(file_listener, PartialFileListener):
+                file_listener.close()
+            self.on_transfer_finish(file_id)
+
+
+def _url_id(url_model: Url) -> int:
+    """The id of a url, without loading its row, which may be deleted."""
+    url_id, = sqlalchemy.inspect(url_model).identity
+    return url_id
+
+
+@traced
+def _file_sizes(directory) -> typing.Dict[str, int]:
+    """Size of every file in `directory`, from a single listing."""
+    sizes = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        sizes[entry.name] = entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return sizes
+
+
+@traced
+def _remove_partial_transfers(directory, before) -> int:
+    """Delete SDK temp files in `directory` last modified before `before`."""
+    removed = 0
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith('.getxfer.') or \
+                        not entry.name.endswith('.mega'):
+                    continue
+
+                try:
+                    if entry.stat().st_mtime < before:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    continue
+    except FileNotFoundError:
+        pass
+
+    return removed
 
 
 SECONDS_IN_MINUTE = 60
@@ -300,19 +1318,43 @@ class FileListener(mega.MegaTransferListener):
         self.transfer_info = None
         self.event = threading.Event()
 
+        # the SDK's tag for the transfer, which it hands over on start; a
+        # pause or cancel asked for before then is applied at that point
+        self.tag = None
+        self.paused = False
+        self.cancelled = False
+
         super().__init__()
 
+    def pause(self, api: mega.MegaApi, paused=True):
+        self.paused = paused
+        if self.tag is not None:
+            api.pauseTransferByTag(self.tag, paused)
+
+    def cancel(self, api: mega.MegaApi):
+        self.cancelled = True
+        if self.tag is not None:
+            api.cancelTransferByTag(self.tag)
+
     def _update(self, transfer: typing.Optional[mega.MegaTransfer]):
         self.transfer_info = transfer
 
     @suppress_errors
+    @traced
     def onTransferStart(
         self, api: mega.MegaApi,
         transfer: mega.MegaTransfer,
     ):
         self.transfer_info = transfer
+        self.tag = transfer.getTag()
+
+        if self.cancelled:
+            api.cancelTransferByTag(self.tag)
+        elif self.paused:
+            api.pauseTransferByTag(self.tag, True)
 
     @suppress_errors
+    @traced
     def onTransferFinish(
         self, api: mega.MegaApi,
         transfer: mega.MegaTransfer, error: mega.MegaError,
@@ -321,6 +1363,7 @@ class FileListener(mega.MegaTransferListener):
         self.event.set()
 
     @suppress_errors
+    @traced
     def onTransferUpdate(self, api: mega.MegaApi, transfer: mega.MegaTransfer):
         self._update(transfer)
 
@@ -332,16 +1375,209 @@ class FileListener(mega.MegaTransferListener):
         pass
 
     @suppress_errors
+    @traced
     def onTransferData(
         self, api: mega.MegaApi, transfer: mega.MegaTransfer,
         buffer: str, size: int,
     ) -> bool:
         return True
 
-    def wait(self, timeout):
+    def wait(self, timeout=None):
         return self.event.wait(timeout)
 
 
+def transfer_progress(transfer: mega.MegaTransfer) -> dict:
+    """Copy what we store about a transfer out of the SDK object.
+
+    The MegaTransfer handed to listener callbacks is only valid for the
+    duration of the callback.
+    """
+    return {
+        'start_time': transfer.getStartTime(),
+        'transferred_bytes': transfer.getTransferredBytes(),
+        'num_retry': transfer.getNumRetry(),
+        'max_retries': transfer.getMaxRetries(),
+        'mean_speed': transfer.getMeanSpeed(),
+        'is_finished': transfer.isFinished(),
+        'state': transfer.getState(),
+    }
+
+
+class DbFileListener(FileListener):
+    def __init__(self, file_id, processor: DownloadProcessor):
+        super().__init__()
+
+        self.file_id = file_id
+        self.processor = processor
+        self._counted_bytes = 0
+
+    def _progress(self, transfer: mega.MegaTransfer) -> dict:
+        progress = transfer_progress(transfer)
+
+        # what the SDK received in this transfer, so not a resumed offset
+        received = progress['transferred_bytes'] - self._counted_bytes
+        if received > 0:
+            DOWNLOADED_BYTES.inc(received)
+            self._counted_bytes += received
+
+        return progress
+
+    def _update(self, transfer: typing.Optional[mega.MegaTransfer]):
+        super()._update(transfer)
+
+        self.processor.on_transfer_progress(
+            self.file_id, self._progress(transfer),
+        )
+
+    @suppress_errors
+    @traced
+    def onTransferFinish(
+        self, api: mega.MegaApi,
+        transfer: mega.MegaTransfer, error: mega.MegaError,
+    ):
+        progress = None
+        try:
+            failed = error and error.getValue() != error.API_OK
+            if failed:
+                self.processor.log.warning(
+                    f'transfer of file {self.file_id} failed: {error}',
+                )
+            self.transfer_info = transfer
+            progress = self._progress(transfer)
+            if failed:
+                # isFinished() is also true of failed and cancelled ones
+                progress['is_finished'] = False
+        finally:
+            self.event.set()
+            self.processor.on_transfer_finish(self.file_id, progress)
+
+
+PARTIAL_SUFFIX = '.part'
+PARTIAL_INFO_SUFFIX = '.part.info'
+
+
+class PartialFileListener(DbFileListener):
+    """Streams a file into `<path>.part` and moves it into place when done.
+
+    Data is appended after whatever an earlier run left in the partial
+    file, so a restart only costs the bytes still missing. The handle and
+    size of the node it holds are kept in `<path>.part.info`, so a file
+    that has changed since, e.g. through a sync, starts over instead.
+    """
+
+    def __init__(
+        self, file_id, processor: DownloadProcessor, path, file_handle,
+        total_bytes,
+    ):
+        super().__init__(file_id, processor)
+
+        self.path = path
+        self.part_path = path + PARTIAL_SUFFIX
+        self.info_path = path + PARTIAL_INFO_SUFFIX
+        self.file_handle = file_handle
+        self.total_bytes = total_bytes
+        self.offset = 0
+        self._file = None
+
+    def open(self) -> int:
+        """Open the partial file and return how much of it is there."""
+        info = f'{self.file_handle}:{self.total_bytes}'
+        try:
+            with open(self.info_path) as f:
+                same_node = f.read() == info
+        except FileNotFoundError:
+            same_node = False
+
+        self._file = open(self.part_path, 'ab')
+        self.offset = self._file.tell()
+        if not same_node or self.offset > self.total_bytes:
+            self._file.truncate(0)
+            self.offset = 0
+
+            with open(self.info_path, 'w') as f:
+                f.write(info)
+
+        return self.offset
+
+    def close(self):
+        """Close the partial file, e.g. when the transfer didn't start."""
+        if self._file is not None:
+            self._file.close()
+
+    def _progress(self, transfer: mega.MegaTransfer) -> dict:
+        progress = super()._progress(transfer)
+        progress['transferred_bytes'] += self.offset
+        return progress
+
+    def _update(self, transfer: typing.Optional[mega.MegaTransfer]):
+        self.transfer_info = transfer
+        self.processor.on_transfer_progress(
+            self.file_id, self._progress(transfer),
+        )
+
+    @traced
+    def onTransferData(
+        self, api: mega.MegaApi, transfer: mega.MegaTransfer,
+        buffer, size: int,
+    ) -> bool:
+        if isinstance(buffer, str):
+            # SWIG hands char buffers over as surrogate-escaped str
+            buffer = buffer.encode('utf-8', 'surrogateescape')
+
+        if len(buffer) != size:
+            self.processor.log.error(
+                f'got {len(buffer)} bytes instead of {size} for '
+                f'{self.part_path}',
+            )
+            return False
+
+        try:
+            self._file.write(buffer)
+        except Exception:
+            self.processor.log.exception(f'failed to write {self.part_path}')
+            return False
+
+        return True
+
+    @suppress_errors
+    @traced
+    def onTransferFinish(
+        self, api: mega.MegaApi,
+        transfer: mega.MegaTransfer, error: mega.MegaError,
+    ):
+        progress = {}
+        try:
+            if error and error.getValue() != error.API_OK:
+                self.processor.log.warning(
+                    f'transfer of file {self.file_id} failed: {error}',
+                )
+            self.transfer_info = transfer
+            progress = self._progress(transfer)
+        finally:
+            self.complete(progress)
+
+    def complete(self, progress: dict = None):
+        """Close the partial file and move it into place if it's whole."""
+        progress = dict(progress or {})
+        try:
+            self.close()
+
+            transferred_bytes = os.path.getsize(self.part_path)
+            is_finished = transferred_bytes == self.total_bytes
+            if is_finished:
+                os.replace(self.part_path, self.path)
+                try:
+                    os.unlink(self.info_path)
+                except FileNotFoundError:
+                    pass
+
+            progress['transferred_bytes'] = transferred_bytes
+            progress['is_finished'] = is_finished
+        finally:
+            self.event.set()
+            self.processor.on_transfer_finish(self.file_id, progress)
+
+
 class LogListener(mega.MegaRequestListener):
     def __init__(self, prefix):
         super().__init__()
@@ -353,6 +1589,7 @@ class LogListener(mega.MegaRequestListener):
     def onRequestStart(self, api: mega.MegaApi, request: mega.MegaRequest):
         print(f'{self.prefix} onRequestStart: {request}')
 
+    @traced
     def onRequestFinish(
         self, api: mega.MegaApi, request: mega.MegaRequest, e: mega.MegaError,
     ):
@@ -379,6 +1616,7 @@ class PublicFolderListener(LogListener):
     public_node = None
 
     @suppress_errors
+    @traced
     def onRequestFinish(
         self, api: mega.MegaApi, request: mega.MegaRequest, e: mega.MegaError,
     ):
@@ -389,27 +1627,25 @@ class PublicFolderListener(LogListener):
 
 
 class UrlProcessor:
-    def __init__(self, api: mega.MegaApi):
+    def __init__(self, api: mega.MegaApi, cache: FolderCache = None):
         self.api = api
-
-    def _is_file(self, url: str):
-        index = url.index('#')
-        if index == -1:
-            return False
-
-        return url[index + 1] != 'F'
+        self.cache = cache
 
     def _handle_listener_error(self, url, listener):
         if listener.error is not None:
             raise Exception(url, str(listener.error))
 
-    def process(self, url) -> list:
+    def process(self, url, refresh=False) -> list:
+        """Yield (fname, node) for every file behind `url`.
+
+        With `refresh`, a folder is fetched again even if it is cached.
+        """
         directories = tuple()
 
-        if self._is_file(url):
+        if is_file_url(url):
             yield self._process_file(url, directories)
         else:
-            yield from self._process_folder(url)
+            yield from self._process_folder(url, refresh)
 
     def _process_file(self, url, directories):
         listener = PublicFolderListener(
@@ -428,7 +1664,14 @@ class UrlProcessor:
         )
         return fname, node
 
-    def _process_folder(self, url):
+    def _process_folder(self, url, refresh=False):
+        handle = folder_handle(url) if self.cache else None
+        if handle and not refresh:
+            entries = self.cache.get(handle)
+            if entries is not None:
+                yield from self._process_cached(entries)
+                return
+
         listener = LogListener(f'loginToFolder("{url}")')
         self.api.loginToFolder(url, listener)
         listener.wait()
@@ -441,7 +1684,29 @@ class UrlProcessor:
 
         dir_node = self.api.getRootNode()
 
-        yield from self._process_folder_node(dir_node, [])
+        entries = []
+        for fname, node in self._process_folder_node(dir_node, []):
+            # an authorized node can be downloaded without the folder login
+            node = self.api.authorizeNode(node)
+            if handle:
+                entries.append(self._cache_entry(fname, node))
+            yield fname, node
+
+        if handle:
+            self.cache.put(handle, entries)
+
+    def _cache_entry(self, fname, node: mega.MegaNode):
+        return {
+            'path': fname,
+            'name': node.getName(),
+            'size': node.getSize(),
+            'handle': node.getBase64Handle(),
+            'node': node.serialize(),
+        }
+
+    def _process_cached(self, entries):
+        for entry in entries:
+            yield entry['path'], mega.MegaNode.unserialize(entry['node'])
 
     def _process_folder_node(self, dir_node, directories):
         directories = [*directories, dir_node.getName()]
@@ -463,6 +1728,7 @@ class UrlProcessor:
 class FileNodeDownloader:
     def __init__(self, api):
         self.api = api
+        self.log = logging.getLogger('processor')
 
     def download(self, fname, file_node, listener: mega.MegaTransferListener):
         os.makedirs(
@@ -470,6 +1736,35 @@ class FileNodeDownloader:
             exist_ok=True,
         )
 
-        print(f'downloading {fname}')
+        self.log.info(f'downloading {fname}')
         self.api.startDownload(file_node, localPath=fname, listener=listener)
-        print(f'\tdone')
+
+
+class ResumableDownloader(FileNodeDownloader):
+    """Downloads through the SDK's streaming API into partial files.
+
+    Unlike startDownload, which keeps its progress in temp files only the
+    SDK understands, this can continue from the bytes already on disk.
+    """
+
+    def download(self, fname, file_node, listener: PartialFileListener):
+        os.makedirs(
+            os.path.dirname(fname),
+            exist_ok=True,
+        )
+
+        offset = listener.open()
+        remaining = file_node.getSize() - offset
+        if remaining <= 0:
+            listener.complete()
+            return
+
+        if offset:
+            self.log.info(f'resuming {fname} at {offset} bytes')
+        else:
+            self.log.info(f'downloading {fname}')
+        self.api.startStreaming(file_node, offset, remaining, listener)
+
+
+if __name__ == '__main__':
+    cli()
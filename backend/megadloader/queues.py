@@ -0,0 +1,230 @@
+import enum
+import heapq
+import itertools
+import math
+import typing
+
+
+class TransferOrder(enum.Enum):
+    fifo = 'fifo'
+    smallest = 'smallest'
+    largest = 'largest'
+
+
+ORDER_KEYS = {
+    TransferOrder.fifo: lambda size, seq: (seq,),
+    TransferOrder.smallest: lambda size, seq: (size, seq),
+    TransferOrder.largest: lambda size, seq: (-size, seq),
+}
+
+OrderKey = typing.Callable[[int, int], typing.Any]
+
+
+class PendingQueue:
+    """Pending transfers, popped in the order given by `order`.
+
+    `order` is either a TransferOrder or a callable taking (size, seq) and
+    returning a sort key. Files smaller than `fast_lane_threshold` bytes are
+    also tracked separately so the scheduler can pull them out of turn with
+    `pop(fast_lane=True)`.
+    """
+
+    def __init__(
+        self,
+        order: typing.Union[TransferOrder, OrderKey] = TransferOrder.fifo,
+        fast_lane_threshold: int = 0,
+    ):
+        if isinstance(order, TransferOrder):
+            order = ORDER_KEYS[order]
+
+        self.key = order
+        self.fast_lane_threshold = fast_lane_threshold
+
+        self._counter = itertools.count()
+        self._heap = []
+        self._small = []
+        self._size = 0
+
+    @property
+    def has_fast_lane(self):
+        return self.fast_lane_threshold > 0
+
+    def push(self, item, size: int, seq: int = None):
+        if seq is None:
+            seq = next(self._counter)
+        entry = [self.key(size, seq), seq, item, True, size]
+
+        heapq.heappush(self._heap, entry)
+        if self.is_small(size):
+            heapq.heappush(self._small, entry)
+
+        self._size += 1
+
+    def is_small(self, size: int):
+        return self.has_fast_lane and size < self.fast_lane_threshold
+
+    def pop(self, fast_lane=False):
+        heap = self._small if fast_lane else self._heap
+
+        while heap:
+            entry = heapq.heappop(heap)
+            if entry[3]:
+                entry[3] = False
+                self._size -= 1
+                return entry[2]
+
+        raise IndexError('pop from an empty queue')
+
+    def has_small(self):
+        while self._small and not self._small[0][3]:
+            heapq.heappop(self._small)
+
+        return bool(self._small)
+
+    def remove(self, predicate: typing.Callable[[typing.Any], bool]):
+        for entry in self._heap:
+            if entry[3] and predicate(entry[2]):
+                entry[3] = False
+                self._size -= 1
+
+    def entries(self) -> typing.Iterator[typing.Tuple[int, typing.Any, int]]:
+        """(seq, item, size) of every pending item, in no particular order."""
+        return ((e[1], e[2], e[4]) for e in self._heap if e[3])
+
+    def __iter__(self):
+        entries = sorted(e for e in self._heap if e[3])
+        return (e[2] for e in entries)
+
+    def __len__(self):
+        return self._size
+
+
+class ClassLimit:
+    """Scheduling limits for one class of transfers.
+
+    `share` is the percentage of the transfer slots the class gets while
+    other classes want them too; classes without one split what is left.
+    A class with `max_transfers` active transfers gets no more slots.
+    """
+
+    def __init__(self, share: int = None, max_transfers: int = None):
+        self.share = share
+        self.max_transfers = max_transfers
+
+
+DEFAULT_LIMIT = ClassLimit()
+
+Active = typing.Mapping[typing.Hashable, int]
+Classify = typing.Callable[[typing.Any], typing.Hashable]
+
+
+class FairQueue:
+    """Pending transfers grouped in classes, each one a PendingQueue.
+
+    `pop` serves the class that is furthest below its share of the active
+    transfers, as counted in `active`, and skips classes that are at their
+    `max_transfers`; it returns None when no class may start a transfer.
+    """
+
+    def __init__(
+        self,
+        order: typing.Union[TransferOrder, OrderKey] = TransferOrder.fifo,
+        fast_lane_threshold: int = 0,
+    ):
+        self.order = order
+        self.fast_lane_threshold = fast_lane_threshold
+        self.limits: typing.Dict[typing.Hashable, ClassLimit] = {}
+
+        self._counter = itertools.count()
+        self._queues: typing.Dict[typing.Hashable, PendingQueue] = {}
+
+    @property
+    def has_fast_lane(self):
+        return self.fast_lane_threshold > 0
+
+    def push(self, item, size: int, cls: typing.Hashable = None, seq=None):
+        pending = self._queues.get(cls)
+        if pending is None:
+            pending = self._queues[cls] = PendingQueue(
+                self.order, self.fast_lane_threshold,
+            )
+
+        if seq is None:
+            seq = next(self._counter)
+        pending.push(item, size, seq)
+
+    def regroup(self, classify: Classify):
+        """Move every pending item to the class `classify` now gives it."""
+        queues, self._queues = self._queues, {}
+        for pending in queues.values():
+            for seq, item, size in sorted(pending.entries()):
+                self.push(item, size, classify(item), seq)
+
+    def pop(self, fast_lane=False, active: Active = None):
+        active = active or {}
+        candidates = [
+            cls
+            for cls, pending in self._queues.items()
+            if self._has_room(cls, active)
+            if (pending.has_small() if fast_lane else pending)
+        ]
+        if not candidates:
+            return None
+
+        weights = self._weights({
+            *candidates, *(cls for cls, count in active.items() if count),
+        })
+
+        def usage(cls):
+            if not weights[cls]:
+                return math.inf
+            return active.get(cls, 0) / weights[cls]
+
+        return self._queues[min(candidates, key=usage)].pop(fast_lane)
+
+    def has_small(self, active: Active = None):
+        active = active or {}
+        return any(
+            pending.has_small() and self._has_room(cls, active)
+            for cls, pending in self._queues.items()
+        )
+
+    def _has_room(self, cls, active: Active):
+        max_transfers = self.limits.get(cls, DEFAULT_LIMIT).max_transfers
+        return max_transfers is None or active.get(cls, 0) < max_transfers
+
+    def _weights(self, classes) -> typing.Dict[typing.Hashable, float]:
+        shares = {
+            cls: self.limits.get(cls, DEFAULT_LIMIT).share for cls in classes
+        }
+        claimed = sum(share for share in shares.values() if share is not None)
+        unset = sum(1 for share in shares.values() if share is None)
+        rest = max(0, 100 - claimed) / unset if unset else 0
+
+        return {
+            cls: rest if share is None else share
+            for cls, share in shares.items()
+        }
+
+    def remove(self, predicate: typing.Callable[[typing.Any], bool]):
+        for pending in self._queues.values():
+            pending.remove(predicate)
+
+    def count_startable(self) -> int:
+        """The number of items outside classes held at max_transfers=0."""
+        return sum(
+            len(pending)
+            for cls, pending in self._queues.items()
+            if self.limits.get(cls, DEFAULT_LIMIT).max_transfers != 0
+        )
+
+    def __iter__(self):
+        entries = sorted(
+            (seq, item)
+            for pending in self._queues.values()
+            for seq, item, size in pending.entries()
+        )
+        return (item for seq, item in entries)
+
+    def __len__(self):
+        return sum(len(pending) for pending in self._queues.values())
@@ -0,0 +1,124 @@
+"""Opt-in timing spans and on-demand profiles of a running processor.
+
+Spans are written one JSON object per line to a rotating file, in the
+Chrome trace event format: `jq -s . <file>` turns a trace into something
+chrome://tracing or ui.perfetto.dev can open. While tracing is off, a
+traced function only costs a flag check.
+"""
+import cProfile
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self._log = logging.getLogger('megadloader.trace')
+        self._log.propagate = False
+        self._log.setLevel(logging.INFO)
+        self._pid = os.getpid()
+
+    def configure(self, path, max_bytes, backup_count, enabled=False):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, delay=True,
+        )
+        self._log.handlers = [handler]
+        # fileConfig() disables loggers that existed before it ran
+        self._log.disabled = False
+        self._pid = os.getpid()
+        self.enabled = enabled
+
+    def toggle(self):
+        # may run in a signal handler, so nothing that takes a lock
+        self.enabled = bool(self._log.handlers) and not self.enabled
+
+    def record(self, name, started, duration):
+        self._log.info(json.dumps({
+            'name': name,
+            'ph': 'X',
+            'ts': int(started * 1e6),
+            'dur': int(duration * 1e6),
+            'pid': self._pid,
+            'tid': threading.get_ident(),
+        }))
+
+
+TRACER = Tracer()
+
+
+def traced(func):
+    """Record a span for every call of `func` while tracing is on."""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not TRACER.enabled:
+            return func(*args, **kwargs)
+
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            TRACER.record(name, started, time.time() - started)
+
+    return wrapper
+
+
+def trace_methods(cls):
+    """Class decorator applying `traced` to every public method."""
+    for name, value in list(vars(cls).items()):
+        if not name.startswith('_') and inspect.isfunction(value):
+            setattr(cls, name, traced(value))
+
+    return cls
+
+
+class Profiler:
+    """cProfile snapshots of the thread that polls it, on request.
+
+    `start` is safe to call from a signal handler; the thread that calls
+    `poll` stops the profile once `seconds` have passed and dumps it to a
+    .prof file in `directory` (see `python -m pstats`).
+    """
+
+    def __init__(self, directory, prefix, seconds=30):
+        self.log = logging.getLogger('profiler')
+        self.directory = directory
+        self.prefix = prefix
+        self.seconds = seconds
+        self._profile = None
+        self._until = None
+
+    def start(self):
+        if self._profile is not None:
+            return
+
+        self._until = time.monotonic() + self.seconds
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def remaining(self):
+        if self._profile is None:
+            return None
+
+        return max(0, self._until - time.monotonic())
+
+    def poll(self):
+        if self._profile is None or time.monotonic() < self._until:
+            return
+
+        profile, self._profile = self._profile, None
+        profile.disable()
+
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.directory, f'{self.prefix}-{stamp}.prof')
+        profile.dump_stats(path)
+        self.log.info(f'wrote profile to {path}')
@@ -1,6 +1,7 @@
 import atexit
 import enum
 import logging
+import os
 import pyramid.config
 import pyramid.events
 import pyramid.httpexceptions
@@ -9,11 +10,17 @@ import pyramid.response
 import pyramid.static
 import subprocess
 import sys
+import typing
 import uuid
 
-from megadloader import decode_url
+from megadloader import decode_url, extract_urls
+from megadloader.cache import folder_cache_from_settings, folder_handle
+from megadloader.channel import ChannelServer
 from megadloader.db import configure_db, Db
-from megadloader.processor import DownloadProcessor
+from megadloader.events import EventBus, stream_events
+from megadloader.metrics import REGISTRY, RemoteMetrics, render
+from megadloader.models import LimitScope, UrlMove, UrlStatus
+from megadloader.processor import TransferControl
 
 
 def main(global_config, **settings):
@@ -31,37 +38,83 @@ def main(global_config, **settings):
 
 
 PROCESSOR_KEY = '--processor-key--'
+CHANNEL_KEY = '--channel-key--'
+EVENTS_KEY = '--events-key--'
+EVENTS_RETRY_AFTER = 10
+METRICS_KEY = '--metrics-key--'
+
+URLS = REGISTRY.gauge(
+    'megadloader_urls',
+    'Queued urls by status.',
+    ['status'],
+)
 
 
 def _processor(config: pyramid.config.Configurator):
     from megadloader import processor
-    processor_id = str(uuid.uuid4())
 
-    config_name = config.registry.settings['__file__']
+    settings = config.registry.settings
+    config_name = settings['__file__']
+    workers = max(1, int(settings.get('processor_workers', 1)))
+
+    events = EventBus(
+        max_subscriptions=int(settings.get('max_event_streams', 8)),
+    )
+    metrics = RemoteMetrics()
+
+    def on_message(message: dict):
+        if message['type'] == 'metrics':
+            metrics.update(message['processor_id'], message['metrics'])
+        elif message['type'] == 'rerun':
+            # for the processor that has the url
+            channel.broadcast(message)
+        else:
+            events.publish(message)
+
+    channel = ChannelServer(on_message)
+
+    # none of the urls left processing have a processor anymore
+    db = Db()
+    db.release_urls()
+    db.dispose()
 
-    process = subprocess.Popen(
-        args=[
+    processor_ids = [str(uuid.uuid4()) for _ in range(workers)]
+    processes = []
+    for index, processor_id in enumerate(processor_ids):
+        args = [
             sys.executable,
             processor.__file__,
             '--processor-id', processor_id,
             '--config', config_name,
             '--app-name', 'main',
-        ],
-    )
-
-    config.registry[PROCESSOR_KEY] = process
+            '--channel', channel.address,
+        ]
+        if index > 0:
+            # the first worker looks after the files for all of them
+            args.append('--no-check-files')
+
+        processes.append(subprocess.Popen(
+            args=args,
+            env={**os.environ, **channel.env},
+        ))
+
+    config.registry[PROCESSOR_KEY] = processes
+    config.registry[CHANNEL_KEY] = channel
+    config.registry[EVENTS_KEY] = events
+    config.registry[METRICS_KEY] = metrics
 
     config.add_request_method(
-        name='processor_id',
-        callable=lambda r: processor_id,
+        name='processor_ids',
+        callable=lambda r: frozenset(processor_ids),
         reify=True,
     )
 
-    atexit.register(_kill_processor, process)
+    atexit.register(_kill_processors, processes)
 
 
-def _kill_processor(process: subprocess.Popen):
-    process.kill()
+def _kill_processors(processes: typing.List[subprocess.Popen]):
+    for process in processes:
+        process.kill()
 
 
 def _cors(config: pyramid.config.Configurator):
@@ -113,6 +166,28 @@ def _api(config: pyramid.config.Configurator):
         view=handle_status, renderer='json',
     )
 
+    config.add_route('metrics', '/metrics')
+    config.add_view(
+        request_method='GET', route_name='metrics',
+        view=handle_metrics,
+    )
+
+    config.add_route('api: events', '/api/events')
+    config.add_view(
+        request_method='GET', route_name='api: events',
+        view=handle_events,
+    )
+
+    config.add_route('api: limits', '/api/limits')
+    config.add_view(
+        request_method='GET', route_name='api: limits',
+        view=handle_get_limits, renderer='json',
+    )
+    config.add_view(
+        request_method='PUT', route_name='api: limits',
+        view=handle_set_limits, renderer='json',
+    )
+
     config.add_route('api: categories', '/api/categories/')
     config.add_view(
         request_method='GET', route_name='api: categories',
@@ -133,12 +208,60 @@ def _api(config: pyramid.config.Configurator):
         view=handle_add_url, renderer='json',
     )
 
+    config.add_route('api: urls import', '/api/urls/import')
+    config.add_view(
+        request_method='POST', route_name='api: urls import',
+        view=handle_import_urls, renderer='json',
+    )
+
     config.add_route('api: queue items', '/api/queue/{queue_id}')
     config.add_view(
         request_method='DELETE', route_name='api: queue items',
         view=handle_delete_url, renderer='json',
     )
 
+    config.add_route('api: queue cache', '/api/queue/{queue_id}/cache')
+    config.add_view(
+        request_method='DELETE', route_name='api: queue cache',
+        view=handle_invalidate_cache, renderer='json',
+    )
+
+    config.add_route('api: queue sync', '/api/queue/{queue_id}/sync')
+    config.add_view(
+        request_method='POST', route_name='api: queue sync',
+        view=handle_sync_url, renderer='json',
+    )
+
+    config.add_route('api: queue pause', '/api/queue/{queue_id}/pause')
+    config.add_view(
+        request_method='POST', route_name='api: queue pause',
+        view=handle_pause_url, renderer='json',
+    )
+
+    config.add_route('api: queue resume', '/api/queue/{queue_id}/resume')
+    config.add_view(
+        request_method='POST', route_name='api: queue resume',
+        view=handle_resume_url, renderer='json',
+    )
+
+    config.add_route('api: queue cancel', '/api/queue/{queue_id}/cancel')
+    config.add_view(
+        request_method='POST', route_name='api: queue cancel',
+        view=handle_cancel_url, renderer='json',
+    )
+
+    config.add_route('api: queue move', '/api/queue/{queue_id}/move')
+    config.add_view(
+        request_method='POST', route_name='api: queue move',
+        view=handle_move_url, renderer='json',
+    )
+
+    config.add_route('api: queue files', '/api/queue/{queue_id}/files')
+    config.add_view(
+        request_method='GET', route_name='api: queue files',
+        view=handle_list_url_files, renderer='json',
+    )
+
     config.add_route('api: files', '/api/files/')
     config.add_view(
         request_method='GET', route_name='api: files',
@@ -151,6 +274,24 @@ def _api(config: pyramid.config.Configurator):
         view=handle_get_file, renderer='json',
     )
 
+    config.add_route('api: file pause', '/api/files/{file_id}/pause')
+    config.add_view(
+        request_method='POST', route_name='api: file pause',
+        view=handle_pause_file, renderer='json',
+    )
+
+    config.add_route('api: file resume', '/api/files/{file_id}/resume')
+    config.add_view(
+        request_method='POST', route_name='api: file resume',
+        view=handle_resume_file, renderer='json',
+    )
+
+    config.add_route('api: file cancel', '/api/files/{file_id}/cancel')
+    config.add_view(
+        request_method='POST', route_name='api: file cancel',
+        view=handle_cancel_file, renderer='json',
+    )
+
 
 def _db(config: pyramid.config.Configurator):
     configure_db(config.registry.settings)
@@ -184,7 +325,83 @@ def _static(config: pyramid.config.Configurator):
 
 def handle_status(request):
     db: Db = request.db
-    return {'urls': [url for url in db.get_urls()]}
+
+    # read the cursor first: anything written while we query is sent again
+    # next time rather than missed
+    cursor = db.get_version()
+    etag = str(cursor)
+
+    if etag in request.if_none_match:
+        response = pyramid.httpexceptions.HTTPNotModified()
+        response.etag = etag
+        return response
+
+    request.response.etag = etag
+
+    since = request.GET.get('since')
+    if since is None:
+        return {'cursor': cursor, 'urls': db.get_urls(summary=True)}
+
+    try:
+        since = int(since)
+    except ValueError:
+        request.response.status_code = 400
+        return {'code': 'invalid_cursor'}
+
+    return {
+        'cursor': cursor,
+        'queue_ids': [str(url_id) for url_id in db.get_url_ids()],
+        'urls': db.get_urls(since, summary=True),
+        'files': db.get_files(since=since),
+    }
+
+
+def handle_metrics(request):
+    db: Db = request.db
+
+    for status, count in db.count_urls().items():
+        URLS.set(count, status=status)
+
+    metrics: RemoteMetrics = request.registry[METRICS_KEY]
+    processors = metrics.snapshot('processor', request.processor_ids)
+
+    response = request.response
+    response.content_type = 'text/plain'
+    response.content_type_params = {'version': '0.0.4', 'charset': 'utf-8'}
+    response.text = render([*REGISTRY.snapshot(), *processors])
+    return response
+
+
+def handle_events(request):
+    events: EventBus = request.registry[EVENTS_KEY]
+    subscription = events.subscribe()
+    if subscription is None:
+        # every stream ties up a server thread; the client retries later
+        response = pyramid.httpexceptions.HTTPServiceUnavailable()
+        response.retry_after = EVENTS_RETRY_AFTER
+        return response
+
+    response = request.response
+    response.content_type = 'text/event-stream'
+    response.cache_control = 'no-cache'
+    response.app_iter = stream_events(events, subscription)
+    return response
+
+
+def _publish(request, event: dict):
+    events: EventBus = request.registry[EVENTS_KEY]
+    events.publish(event)
+
+
+def _wake_processors(request):
+    channel: ChannelServer = request.registry[CHANNEL_KEY]
+    channel.broadcast({'type': 'wake'})
+
+
+def _control_processors(request, action: TransferControl, **target):
+    """Tell whichever processor has the url or file to act on it."""
+    channel: ChannelServer = request.registry[CHANNEL_KEY]
+    channel.broadcast({'type': 'control', 'action': action.value, **target})
 
 
 def handle_add_url(request):
@@ -199,10 +416,56 @@ def handle_add_url(request):
         return {'code': 'invalid_mega_url'}
 
     url = db.add_url(mega_url, category)
+    if request.POST.get('sync') and url.status != UrlStatus.processing.value:
+        # re-queued: fetch the tree again and download only what changed
+        db.request_sync(url)
+
+    _publish(request, {'type': 'url_added', 'url': url.summary_json(request)})
+    _wake_processors(request)
+
     request.response.status_code = 201
     return url
 
 
+def handle_import_urls(request):
+    db: Db = request.db
+    category = request.POST.get('category')
+
+    text = request.POST.get('text', '')
+    upload = request.POST.get('file')
+    if upload is not None and hasattr(upload, 'file'):
+        text = upload.file.read().decode('utf-8', 'replace')
+
+    entries = extract_urls(text)
+    if not entries:
+        request.response.status_code = 400
+        return {'code': 'no_mega_urls'}
+
+    urls = db.add_urls([url for _, url in entries if url], category)
+    urls = iter(urls)
+
+    results = []
+    for line, mega_url in entries:
+        if not mega_url:
+            results.append({'line': line, 'result': 'invalid'})
+            continue
+
+        url, created = next(urls)
+        results.append({
+            'line': line,
+            'result': 'added' if created else 'exists',
+            'url': url.summary_json(request),
+        })
+
+        if created:
+            _publish(request, {'type': 'url_added', 'url': results[-1]['url']})
+
+    if any(result['result'] == 'added' for result in results):
+        _wake_processors(request)
+
+    return {'results': results}
+
+
 def handle_get_urls(request):
     db: Db = request.db
 
@@ -219,6 +482,31 @@ def handle_list_files(request):
     return files
 
 
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def handle_list_url_files(request):
+    db: Db = request.db
+
+    url_id = request.matchdict['queue_id']
+    try:
+        offset = max(0, int(request.GET.get('offset', 0)))
+        limit = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        request.response.status_code = 400
+        return {'code': 'invalid_page'}
+
+    limit = min(max(1, limit), MAX_PAGE_SIZE)
+
+    return {
+        'offset': offset,
+        'limit': limit,
+        'total': db.count_files(url_id),
+        'files': db.get_files(url_id, offset=offset, limit=limit),
+    }
+
+
 def handle_get_file(request):
     db: Db = request.db
     file_id = request.matchdict['file_id']
@@ -230,9 +518,15 @@ def handle_get_file(request):
     return file_model
 
 
+def _publish_url(request, url_model):
+    _publish(request, {
+        'type': 'url_updated',
+        'url': url_model.summary_json(request),
+    })
+
+
 def handle_delete_url(request):
     db: Db = request.db
-    processor: DownloadProcessor = request.processor
 
     url_id = request.matchdict['queue_id']
     url_model = db.get_url(url_id)
@@ -240,14 +534,259 @@ def handle_delete_url(request):
         request.response.status_code = 404
         return {'code': 'url_not_found'}
 
-    if processor.current_url == url_model:
-        request.response.status_code = 400
-        return {'code': 'cannot_stop_current_url'}
+    status = url_model.get_status(request.processor_ids)
+    if status == UrlStatus.processing.value:
+        # its processor stops the transfers and forgets about it
+        _control_processors(
+            request, TransferControl.cancel, url_id=url_model.id,
+        )
 
     db.delete_url(url_model)
+    _publish(request, {'type': 'url_removed', 'queue_id': url_id})
+    return {'code': 'ok'}
+
+
+def handle_sync_url(request):
+    db: Db = request.db
+
+    url_model = db.get_url(request.matchdict['queue_id'])
+    if not url_model:
+        request.response.status_code = 404
+        return {'code': 'url_not_found'}
+
+    if url_model.status == UrlStatus.processing.value:
+        request.response.status_code = 400
+        return {'code': 'url_is_processing'}
+
+    db.request_sync(url_model)
+    _publish(request, {
+        'type': 'url',
+        'queue_id': str(url_model.id),
+        'status': url_model.status,
+        'error_msg': url_model.message,
+    })
+    _wake_processors(request)
+
+    return url_model.summary_json(request)
+
+
+def _set_url_paused(request, paused):
+    db: Db = request.db
+
+    url_model = db.get_url(request.matchdict['queue_id'])
+    if not url_model:
+        request.response.status_code = 404
+        return {'code': 'url_not_found'}
+
+    db.set_url_paused(url_model, paused)
+    action = TransferControl.pause if paused else TransferControl.resume
+    _control_processors(request, action, url_id=url_model.id)
+    if not paused:
+        _wake_processors(request)
+
+    _publish_url(request, url_model)
+    return url_model.summary_json(request)
+
+
+def handle_pause_url(request):
+    return _set_url_paused(request, True)
+
+
+def handle_resume_url(request):
+    return _set_url_paused(request, False)
+
+
+def handle_cancel_url(request):
+    db: Db = request.db
+
+    url_model = db.get_url(request.matchdict['queue_id'])
+    if not url_model:
+        request.response.status_code = 404
+        return {'code': 'url_not_found'}
+
+    status = url_model.get_status(request.processor_ids)
+    if status not in (UrlStatus.idle.value, UrlStatus.processing.value):
+        request.response.status_code = 400
+        return {'code': 'url_not_queued'}
+
+    # re-queued like any failed url: with a sync
+    db.update_url(
+        url_model, url_model.processor_id, UrlStatus.error, 'cancelled',
+    )
+    _control_processors(request, TransferControl.cancel, url_id=url_model.id)
+
+    _publish_url(request, url_model)
+    return url_model.summary_json(request)
+
+
+def handle_move_url(request):
+    db: Db = request.db
+
+    url_model = db.get_url(request.matchdict['queue_id'])
+    if not url_model:
+        request.response.status_code = 404
+        return {'code': 'url_not_found'}
+
+    try:
+        move = UrlMove(request.POST.get('to'))
+    except ValueError:
+        request.response.status_code = 400
+        return {'code': 'invalid_move'}
+
+    for moved in db.move_url(url_model, move):
+        _publish_url(request, moved)
+
+    return url_model.summary_json(request)
+
+
+def _control_file(request, action: TransferControl):
+    db: Db = request.db
+
+    file_model = db.get_file(request.matchdict['file_id'])
+    if file_model is None:
+        request.response.status_code = 404
+        return {'code': 'file_not_found'}
+
+    if not file_model.is_processing:
+        request.response.status_code = 400
+        return {'code': 'file_not_downloading'}
+
+    # the processor publishes the transfer's new state once it's applied
+    _control_processors(request, action, file_id=file_model.id)
+
+    request.response.status_code = 202
+    return file_model
+
+
+def handle_pause_file(request):
+    return _control_file(request, TransferControl.pause)
+
+
+def handle_resume_file(request):
+    return _control_file(request, TransferControl.resume)
+
+
+def handle_cancel_file(request):
+    return _control_file(request, TransferControl.cancel)
+
+
+def handle_invalidate_cache(request):
+    db: Db = request.db
+
+    url_model = db.get_url(request.matchdict['queue_id'])
+    if not url_model:
+        request.response.status_code = 404
+        return {'code': 'url_not_found'}
+
+    cache = folder_cache_from_settings(request.registry.settings)
+    handle = folder_handle(url_model.url)
+    if cache and handle:
+        cache.invalidate(handle)
+
     return {'code': 'ok'}
 
 
+LIMIT_GROUPS = {
+    LimitScope.category: 'categories',
+    LimitScope.url: 'urls',
+}
+CLASS_LIMIT_FIELDS = {'share', 'max_transfers'}
+
+
+def _limits_json(db: Db):
+    limits = {'max_speed': None, 'categories': {}, 'urls': {}}
+    for limit in db.get_limits():
+        scope = LimitScope(limit.scope)
+        if scope == LimitScope.everything:
+            limits['max_speed'] = limit.max_speed
+        else:
+            limits[LIMIT_GROUPS[scope]][limit.key] = limit
+
+    return limits
+
+
+def _limit_value(value, maximum=None):
+    if value is None:
+        return None
+
+    if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+        raise ValueError(value)
+
+    if maximum is not None and value > maximum:
+        raise ValueError(value)
+
+    return value
+
+
+def _parse_class_limit(values) -> typing.Optional[dict]:
+    if values is None:
+        return None
+
+    if not isinstance(values, dict) or set(values) - CLASS_LIMIT_FIELDS:
+        raise ValueError(values)
+
+    values = {
+        'share': _limit_value(values.get('share'), maximum=100),
+        'max_transfers': _limit_value(values.get('max_transfers')),
+    }
+    if all(value is None for value in values.values()):
+        return None
+
+    return values
+
+
+def _parse_limits(payload) -> typing.List[tuple]:
+    """(scope, key, values) for every limit in a PUT /api/limits body."""
+    if not isinstance(payload, dict) or \
+            set(payload) - {'max_speed', *LIMIT_GROUPS.values()}:
+        raise ValueError(payload)
+
+    changes = []
+    if 'max_speed' in payload:
+        max_speed = _limit_value(payload['max_speed'])
+        values = None if max_speed is None else {'max_speed': max_speed}
+        changes.append((LimitScope.everything, '', values))
+
+    for scope, group in LIMIT_GROUPS.items():
+        limits = payload.get(group, {})
+        if not isinstance(limits, dict):
+            raise ValueError(limits)
+
+        for key, values in limits.items():
+            changes.append((scope, key, _parse_class_limit(values)))
+
+    return changes
+
+
+def handle_get_limits(request):
+    db: Db = request.db
+
+    return _limits_json(db)
+
+
+def handle_set_limits(request):
+    db: Db = request.db
+
+    try:
+        changes = _parse_limits(request.json_body)
+    except ValueError:
+        request.response.status_code = 400
+        return {'code': 'invalid_limits'}
+
+    for scope, key, values in changes:
+        if scope == LimitScope.url and values and not db.get_url(key):
+            request.response.status_code = 404
+            return {'code': 'url_not_found'}
+
+    for scope, key, values in changes:
+        db.set_limit(scope, key, values)
+
+    channel: ChannelServer = request.registry[CHANNEL_KEY]
+    channel.broadcast({'type': 'limits'})
+
+    return _limits_json(db)
+
+
 def handle_list_categories(request):
     db: Db = request.db
 
@@ -0,0 +1,238 @@
+"""End-to-end throughput against the offline MegaApi stand-in.
+
+For each folder size, times walking the folder with UrlProcessor, then
+runs a DownloadProcessor in a child process over it while polling the
+status endpoint of an in-process Pyramid app, and reports:
+
+- index: nodes walked per second
+- files/s and MiB/s until the url is done
+- commits/s the processor made to the database
+- status and delta latency: p50/p95 of GET /api/status without and with
+  `since`, while the downloads run
+
+    $ PYTHONPATH=backend python benchmarks/bench_processor.py \\
+        --files 10,1000,10000 --transfers 4
+"""
+import fakemega
+fakemega.install()
+
+import click  # noqa: E402
+import contextlib  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import mega  # noqa: E402
+import multiprocessing  # noqa: E402
+import os  # noqa: E402
+import pyramid.config  # noqa: E402
+import sqlalchemy.event  # noqa: E402
+import sys  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+import webob  # noqa: E402
+
+from megadloader import web  # noqa: E402
+from megadloader.db import Db, DBSession, configure_db  # noqa: E402
+from megadloader.events import EventBus  # noqa: E402
+from megadloader.models import Base, UrlStatus  # noqa: E402
+from megadloader.processor import (  # noqa: E402
+    DownloadProcessor,
+    UrlProcessor,
+)
+
+PROCESSOR_ID = 'benchmark'
+
+
+class _Channel:
+    """Stands in for the web process' channel; nobody's listening."""
+
+    def broadcast(self, message):
+        pass
+
+
+def make_app(db_url):
+    config = pyramid.config.Configurator(settings={'db.url': db_url})
+    config.include(web._api)
+    config.include(web._db)
+    config.include(web._renderers)
+
+    config.registry[web.EVENTS_KEY] = EventBus()
+    config.registry[web.CHANNEL_KEY] = _Channel()
+    config.add_request_method(
+        name='processor_ids',
+        callable=lambda r: frozenset({PROCESSOR_ID}),
+        reify=True,
+    )
+
+    return config.make_wsgi_app()
+
+
+def _get(app, path):
+    started = time.perf_counter()
+    response = webob.Request.blank(path).get_response(app)
+    elapsed = time.perf_counter() - started
+
+    assert response.status_code == 200, response.status
+    return json.loads(response.body), elapsed
+
+
+def _percentile(values, percent):
+    if not values:
+        return float('nan')
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * percent / 100))
+    return values[index]
+
+
+def bench_index(url, files):
+    api = mega.MegaApi('benchmark')
+    processor = UrlProcessor(api)
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        walked = sum(1 for _ in processor.process(url))
+    elapsed = time.perf_counter() - started
+
+    assert walked == files, walked
+    return walked / elapsed
+
+
+def _run_processor(db_url, destination, commits, options):
+    sys.stdout = open(os.devnull, 'w')
+
+    configure_db({'db.url': db_url})
+
+    @sqlalchemy.event.listens_for(Base.metadata.bind, 'commit')
+    def count_commit(conn):
+        with commits.get_lock():
+            commits.value += 1
+
+    processor = DownloadProcessor(
+        destination, PROCESSOR_ID, check_files=False, **options,
+    )
+    processor.run()
+
+
+def bench_download(directory, url, files, size, status_interval, timeout,
+                   options):
+    db_url = f'sqlite:///{os.path.join(directory, "benchmark.db")}'
+    app = make_app(db_url)
+
+    db = Db()
+    db.add_url(url)
+    db.dispose()
+    # the child opens its own connections
+    DBSession.remove()
+    Base.metadata.bind.dispose()
+
+    commits = multiprocessing.Value('q', 0)
+    child = multiprocessing.get_context('fork').Process(
+        target=_run_processor,
+        args=(db_url, os.path.join(directory, 'downloads'), commits, options),
+        daemon=True,
+    )
+
+    full, delta = [], []
+    started = time.perf_counter()
+    child.start()
+    try:
+        cursor = 0
+        while True:
+            status, elapsed = _get(app, '/api/status')
+            full.append(elapsed)
+
+            _, elapsed = _get(app, f'/api/status?since={cursor}')
+            delta.append(elapsed)
+            cursor = status['cursor']
+
+            if status['urls'][0]['status'] == UrlStatus.done.value:
+                break
+
+            if time.perf_counter() - started > timeout:
+                raise click.ClickException(f'{files} files: timed out')
+
+            time.sleep(status_interval)
+    finally:
+        elapsed = time.perf_counter() - started
+        child.terminate()
+        child.join()
+        DBSession.remove()
+
+    return {
+        'files/s': files / elapsed,
+        'MiB/s': files * size / elapsed / 1024 / 1024,
+        'commits/s': commits.value / elapsed,
+        'status p50': _percentile(full, 50) * 1000,
+        'status p95': _percentile(full, 95) * 1000,
+        'delta p50': _percentile(delta, 50) * 1000,
+        'delta p95': _percentile(delta, 95) * 1000,
+    }
+
+
+COLUMNS = [
+    ('files', '{:>7}'),
+    ('index/s', '{:>10.0f}'),
+    ('files/s', '{:>9.1f}'),
+    ('MiB/s', '{:>8.2f}'),
+    ('commits/s', '{:>10.1f}'),
+    ('status p50', '{:>11.1f}'),
+    ('status p95', '{:>11.1f}'),
+    ('delta p50', '{:>10.1f}'),
+    ('delta p95', '{:>10.1f}'),
+]
+
+
+@click.command()
+@click.option('--files', default='10,1000,10000',
+              help='comma separated folder sizes, in files')
+@click.option('--size', default=64 * 1024, help='bytes per file')
+@click.option('--latency', default=0.01, help='seconds per SDK request')
+@click.option('--bandwidth', type=float,
+              help='MiB/s shared by all transfers (default: unlimited)')
+@click.option('--transfers', default=4, help='max concurrent transfers')
+@click.option('--flush-interval', default=1.0,
+              help='seconds between progress flushes')
+@click.option('--status-interval', default=0.1,
+              help='seconds between status requests')
+@click.option('--timeout', default=1800.0, help='seconds per folder size')
+def main(files, size, latency, bandwidth, transfers, flush_interval,
+         status_interval, timeout):
+    logging.basicConfig(level=logging.WARNING)
+    if bandwidth:
+        bandwidth = bandwidth * 1024 * 1024
+    fakemega.configure(latency, bandwidth)
+
+    options = {
+        'max_concurrent_transfers': transfers,
+        'progress_flush_interval': flush_interval,
+    }
+
+    click.echo(' '.join(
+        fmt.replace('.0f', '').replace('.1f', '').replace('.2f', '')
+        .format(name) for name, fmt in COLUMNS
+    ))
+
+    for count in [int(value) for value in files.split(',')]:
+        fakemega.reset()
+        url = f'https://mega.nz/folder/bench{count}#key'
+        fakemega.add_folder(
+            url, fakemega.synthetic_folder('benchmark', count, size),
+        )
+
+        with tempfile.TemporaryDirectory() as directory:
+            result = {
+                'files': count,
+                'index/s': bench_index(url, count),
+                **bench_download(
+                    directory, url, count, size, status_interval, timeout,
+                    options,
+                ),
+            }
+
+        click.echo(' '.join(
+            fmt.format(result[name]) for name, fmt in COLUMNS
+        ))
+
+
+if __name__ == '__main__':
+    main()
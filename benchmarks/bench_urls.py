@@ -0,0 +1,81 @@
+"""Link extraction throughput over a large synthetic forum paste.
+
+    $ PYTHONPATH=backend python benchmarks/bench_urls.py --links 20000
+"""
+import base64
+import click
+import random
+import string
+import time
+
+from megadloader import extract_urls, iter_urls
+
+
+def _handle(rand, length):
+    alphabet = string.ascii_letters + string.digits
+    return ''.join(rand.choices(alphabet, k=length))
+
+
+def _b64(value):
+    return base64.b64encode(value.encode('ascii')).decode('ascii')
+
+
+def make_paste(links, seed=0):
+    """`links` links in every supported format, between lines of prose."""
+    rand = random.Random(seed)
+    words = ['mirror', 'part', 'enjoy', 'thanks', 'password', 'the', 'new']
+
+    lines = []
+    for index in range(links):
+        lines.append(' '.join(rand.choices(words, k=rand.randint(3, 12))))
+
+        handle, key = _handle(rand, 8), _handle(rand, 22)
+        kind = index % 5
+        if kind == 0:
+            lines.append(f'https://mega.nz/#F!{handle}!{key}')
+        elif kind == 1:
+            lines.append(f'see https://mega.nz/folder/{handle}#{key} too')
+        elif kind == 2:
+            lines.append(_b64(f'https://mega.nz/file/{handle}#{key}'))
+        elif kind == 3:
+            lines.append(f'Link: {_b64(f"https://mega.nz/#F!{handle}")}')
+            lines.append(f'Key: {_b64(f"!{key}")}')
+        else:
+            lines.append(f'M: #F!{handle}')
+            lines.append(f'K: !{key}')
+
+    return '\n'.join(lines)
+
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+@click.command()
+@click.option('--links', default=20000, help='links in the paste')
+@click.option('--repeat', default=3, help='best of this many runs')
+def main(links, repeat):
+    paste = make_paste(links)
+    megabytes = len(paste) / 1024 / 1024
+    click.echo(f'{links} links, {megabytes:.1f} MiB')
+
+    for name, func in [
+        ('iter_urls', lambda text: list(iter_urls(text))),
+        ('extract_urls', extract_urls),
+    ]:
+        runs = [_timed(func, paste) for _ in range(repeat)]
+        found, elapsed = min(runs, key=lambda run: run[1])
+        found = [url for url in found if isinstance(url, str) or url[1]]
+        assert len(found) == links, (name, len(found))
+
+        click.echo(
+            f'{name:>13}: {elapsed * 1000:8.1f} ms'
+            f' {megabytes / elapsed:8.1f} MiB/s'
+            f' {links / elapsed:10.0f} links/s'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+"""An offline stand-in for the MEGA SDK's `mega` module.
+
+Public folders and files are registered up front and served from memory.
+Like the SDK, each MegaApi delivers every listener callback from a single
+thread of its own; requests take `latency` seconds and transfers share
+`bandwidth` bytes per second (None for as fast as possible). Downloads
+write sparse files of the right size, so nothing is actually copied.
+
+Call `install()` before importing anything from megadloader, so it picks
+this module up as `mega`.
+"""
+import heapq
+import itertools
+import logging
+import os
+import string
+import sys
+import threading
+import time
+
+log = logging.getLogger('fakemega')
+
+latency = 0.01
+bandwidth = None
+
+# interval between the progress updates of a transfer, and the most data
+# handed to onTransferData at once
+TICK = 0.1
+MAX_CHUNK = 1024 * 1024
+
+_folders = {}
+_files = {}
+_handles = itertools.count()
+
+
+def install():
+    sys.modules['mega'] = sys.modules[__name__]
+
+
+def configure(request_latency=0.01, max_bandwidth=None):
+    global latency, bandwidth
+    latency = request_latency
+    bandwidth = max_bandwidth
+
+
+def reset():
+    _folders.clear()
+    _files.clear()
+
+
+def add_folder(url, root: 'MegaNode'):
+    _folders[url] = root
+
+
+def add_file(url, node: 'MegaNode'):
+    _files[url] = node
+
+
+def synthetic_folder(name, files, size, per_folder=100) -> 'MegaNode':
+    """A folder of `files` files of `size` bytes, `per_folder` per folder."""
+    folders = []
+    for start in range(0, files, per_folder):
+        children = [
+            MegaNode(f'file{index:06}.bin', size)
+            for index in range(start, min(files, start + per_folder))
+        ]
+        folders.append(MegaNode(f'part{len(folders):04}', children=children))
+
+    return MegaNode(name, children=folders)
+
+
+def _new_handle():
+    value = next(_handles)
+    alphabet = string.ascii_letters + string.digits
+    chars = []
+    for _ in range(8):
+        value, index = divmod(value, len(alphabet))
+        chars.append(alphabet[index])
+    return ''.join(chars)
+
+
+class MegaError:
+    API_OK = 0
+    API_EARGS = -2
+    API_ENOENT = -9
+    API_EINCOMPLETE = -13
+
+    def __init__(self, value=API_OK):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+    def getErrorString(self):
+        return 'No error' if self.value == self.API_OK else 'Not found'
+
+    def __str__(self):
+        return self.getErrorString()
+
+
+class MegaNode:
+    def __init__(self, name, size=0, children=None, handle=None):
+        self.name = name
+        self.size = size
+        self.children = children
+        self.handle = handle or _new_handle()
+
+    def getName(self):
+        return self.name
+
+    def getSize(self):
+        return self.size
+
+    def getBase64Handle(self):
+        return self.handle
+
+    def isFolder(self):
+        return self.children is not None
+
+    def isFile(self):
+        return self.children is None
+
+    def serialize(self):
+        return f'{self.handle}:{self.size}:{self.name}'
+
+    @staticmethod
+    def unserialize(value):
+        try:
+            handle, size, name = value.split(':', 2)
+            return MegaNode(name, int(size), handle=handle)
+        except ValueError:
+            return None
+
+
+class MegaNodeList:
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def size(self):
+        return len(self.nodes)
+
+    def get(self, index):
+        return self.nodes[index]
+
+
+class MegaChildrenLists:
+    def __init__(self, node: MegaNode):
+        self.files = [c for c in node.children if not c.isFolder()]
+        self.folders = [c for c in node.children if c.isFolder()]
+
+    def getFileList(self):
+        return MegaNodeList(self.files)
+
+    def getFolderList(self):
+        return MegaNodeList(self.folders)
+
+
+class MegaRequest:
+    def __init__(self, name, node=None):
+        self.name = name
+        self.node = node
+
+    def getPublicMegaNode(self):
+        return self.node
+
+    def __str__(self):
+        return self.name
+
+
+class MegaTransfer:
+    STATE_ACTIVE = 2
+    STATE_PAUSED = 3
+    STATE_COMPLETED = 6
+    STATE_CANCELLED = 7
+
+    def __init__(self, tag, node: MegaNode, path, offset=0, size=None):
+        self.tag = tag
+        self.node = node
+        self.path = path
+        self.total_bytes = node.getSize() if size is None else size
+        self.offset = offset
+        self.transferred_bytes = 0
+        self.start_time = int(time.time())
+        self.state = self.STATE_ACTIVE
+        self.paused = False
+
+    def getTag(self):
+        return self.tag
+
+    def getPath(self):
+        return self.path
+
+    def getStartTime(self):
+        return self.start_time
+
+    def getTotalBytes(self):
+        return self.total_bytes
+
+    def getTransferredBytes(self):
+        return self.transferred_bytes
+
+    def getNumRetry(self):
+        return 0
+
+    def getMaxRetries(self):
+        return 7
+
+    def getSpeed(self):
+        return bandwidth or 0
+
+    def getMeanSpeed(self):
+        elapsed = max(1, time.time() - self.start_time)
+        return int(self.transferred_bytes / elapsed)
+
+    def isFinished(self):
+        return self.state in (self.STATE_COMPLETED, self.STATE_CANCELLED)
+
+    def getState(self):
+        if self.state == self.STATE_ACTIVE and self.paused:
+            return self.STATE_PAUSED
+        return self.state
+
+
+class MegaRequestListener:
+    def __init__(self):
+        pass
+
+
+class MegaTransferListener:
+    def __init__(self):
+        pass
+
+
+class _Dispatcher(threading.Thread):
+    """Runs callbacks at their due time, one at a time, like the SDK."""
+
+    def __init__(self):
+        super().__init__(name='FakeMegaApi', daemon=True)
+        self._calls = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+
+    def call_later(self, delay, func, *args):
+        due = time.monotonic() + delay
+        with self._cond:
+            heapq.heappush(self._calls, (due, next(self._order), func, args))
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._calls or \
+                        self._calls[0][0] > time.monotonic():
+                    timeout = None
+                    if self._calls:
+                        timeout = self._calls[0][0] - time.monotonic()
+                    self._cond.wait(timeout)
+
+                _, _, func, args = heapq.heappop(self._calls)
+
+            try:
+                func(*args)
+            except Exception:
+                log.exception('callback failed')
+
+
+class MegaApi:
+    def __init__(self, app_key, *args, **kwargs):
+        self.app_key = app_key
+        self.root = None
+        self.max_speed = None
+        self._tags = itertools.count(1)
+        self._transfers = {}
+        self._listeners = {}
+        self._dispatcher = _Dispatcher()
+        self._dispatcher.start()
+
+    def _request(self, name, listener, error=MegaError.API_OK, node=None):
+        request = MegaRequest(name, node)
+
+        def finish():
+            if listener is not None:
+                listener.onRequestFinish(self, request, MegaError(error))
+
+        if listener is not None:
+            self._dispatcher.call_later(
+                0, listener.onRequestStart, self, request,
+            )
+        self._dispatcher.call_later(latency, finish)
+
+    def loginToFolder(self, url, listener=None):
+        self.root = _folders.get(url)
+        error = MegaError.API_OK if self.root else MegaError.API_ENOENT
+        self._request('loginToFolder', listener, error)
+
+    def fetchNodes(self, listener=None):
+        self._request('fetchNodes', listener)
+
+    def logout(self, listener=None):
+        self.root = None
+        self._request('logout', listener)
+
+    def getRootNode(self):
+        return self.root
+
+    def getFileFolderChildren(self, node: MegaNode):
+        return MegaChildrenLists(node)
+
+    def getPublicNode(self, url, listener=None):
+        node = _files.get(url)
+        error = MegaError.API_OK if node else MegaError.API_ENOENT
+        self._request('getPublicNode', listener, error, node)
+
+    def authorizeNode(self, node: MegaNode):
+        return node
+
+    def setMaxDownloadSpeed(self, max_speed):
+        self.max_speed = max_speed if max_speed and max_speed > 0 else None
+        return True
+
+    def startDownload(self, node, localPath=None, listener=None):
+        transfer = MegaTransfer(next(self._tags), node, localPath)
+        self._start(transfer, listener, stream=False)
+
+    def startStreaming(self, node, startPos, size, listener=None):
+        transfer = MegaTransfer(next(self._tags), node, None, startPos, size)
+        self._start(transfer, listener, stream=True)
+
+    def pauseTransferByTag(self, tag, pause, listener=None):
+        transfer = self._transfers.get(tag)
+        if transfer is not None and transfer.paused != pause:
+            transfer.paused = pause
+            # like the SDK, report the new state
+            self._dispatcher.call_later(
+                0, self._listeners[tag].onTransferUpdate, self, transfer,
+            )
+        self._request('pauseTransfer', listener)
+
+    def cancelTransferByTag(self, tag, listener=None):
+        transfer = self._transfers.get(tag)
+        if transfer is not None:
+            transfer.state = MegaTransfer.STATE_CANCELLED
+        self._request('cancelTransfer', listener)
+
+    def _speed(self):
+        speeds = [s for s in (bandwidth, self.max_speed) if s]
+        if not speeds:
+            return None
+        # shared by everything in flight, paused transfers aside
+        running = sum(1 for t in self._transfers.values() if not t.paused)
+        return min(speeds) / max(1, running)
+
+    def _start(self, transfer: MegaTransfer, listener, stream):
+        self._transfers[transfer.tag] = transfer
+        self._listeners[transfer.tag] = listener
+
+        def start():
+            listener.onTransferStart(self, transfer)
+            tick()
+
+        def tick():
+            if transfer.state == MegaTransfer.STATE_CANCELLED:
+                return finish(MegaError.API_EINCOMPLETE)
+
+            if not transfer.paused:
+                speed = self._speed()
+                remaining = transfer.total_bytes - transfer.transferred_bytes
+                chunk = remaining if speed is None else \
+                    min(remaining, max(1, int(speed * TICK)))
+
+                if stream:
+                    chunk = min(chunk, MAX_CHUNK)
+                if stream and chunk:
+                    data = bytes(chunk).decode('utf-8', 'surrogateescape')
+                    if listener.onTransferData(
+                        self, transfer, data, chunk,
+                    ) is False:
+                        transfer.state = MegaTransfer.STATE_CANCELLED
+                        return finish(MegaError.API_EINCOMPLETE)
+
+                transfer.transferred_bytes += chunk
+                listener.onTransferUpdate(self, transfer)
+
+            if transfer.transferred_bytes < transfer.total_bytes:
+                self._dispatcher.call_later(TICK, tick)
+                return
+
+            if not stream:
+                os.makedirs(os.path.dirname(transfer.path), exist_ok=True)
+                with open(transfer.path, 'wb') as f:
+                    f.truncate(transfer.total_bytes)
+
+            transfer.state = MegaTransfer.STATE_COMPLETED
+            finish(MegaError.API_OK)
+
+        def finish(error):
+            del self._transfers[transfer.tag]
+            del self._listeners[transfer.tag]
+            listener.onTransferFinish(self, transfer, MegaError(error))
+
+        self._dispatcher.call_later(latency, start)
@@ -45,11 +45,12 @@ function urlAddFailed (megaUrl, category, error) {
 export const QUEUE_REFRESHING = 'QUEUE_REFRESHING'
 export const QUEUE_REFRESHED = 'QUEUE_REFRESHED'
 
-export function refreshQueue () {
+export function refreshQueue (since) {
   return dispatch => {
     dispatch({ type: QUEUE_REFRESHING })
 
-    fetch(`${API_ROOT}/api/status`)
+    const query = since === undefined ? '' : `?since=${since}`
+    fetch(`${API_ROOT}/api/status${query}`)
       .then(res => res.json())
       .then(response => {
         dispatch({
@@ -60,6 +61,95 @@ export function refreshQueue () {
   }
 }
 
+// file events only carry the file itself, so fetch the changed url
+// summaries at most this often while transfers are running
+const SUMMARY_REFRESH_MS = 2000
+const STREAM_RETRY_MS = 10000
+
+export const QUEUE_FILES_LOADED = 'QUEUE_FILES_LOADED'
+export const QUEUE_FILES_HIDDEN = 'QUEUE_FILES_HIDDEN'
+
+export function loadQueueFiles (queueId, offset = 0) {
+  return dispatch => {
+    fetch(`${API_ROOT}/api/queue/${queueId}/files?offset=${offset}`)
+      .then(res => res.json())
+      .then(response => {
+        dispatch({
+          type: QUEUE_FILES_LOADED,
+          queueId,
+          data: response
+        })
+      })
+  }
+}
+
+export function hideQueueFiles (queueId) {
+  return { type: QUEUE_FILES_HIDDEN, queueId }
+}
+
+export const QUEUE_EVENT = 'QUEUE_EVENT'
+
+export function subscribeToQueue () {
+  return (dispatch, getState) => {
+    let source = null
+    let retryTimeoutId = null
+
+    let summaryTimeoutId = null
+    const refreshSummaries = () => {
+      if (summaryTimeoutId) {
+        return
+      }
+
+      summaryTimeoutId = setTimeout(() => {
+        summaryTimeoutId = null
+        refreshQueue(getState().queue.cursor)(dispatch)
+      }, SUMMARY_REFRESH_MS)
+    }
+
+    const connect = () => {
+      const stream = source = new EventSource(`${API_ROOT}/api/events`)
+
+      // (re)load everything whenever the stream (re)connects, since events
+      // sent while we were disconnected are gone
+      stream.onopen = () => refreshQueue()(dispatch)
+
+      // EventSource reconnects by itself after network errors, but gives
+      // up on an error response, e.g. a 503 when the server has too many
+      // streams: poll the queue instead until a new stream gets through
+      stream.onerror = () => {
+        if (stream.readyState === EventSource.CLOSED) {
+          refreshQueue()(dispatch)
+          retryTimeoutId = setTimeout(connect, STREAM_RETRY_MS)
+        }
+      }
+
+      stream.onmessage = message => {
+        const event = JSON.parse(message.data)
+        if (event.type === 'resync') {
+          refreshQueue()(dispatch)
+          return
+        }
+
+        dispatch({ type: QUEUE_EVENT, event })
+        if (event.type === 'file') {
+          refreshSummaries()
+        }
+      }
+    }
+
+    connect()
+
+    // closes whichever stream is current, and stops retrying
+    return {
+      close: () => {
+        clearTimeout(retryTimeoutId)
+        clearTimeout(summaryTimeoutId)
+        source.close()
+      }
+    }
+  }
+}
+
 const QUEUE_ITEM_REMOVING = 'QUEUE_ITEM_REMOVING'
 const QUEUE_ITEM_REMOVED = 'QUEUE_ITEM_REMOVED'
 
@@ -81,6 +171,49 @@ export function removeQueueItem (queueId) {
   }
 }
 
+export function syncQueueItem (queueId) {
+  return dispatch => {
+    fetch(`${API_ROOT}/api/queue/${queueId}/sync`, { method: 'POST' })
+      .then(res => res.json())
+      .then(response => {
+        const queueRefresher = refreshQueue()
+        queueRefresher(dispatch)
+      })
+  }
+}
+
+export function controlQueueItem (queueId, action) {
+  return dispatch => {
+    fetch(`${API_ROOT}/api/queue/${queueId}/${action}`, { method: 'POST' })
+      .then(res => res.json())
+      .then(response => {
+        const queueRefresher = refreshQueue()
+        queueRefresher(dispatch)
+      })
+  }
+}
+
+export function moveQueueItem (queueId, to) {
+  return dispatch => {
+    const body = new URLSearchParams()
+    body.append('to', to)
+
+    fetch(`${API_ROOT}/api/queue/${queueId}/move`, {
+      body: body,
+      method: 'POST',
+      headers: { 'Content-Type': 'application/x-www-form-urlencoded' }
+    }).then(res => res.json())
+  }
+}
+
+// the processor applies these asynchronously; the new transfer state
+// comes back as a file event
+export function controlFile (fileId, action) {
+  return dispatch => {
+    fetch(`${API_ROOT}/api/files/${fileId}/${action}`, { method: 'POST' })
+  }
+}
+
 export const CATEGORIES_REFRESHING = 'CATEGORIES_REFRESHING'
 export const CATEGORIES_REFRESHED = 'CATEGORIES_REFRESHED'
 
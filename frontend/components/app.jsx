@@ -5,7 +5,7 @@ import PropTypes from 'prop-types'
 import AddCategory from '../components/addCategory'
 import AddUrl from '../components/addUrl'
 import QueueItem from './queueItem'
-import { refreshCategories, refreshQueue } from "../actions";
+import { refreshCategories, subscribeToQueue } from "../actions";
 
 class App extends Component {
     constructor(props) {
@@ -16,15 +16,12 @@ class App extends Component {
             },
         }
 
-        this.statusUpdateIntervalId = null
+        this.subscription = null
     }
 
     componentWillMount() {
-        if (!this.statusUpdateIntervalId) {
-            this.props.onTimer()
-            this.statusUpdateIntervalId = setInterval(() => {
-                this.props.onTimer();
-            }, 5000)
+        if (!this.subscription) {
+            this.subscription = this.props.onSubscribe()
         }
     }
 
@@ -33,8 +30,8 @@ class App extends Component {
     }
 
     componentWillUnmount() {
-        clearInterval(this.statusUpdateIntervalId)
-        this.statusUpdateIntervalId = null
+        this.subscription.close()
+        this.subscription = null
     }
 
     render() {
@@ -53,22 +50,18 @@ class App extends Component {
     }
 }
 
-const filePropType = PropTypes.shape({
-    file_id: PropTypes.isRequired,
-    is_finished: PropTypes.bool.isRequired,
-    mean_speed: PropTypes.number,
-    transferred_bytes: PropTypes.number.isRequired,
-    is_downloading: PropTypes.bool.isRequired,
-})
-
 const queueItemPropType = PropTypes.shape({
-    files: PropTypes.arrayOf(filePropType).isRequired,
     queue_id: PropTypes.string.isRequired,
     url: PropTypes.string.isRequired,
+    file_count: PropTypes.number.isRequired,
+    finished_count: PropTypes.number.isRequired,
+    transferred_size: PropTypes.number.isRequired,
+    total_size: PropTypes.number.isRequired,
+    active_count: PropTypes.number.isRequired,
 })
 
 App.propTypes = {
-    onTimer: PropTypes.func.isRequired,
+    onSubscribe: PropTypes.func.isRequired,
     queue: PropTypes.arrayOf(queueItemPropType).isRequired,
 }
 
@@ -82,7 +75,7 @@ function mapStateToProps(state) {
 function mapDispatchToProps(dispatch) {
     return {
         onLoad: () => dispatch(refreshCategories()),
-        onTimer: () => dispatch(refreshQueue()),
+        onSubscribe: () => dispatch(subscribeToQueue()),
     }
 }
 
@@ -1,6 +1,29 @@
 import React, {Component} from 'react'
+import {connect} from 'react-redux'
+import {controlFile} from '../actions'
+
+// MegaTransfer.STATE_PAUSED
+const STATE_PAUSED = 3
 
 class QueueFile extends Component {
+    renderControls() {
+        const {file, control} = this.props
+        if (!file.is_downloading) {
+            return null
+        }
+
+        const paused = file.state === STATE_PAUSED
+
+        return (
+            <p>
+                <button onClick={() => control(file.file_id, paused ? 'resume' : 'pause')}>
+                    {paused ? 'Resume' : 'Pause'}
+                </button>
+                {' '}<button onClick={() => control(file.file_id, 'cancel')}>Cancel</button>
+            </p>
+        )
+    }
+
     render() {
         const {file} = this.props
 
@@ -14,9 +37,14 @@ class QueueFile extends Component {
                 <p>{Math.round(file.mean_speed / 1024)} kbps</p>
                 <p>{Math.round((file.transferred_bytes / file.total_bytes) * 100)}% finished</p>
                 <p>is downloading: {file.is_downloading ? "yes" : "no"}</p>
+                {this.renderControls()}
             </div>
         )
     }
 }
 
-export default QueueFile
+function mapDispatchToProps(dispatch) {
+    return {control: (fileId, action) => dispatch(controlFile(fileId, action))}
+}
+
+export default connect(null, mapDispatchToProps)(QueueFile)
@@ -1,19 +1,105 @@
 import React, {Component} from 'react'
+import {connect} from 'react-redux'
 
 import QueueFile from './queueFile'
 import RemoveUrl from './removeUrl'
+import {
+    controlQueueItem,
+    hideQueueFiles,
+    loadQueueFiles,
+    moveQueueItem,
+    syncQueueItem,
+} from '../actions'
 
 class QueueItem extends Component {
+    renderFiles() {
+        const {item, page, load} = this.props
+        if (!page) {
+            return null
+        }
+
+        const hasPrevious = page.offset > 0
+        const hasNext = page.offset + page.limit < page.total
+
+        return (
+            <div>
+                {page.files.map(file => (<QueueFile key={file.file_id} file={file} />))}
+                {hasPrevious && <button onClick={() => load(item.queue_id, Math.max(0, page.offset - page.limit))}>Previous</button>}
+                {hasNext && <button onClick={() => load(item.queue_id, page.offset + page.limit)}>Next</button>}
+            </div>
+        )
+    }
+
+    renderLastSync() {
+        const {last_sync} = this.props.item
+        if (!last_sync) {
+            return null
+        }
+
+        return (
+            <p>
+                Last sync: {last_sync.added} added, {last_sync.changed} changed,
+                {' '}{last_sync.removed} removed, {last_sync.unchanged} unchanged
+            </p>
+        )
+    }
+
+    renderControls() {
+        const {item, control, move} = this.props
+        const queued = item.status === 'IDLE' || item.status === 'PROCESSING'
+
+        return (
+            <span>
+                {' '}<button onClick={() => control(item.queue_id, item.paused ? 'resume' : 'pause')}>
+                    {item.paused ? 'Resume' : 'Pause'}
+                </button>
+                {' '}<button disabled={!queued} onClick={() => control(item.queue_id, 'cancel')}>Cancel</button>
+                {' '}<button onClick={() => move(item.queue_id, 'up')}>Up</button>
+                {' '}<button onClick={() => move(item.queue_id, 'down')}>Down</button>
+            </span>
+        )
+    }
+
     render() {
-        const {item} = this.props
+        const {item, page, load, hide, sync} = this.props
+        const percent = item.total_size
+            ? Math.round((item.transferred_size / item.total_size) * 100)
+            : 0
 
         return (
             <div>
-                {item.url} [{item.status}] <RemoveUrl queue_id={item.queue_id} />
-                {item.files.map(file => (<QueueFile key={file.file_id} file={file} />))}
+                {item.url} [{item.status}{item.paused ? ', paused' : ''}] <RemoveUrl queue_id={item.queue_id} />
+                {' '}<button disabled={item.sync} onClick={() => sync(item.queue_id)}>Sync</button>
+                {this.renderControls()}
+                <p>
+                    {item.finished_count}/{item.file_count} files, {percent}% finished,
+                    {' '}{item.active_count} downloading
+                    {' '}
+                    {page
+                        ? <button onClick={() => hide(item.queue_id)}>Hide files</button>
+                        : <button onClick={() => load(item.queue_id)}>Show files</button>}
+                </p>
+                {this.renderLastSync()}
+                {this.renderFiles()}
             </div>
         )
     }
 }
 
-export default QueueItem
+function mapStateToProps(state, ownProps) {
+    return {
+        page: state.queue.files[ownProps.item.queue_id],
+    }
+}
+
+function mapDispatchToProps(dispatch) {
+    return {
+        load: (queueId, offset) => dispatch(loadQueueFiles(queueId, offset)),
+        hide: (queueId) => dispatch(hideQueueFiles(queueId)),
+        sync: (queueId) => dispatch(syncQueueItem(queueId)),
+        control: (queueId, action) => dispatch(controlQueueItem(queueId, action)),
+        move: (queueId, to) => dispatch(moveQueueItem(queueId, to)),
+    }
+}
+
+export default connect(mapStateToProps, mapDispatchToProps)(QueueItem)
@@ -1,8 +1,95 @@
-import { QUEUE_REFRESHING, QUEUE_REFRESHED } from '../actions'
+import {
+  QUEUE_EVENT,
+  QUEUE_FILES_HIDDEN,
+  QUEUE_FILES_LOADED,
+  QUEUE_REFRESHING,
+  QUEUE_REFRESHED
+} from '../actions'
+
+const emptySummary = {
+  file_count: 0,
+  finished_count: 0,
+  transferred_size: 0,
+  total_size: 0,
+  active_count: 0
+}
+
+function byPosition (items) {
+  return [...items].sort((a, b) => a.position - b.position)
+}
+
+function mergeUrls (items, data) {
+  const queueIds = new Set(data.queue_ids)
+  const changed = new Map(data.urls.map(url => [url.queue_id, url]))
+
+  const merged = items
+    .filter(item => queueIds.has(item.queue_id))
+    .map(item => changed.get(item.queue_id) || item)
+
+  const known = new Set(merged.map(item => item.queue_id))
+  return byPosition(
+    [...merged, ...data.urls.filter(url => !known.has(url.queue_id))]
+  )
+}
+
+function updateFiles (files, changed) {
+  let result = files
+  changed.forEach(file => {
+    const page = result[String(file.url_id)]
+    if (!page) {
+      return
+    }
+
+    result = {
+      ...result,
+      [String(file.url_id)]: {
+        ...page,
+        files: page.files.map(f => f.file_id === file.file_id ? file : f)
+      }
+    }
+  })
+  return result
+}
+
+function applyEvent (items, event) {
+  switch (event.type) {
+    case 'url_added':
+      if (items.some(item => item.queue_id === event.url.queue_id)) {
+        return items
+      }
+      return [...items, { ...emptySummary, ...event.url }]
+
+    case 'url_removed':
+      return items.filter(item => item.queue_id !== event.queue_id)
+
+    case 'url':
+      return items.map(item => item.queue_id === event.queue_id
+        ? { ...item, status: event.status, error_msg: event.error_msg }
+        : item
+      )
+
+    case 'url_updated':
+      return byPosition(items.map(item => item.queue_id === event.url.queue_id
+        ? { ...item, ...event.url }
+        : item
+      ))
+
+    case 'url_synced':
+      return items.map(item => item.queue_id === event.queue_id
+        ? { ...item, sync: false, last_sync: event.last_sync }
+        : item
+      )
+
+    default:
+      return items
+  }
+}
 
 const initialState = {
   isRefreshing: false,
-  items: []
+  cursor: undefined,
+  items: [],
+  files: {}
 }
 
 export default function queue (state = initialState, action) {
@@ -13,11 +100,40 @@ export default function queue (state = initialState, action) {
         isRefreshing: true
       }
     case QUEUE_REFRESHED:
+      if (action.data.queue_ids) {
+        return {
+          ...state,
+          isRefreshing: false,
+          cursor: action.data.cursor,
+          items: mergeUrls(state.items, action.data),
+          files: updateFiles(state.files, action.data.files)
+        }
+      }
+
       return {
         ...state,
         isRefreshing: false,
+        cursor: action.data.cursor,
         items: action.data.urls
       }
+    case QUEUE_EVENT:
+      return {
+        ...state,
+        items: applyEvent(state.items, action.event),
+        files: action.event.type === 'file'
+          ? updateFiles(state.files, [action.event.file])
+          : state.files
+      }
+    case QUEUE_FILES_LOADED:
+      return {
+        ...state,
+        files: { ...state.files, [action.queueId]: action.data }
+      }
+    case QUEUE_FILES_HIDDEN: {
+      const files = { ...state.files }
+      delete files[action.queueId]
+      return { ...state, files }
+    }
 
     default:
       return state
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# processor and db tests run against the offline stand-in for the SDK
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+import fakemega  # noqa: E402
+fakemega.install()
+
+
+@pytest.fixture
+def fake_mega():
+    fakemega.reset()
+    fakemega.configure(0.001, None)
+    yield fakemega
+    fakemega.reset()
+
+
+@pytest.fixture
+def db(tmp_path):
+    from megadloader.db import Db, DBSession, configure_db
+    from megadloader.models import Base
+
+    configure_db({'db.url': f'sqlite:///{tmp_path / "test.db"}'})
+    db = Db()
+    yield db
+
+    db.dispose()
+    DBSession.remove()
+    Base.metadata.bind.dispose()
@@ -0,0 +1,43 @@
+def test_folder_handle():
+    from megadloader.cache import folder_handle
+
+    url = 'https://mega.nz/#F!m2wgnAJR!t1kLXa7x073kOAXb4PPWKw'
+    assert folder_handle(url) == 'm2wgnAJR'
+
+    url = 'https://mega.nz/folder/m2wgnAJR#t1kLXa7x073kOAXb4PPWKw'
+    assert folder_handle(url) == 'm2wgnAJR'
+
+    assert folder_handle('https://mega.nz/#!m2wgnAJR!t1kLXa7x') is None
+
+
+def test_folder_cache(tmp_path):
+    from megadloader.cache import FolderCache
+
+    cache = FolderCache(str(tmp_path), ttl=60)
+    entries = [{'path': 'a/b.txt', 'handle': 'h1', 'size': 1, 'node': 'x'}]
+
+    assert cache.get('m2wgnAJR') is None
+
+    cache.put('m2wgnAJR', entries)
+    assert cache.get('m2wgnAJR') == entries
+
+    cache.invalidate('m2wgnAJR')
+    assert cache.get('m2wgnAJR') is None
+    cache.invalidate('m2wgnAJR')
+
+
+def test_folder_cache_expiry(tmp_path):
+    from megadloader.cache import FolderCache
+
+    cache = FolderCache(str(tmp_path), ttl=-1)
+    cache.put('m2wgnAJR', [])
+    assert cache.get('m2wgnAJR') is None
+
+
+def test_folder_cache_rejects_paths(tmp_path):
+    import pytest
+    from megadloader.cache import FolderCache
+
+    cache = FolderCache(str(tmp_path), ttl=60)
+    with pytest.raises(ValueError):
+        cache.get('../etc/passwd')
@@ -0,0 +1,146 @@
+import threading
+import time
+
+
+def _claim_elsewhere(processor_id, lease_duration=30):
+    """Claim the next url from another thread, as another processor."""
+    from megadloader.db import DBSession, Db
+
+    claimed = []
+
+    def claim():
+        db = Db()
+        url_model = db.claim_next_url(processor_id, lease_duration)
+        claimed.append(url_model and url_model.id)
+        db.dispose()
+        DBSession.remove()
+
+    thread = threading.Thread(target=claim)
+    thread.start()
+    thread.join()
+    return claimed[0]
+
+
+def test_claim_next_url(db):
+    first = db.add_url('https://mega.nz/#F!a')
+    second = db.add_url('https://mega.nz/#F!b')
+
+    assert db.claim_next_url('one', 30).id == first.id
+    assert _claim_elsewhere('two') == second.id
+    assert db.claim_next_url('three', 30) is None
+
+
+def test_lose_claim_race(db, monkeypatch):
+    url_model = db.add_url('https://mega.nz/#F!a')
+    execute = db.session.execute
+
+    def execute_after_other_claim(*args, **kwargs):
+        # the url is free when we look, and taken when we update it
+        result = execute(*args, **kwargs)
+        monkeypatch.setattr(db.session, 'execute', execute)
+        assert _claim_elsewhere('two') == url_model.id
+        return result
+
+    monkeypatch.setattr(db.session, 'execute', execute_after_other_claim)
+    assert db.claim_next_url('one', 30) is None
+
+    db.session.expire_all()
+    assert db.get_url(url_model.id).processor_id == 'two'
+
+
+def test_reclaim_expired_lease(db):
+    url_model = db.add_url('https://mega.nz/#F!a')
+
+    assert db.claim_next_url('one', 0.1).id == url_model.id
+    assert _claim_elsewhere('two') is None
+
+    time.sleep(0.2)
+    assert _claim_elsewhere('two') == url_model.id
+
+
+def test_renew_leases(db):
+    first = db.add_url('https://mega.nz/#F!a')
+    second = db.add_url('https://mega.nz/#F!b')
+
+    assert db.claim_next_url('one', 0.1).id == first.id
+    assert db.claim_next_url('one', 30, exclude={first.id}).id == second.id
+    assert db.renew_leases('one', {first.id, second.id}, 0.1) == set()
+
+    time.sleep(0.2)
+    assert _claim_elsewhere('two') == first.id
+    assert db.renew_leases('one', {first.id, second.id}, 30) == {first.id}
+
+
+def _create_files(db, url_model, count, mega):
+    return db.create_files(url_model, [
+        (f'/downloads/{index}.bin', mega.MegaNode(f'{index}.bin', 10))
+        for index in range(count)
+    ])
+
+
+def test_get_pending_files(db, fake_mega):
+    url_model = db.add_url('https://mega.nz/#F!a')
+    other = db.add_url('https://mega.nz/#F!b')
+    files = _create_files(db, url_model, 5, fake_mega)
+    _create_files(db, other, 2, fake_mega)
+    db.update_files_progress({files[1].id: {'is_finished': True}})
+    file_ids = [file_model.id for file_model in files]
+
+    first = db.get_pending_files(url_model.id, limit=2)
+    assert [file_id for file_id, _, _ in first] == \
+        [file_ids[0], file_ids[2]]
+    assert first[0][1] == '/downloads/0.bin'
+    assert fake_mega.MegaNode.unserialize(first[0][2]).getName() == '0.bin'
+
+    second = db.get_pending_files(url_model.id, first[-1][0], limit=2)
+    assert [file_id for file_id, _, _ in second] == file_ids[3:]
+    assert db.get_pending_files(url_model.id, second[-1][0], limit=2) == []
+
+
+def test_sync_files(db, fake_mega):
+    from megadloader.models import FileChange
+
+    url_model = db.add_url('https://mega.nz/#F!a')
+    nodes = {
+        name: fake_mega.MegaNode(f'{name}.bin', 10)
+        for name in ['same', 'resized', 'moved', 'gone']
+    }
+    files = db.create_files(url_model, [
+        (f'/downloads/{name}.bin', node) for name, node in nodes.items()
+    ])
+    db.update_files_progress({
+        file_model.id: {'is_finished': True, 'transferred_bytes': 10}
+        for file_model in files
+    })
+
+    resized = fake_mega.MegaNode(
+        'resized.bin', 20, handle=nodes['resized'].getBase64Handle(),
+    )
+    added = fake_mega.MegaNode('added.bin', 10)
+    changes = db.sync_files(url_model, [
+        ('/downloads/same.bin', nodes['same']),
+        ('/downloads/resized.bin', resized),
+        ('/downloads/sub/moved.bin', nodes['moved']),
+        ('/downloads/added.bin', added),
+    ])
+
+    assert [change for _, change in changes] == [
+        FileChange.unchanged, FileChange.changed, FileChange.changed,
+        FileChange.added,
+    ]
+    same, resized_file, moved, added_file = [f for f, _ in changes]
+    assert same.is_finished
+    assert resized_file.total_bytes == 20
+    assert moved.path == '/downloads/sub/moved.bin'
+    for file_model in [resized_file, moved]:
+        assert not file_model.is_finished
+        assert file_model.transferred_bytes == 0
+    assert not added_file.is_finished
+
+    handles = {file_model.file_handle for file_model, _ in changes}
+    assert db.remove_missing_files(url_model, handles) == 1
+    assert db.remove_missing_files(url_model, handles) == 0
+    assert sorted(f.path for f in db.get_files(url_model.id)) == [
+        '/downloads/added.bin', '/downloads/resized.bin',
+        '/downloads/same.bin', '/downloads/sub/moved.bin',
+    ]
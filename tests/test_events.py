@@ -0,0 +1,13 @@
+def test_max_subscriptions():
+    from megadloader.events import EventBus
+
+    bus = EventBus(max_subscriptions=2)
+    first = bus.subscribe()
+    second = bus.subscribe()
+    assert bus.subscribe() is None
+
+    bus.publish({'type': 'wake'})
+    assert first.get(0) == second.get(0) == {'type': 'wake'}
+
+    bus.unsubscribe(first)
+    assert bus.subscribe() is not None
@@ -0,0 +1,42 @@
+def test_render_metrics():
+    from megadloader.metrics import Registry, render
+
+    registry = Registry()
+    registry.counter('bytes_total', 'Bytes.').inc(5)
+    registry.gauge('urls', 'Urls by "status".', ['status']).set(2, status='a')
+    histogram = registry.histogram('seconds', 'Time.', buckets=[1, 10])
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert render(registry.snapshot()) == '''\
+# HELP bytes_total Bytes.
+# TYPE bytes_total counter
+bytes_total 5
+# HELP urls Urls by "status".
+# TYPE urls gauge
+urls{status="a"} 2
+# HELP seconds Time.
+# TYPE seconds histogram
+seconds_bucket{le="1"} 1
+seconds_bucket{le="10"} 2
+seconds_bucket{le="+Inf"} 2
+seconds_sum 5.5
+seconds_count 2
+'''
+
+
+def test_remote_metrics():
+    from megadloader.metrics import Registry, RemoteMetrics, render
+
+    registry = Registry()
+    registry.counter('bytes_total', 'Bytes.').inc(5)
+
+    remote = RemoteMetrics()
+    remote.update('p1', registry.snapshot())
+    remote.update('gone', registry.snapshot())
+
+    assert render(remote.snapshot('processor', {'p1'})) == '''\
+# HELP bytes_total Bytes.
+# TYPE bytes_total counter
+bytes_total{processor="p1"} 5
+'''
@@ -0,0 +1,637 @@
+import os
+import threading
+import time
+import types
+import uuid
+
+
+def _processor(tmp_path, **kwargs):
+    from megadloader.processor import DownloadProcessor
+
+    return DownloadProcessor(
+        str(tmp_path / 'downloads'), 'test', check_files=False, **kwargs,
+    )
+
+
+def test_fast_lane_with_class_limits(tmp_path, fake_mega):
+    from megadloader.queues import ClassLimit
+
+    processor = _processor(
+        tmp_path, max_concurrent_transfers=2, fast_lane_threshold=10,
+    )
+    processor._files.limits = {
+        'tv': ClassLimit(max_transfers=1),
+        'held': ClassLimit(max_transfers=0),
+    }
+    processor._files.push('a.mkv', 900, None)
+    processor._files.push('b.srt', 2, 'held')
+    processor._files.push('c.srt', 2, 'tv')
+
+    # one large transfer takes the regular slot
+    processor._transfers[1] = types.SimpleNamespace(paused=False)
+    active = {None: 1}
+
+    assert processor._next_slot_is_fast_lane(active) is True
+    assert processor._files.pop(fast_lane=True, active=active) == 'c.srt'
+
+    # the small file left is held back, so the fast lane stays empty
+    processor._transfers[2] = types.SimpleNamespace(paused=False)
+    processor._fast_lane_file_id = 2
+    assert processor._next_slot_is_fast_lane({None: 1, 'tv': 1}) is None
+
+    del processor._transfers[2]
+    processor._fast_lane_file_id = None
+    assert processor._next_slot_is_fast_lane({None: 1}) is None
+
+
+def _delete_elsewhere(url_id):
+    """Delete a url from another thread, as the web app does."""
+    from megadloader.db import DBSession, Db
+
+    def delete():
+        db = Db()
+        db.delete_url(db.get_url(url_id))
+        db.dispose()
+        DBSession.remove()
+
+    thread = threading.Thread(target=delete)
+    thread.start()
+    thread.join()
+
+
+def _wait_for(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.05)
+
+
+def test_pause_url_with_fast_lane(tmp_path, fake_mega, db):
+    from megadloader.models import UrlStatus
+
+    def folder(name, big, small):
+        return fake_mega.MegaNode(name, children=[
+            *(fake_mega.MegaNode(f'big{i}.bin', big) for i in range(2)),
+            *(fake_mega.MegaNode(f'{i}.srt', small) for i in range(5)),
+        ])
+
+    # the paused url keeps files queued, held back while another's run
+    fake_mega.configure(0.001, 1024 * 1024)
+    fake_mega.add_folder(
+        'https://mega.nz/#F!a', folder('a', 2 * 1024 * 1024, 100 * 1024),
+    )
+    fake_mega.add_folder('https://mega.nz/#F!b', folder('b', 256 * 1024, 1024))
+    paused = db.add_url('https://mega.nz/#F!a')
+    other = db.add_url('https://mega.nz/#F!b')
+
+    processor = _processor(
+        tmp_path, max_concurrent_transfers=3, fast_lane_threshold=200 * 1024,
+        progress_flush_interval=0.1,
+    )
+    thread = threading.Thread(target=processor.run)
+    thread.start()
+    try:
+        _wait_for(lambda: any(
+            wrapper.url_id == paused.id
+            for wrapper in list(processor._transfers.values())
+        ))
+        db.set_url_paused(paused, True)
+        processor._on_channel_message(
+            {'type': 'control', 'action': 'pause', 'url_id': paused.id},
+        )
+
+        def status(url_model):
+            db.session.expire_all()
+            return UrlStatus(db.get_url(url_model.id).status)
+
+        _wait_for(lambda: status(other) == UrlStatus.done)
+        assert status(paused) == UrlStatus.processing
+        big = [
+            f for f in db.get_url(paused.id).files
+            if f.path.endswith('.bin')
+        ]
+        assert not any(f.is_finished for f in big)
+
+        db.set_url_paused(paused, False)
+        processor._on_channel_message(
+            {'type': 'control', 'action': 'resume', 'url_id': paused.id},
+        )
+        _wait_for(lambda: status(paused) == UrlStatus.done)
+    finally:
+        processor.event.set()
+        processor.wake()
+        thread.join()
+
+
+def test_partial_file_of_another_node(tmp_path, fake_mega):
+    from megadloader.processor import PartialFileListener
+
+    processor = _processor(tmp_path)
+    path = str(tmp_path / 'file.bin')
+    with open(path + '.part', 'wb') as f:
+        f.write(b'x' * 10)
+
+    # no record of what it holds
+    listener = PartialFileListener(1, processor, path, 'handle', 100)
+    assert listener.open() == 0
+    listener._file.write(b'y' * 10)
+    listener._file.close()
+
+    listener = PartialFileListener(1, processor, path, 'handle', 100)
+    assert listener.open() == 10
+    listener._file.close()
+
+    # synced: same handle, another size
+    listener = PartialFileListener(1, processor, path, 'handle', 50)
+    assert listener.open() == 0
+    listener._file.close()
+
+    listener = PartialFileListener(1, processor, path, 'other', 50)
+    assert listener.open() == 0
+    assert listener.onTransferData(None, None, b'z' * 5, 10) is False
+    assert listener.onTransferData(None, None, b'z' * 5, 5) is True
+    listener._file.close()
+
+    with open(path + '.part', 'rb') as f:
+        assert f.read() == b'z' * 5
+
+
+def test_partial_file_closed_when_start_fails(
+    tmp_path, fake_mega, db, monkeypatch,
+):
+    from megadloader.processor import NodeWrapper
+
+    processor = _processor(tmp_path, keep_partial_transfers=True)
+    url_model = db.add_url('https://mega.nz/#F!a')
+    node = fake_mega.MegaNode('a.bin', 10)
+    file_model, = db.create_files(url_model, [('a.bin', node)])
+    wrapper = NodeWrapper(
+        uuid.uuid4(), str(tmp_path / 'a.bin'), node, file_model, url_model,
+    )
+
+    def start_streaming(*args, **kwargs):
+        raise RuntimeError('no streaming')
+
+    monkeypatch.setattr(processor.api, 'startStreaming', start_streaming)
+    processor._download_file(wrapper)
+
+    assert wrapper.listener._file.closed
+
+
+def test_lost_lease_cancels_transfers(tmp_path, fake_mega, db):
+    processor = _processor(tmp_path, lease_duration=30)
+    url_model = db.add_url('https://mega.nz/#F!a')
+    assert db.claim_next_url('test', 30).id == url_model.id
+
+    cancelled = []
+    listener = types.SimpleNamespace(cancel=lambda api: cancelled.append(1))
+    processor._transfers[1] = types.SimpleNamespace(
+        url_id=url_model.id, listener=listener, path='a.bin', paused=False,
+    )
+    processor._remaining[url_model.id] = 1
+
+    # taken over by another processor after our lease ran out
+    db.session.expire_all()
+    db.get_url(url_model.id).processor_id = 'other'
+    db.session.commit()
+
+    processor._last_heartbeat = -processor.lease_duration
+    processor._heartbeat()
+
+    assert cancelled == [1]
+    assert url_model.id not in processor._active_url_ids()
+
+
+def test_speed_limit_split_between_workers(tmp_path, fake_mega, db):
+    from megadloader.models import LimitScope
+
+    db.set_limit(LimitScope.everything, '', {'max_speed': 3000})
+    processor = _processor(tmp_path, processor_workers=2)
+    processor._load_limits()
+
+    assert processor.api.max_speed == 1500
+
+
+def test_reset_files_of_another_processor(tmp_path, fake_mega, db):
+    from megadloader.models import UrlStatus
+
+    url_model = db.add_url('https://mega.nz/#F!a')
+    file_model, = db.create_files(
+        url_model, [('a/big.bin', fake_mega.MegaNode('big.bin', 10))],
+    )
+    db.update_url(url_model, 'other', UrlStatus.processing)
+
+    processor = _processor(tmp_path)
+    sent = []
+    processor.channel = types.SimpleNamespace(send=sent.append)
+    processor._reset_files([file_model.id])
+    assert sent[-1] == {'type': 'rerun', 'url_ids': [url_model.id]}
+
+    # the url's processor got there first and finished it
+    other = _processor(tmp_path)
+    other.processor_id = 'other'
+    other.channel = processor.channel
+    db.update_url(url_model, 'other', UrlStatus.done)
+    other._rerun([url_model.id])
+
+    db.session.expire_all()
+    assert db.get_url(url_model.id).status == UrlStatus.idle.value
+
+    # and if it's still running it, it runs the url again once it's done
+    other._remaining[url_model.id] = 1
+    other._rerun([url_model.id])
+    assert url_model.id in other._rerun_urls
+
+
+def test_reset_files_of_deleted_url(tmp_path, fake_mega, db, monkeypatch):
+    url_model = db.add_url('https://mega.nz/#F!a')
+    file_model, = db.create_files(
+        url_model, [('a/big.bin', fake_mega.MegaNode('big.bin', 10))],
+    )
+
+    processor = _processor(tmp_path)
+    # deleted by the web app between the reset and the lookup
+    monkeypatch.setattr(processor.db, 'get_url', lambda url_id: None)
+    processor._reset_files([file_model.id])
+
+
+def test_url_deleted_under_processor(tmp_path, fake_mega, db):
+    from megadloader.models import UrlStatus
+    from megadloader.processor import IndexRun
+
+    first = db.add_url('https://mega.nz/#F!a')
+    second = db.add_url('https://mega.nz/#F!b')
+    third = db.add_url('https://mega.nz/#F!c')
+
+    processor = _processor(tmp_path)
+    runs = []
+    for _ in range(2):
+        url_model = processor.db.claim_next_url('test', 30)
+        run = processor._index_runs[url_model.id] = IndexRun(url_model.id)
+        processor._indexing[url_model.id] = url_model
+        processor._remaining[url_model.id] = 0
+        runs.append(run)
+    processor.db.session.commit()
+
+    _delete_elsewhere(first.id)
+    _delete_elsewhere(second.id)
+
+    # what was handed over before the cancels came in
+    node = fake_mega.MegaNode('a.bin', 10)
+    processor._indexed.put((runs[0], [('a.bin', node)], None))
+    processor._indexed.put((runs[1], None, None))
+    processor._take_indexed()
+
+    assert not processor._active_url_ids()
+    assert processor.db.get_url(third.id).status == UrlStatus.idle.value
+
+
+def test_pause_url_while_indexing(tmp_path, fake_mega, db):
+    from megadloader.models import UrlStatus
+
+    fake_mega.configure(0.001, 1024 * 1024)
+    fake_mega.add_folder(
+        'https://mega.nz/#F!a', fake_mega.synthetic_folder('a', 60, 10240),
+    )
+    fake_mega.add_folder(
+        'https://mega.nz/#F!b', fake_mega.synthetic_folder('b', 2, 10240),
+    )
+    paused = db.add_url('https://mega.nz/#F!a')
+    other = db.add_url('https://mega.nz/#F!b')
+
+    processor = _processor(
+        tmp_path, max_concurrent_transfers=2, max_pending_files=5,
+        index_batch_size=5,
+    )
+    thread = threading.Thread(target=processor.run)
+    thread.start()
+    try:
+        _wait_for(lambda: any(
+            wrapper.url_id == paused.id
+            for wrapper in list(processor._transfers.values())
+        ))
+        db.set_url_paused(paused, True)
+        processor._on_channel_message(
+            {'type': 'control', 'action': 'pause', 'url_id': paused.id},
+        )
+
+        def status(url_model):
+            db.session.expire_all()
+            return UrlStatus(db.get_url(url_model.id).status)
+
+        # neither the paused url's held files nor its unfinished walk
+        # keep the next url from being taken on
+        _wait_for(lambda: status(other) == UrlStatus.done, timeout=10)
+        assert status(paused) == UrlStatus.processing
+    finally:
+        processor.event.set()
+        processor.wake()
+        thread.join()
+
+
+def test_cancel_url_while_indexing(tmp_path, fake_mega, db):
+    from megadloader.cache import FolderCache
+    from megadloader.models import UrlStatus
+
+    cancelled_url = 'https://mega.nz/#F!aaaaaaaa!key'
+    fake_mega.configure(0.001, 1024 * 1024)
+    fake_mega.add_folder(
+        cancelled_url, fake_mega.synthetic_folder('a', 300, 10240),
+    )
+    fake_mega.add_folder(
+        'https://mega.nz/#F!bbbbbbbb!key',
+        fake_mega.synthetic_folder('b', 2, 10240),
+    )
+    cancelled = db.add_url(cancelled_url)
+    other = db.add_url('https://mega.nz/#F!bbbbbbbb!key')
+
+    cache = FolderCache(str(tmp_path / 'cache'), ttl=60)
+    processor = _processor(
+        tmp_path, max_pending_files=5, index_batch_size=5,
+        folder_cache=cache,
+    )
+    thread = threading.Thread(target=processor.run)
+    thread.start()
+    try:
+        # its walk is waiting for the transfers to catch up
+        _wait_for(lambda: processor._transfers)
+        db.update_url(cancelled, 'test', UrlStatus.error, 'cancelled')
+        processor._on_channel_message(
+            {'type': 'control', 'action': 'cancel', 'url_id': cancelled.id},
+        )
+
+        def indexers():
+            return [
+                t for t in threading.enumerate()
+                if t.name == f'UrlIndexer-{cancelled.id}'
+            ]
+
+        _wait_for(lambda: not indexers(), timeout=5)
+
+        def status(url_model):
+            db.session.expire_all()
+            return UrlStatus(db.get_url(url_model.id).status)
+
+        _wait_for(lambda: status(other) == UrlStatus.done, timeout=10)
+        assert not db.get_url(cancelled.id).indexed
+        assert cache.get('aaaaaaaa') is None
+    finally:
+        processor.event.set()
+        processor.wake()
+        thread.join()
+
+
+def test_lost_lease_stops_indexer(tmp_path, fake_mega, db):
+    from megadloader.processor import IndexRun
+
+    processor = _processor(tmp_path, lease_duration=30)
+    url_model = db.add_url('https://mega.nz/#F!a')
+    claimed = processor.db.claim_next_url('test', 30)
+    run = processor._index_runs[claimed.id] = IndexRun(claimed.id)
+    processor._indexing[claimed.id] = claimed
+
+    db.session.expire_all()
+    db.get_url(url_model.id).processor_id = 'other'
+    db.session.commit()
+
+    processor._last_heartbeat = -processor.lease_duration
+    processor._heartbeat()
+
+    assert run.cancelled.is_set()
+    assert not processor._active_url_ids()
+
+    # whatever it still hands over is dropped
+    processor._indexed.put((run, None, None))
+    processor._take_indexed()
+    assert not db.get_url(url_model.id).indexed
+
+
+def test_url_with_cancelled_file(tmp_path, fake_mega, db):
+    from megadloader.models import UrlStatus
+
+    fake_mega.configure(0.001, 1024 * 1024)
+    fake_mega.add_folder(
+        'https://mega.nz/#F!a', fake_mega.MegaNode('a', children=[
+            fake_mega.MegaNode('big.bin', 8 * 1024 * 1024),
+            fake_mega.MegaNode('small.bin', 1024),
+        ]),
+    )
+    url_model = db.add_url('https://mega.nz/#F!a')
+
+    processor = _processor(tmp_path, max_concurrent_transfers=2)
+    thread = threading.Thread(target=processor.run)
+    thread.start()
+    try:
+        def big_file_id():
+            for file_id, wrapper in list(processor._transfers.items()):
+                if wrapper.path.endswith('big.bin'):
+                    return file_id
+
+        _wait_for(big_file_id)
+        processor._on_channel_message(
+            {'type': 'control', 'action': 'cancel', 'file_id': big_file_id()},
+        )
+
+        def url():
+            db.session.expire_all()
+            return db.get_url(url_model.id)
+
+        _wait_for(lambda: url().status != UrlStatus.processing.value)
+        assert url().status == UrlStatus.error.value
+        assert url().message == '1 file(s) did not finish'
+    finally:
+        processor.event.set()
+        processor.wake()
+        thread.join()
+
+
+def test_verify_requeues_done_url_with_unfinished_files(
+    tmp_path, fake_mega, db,
+):
+    from megadloader.models import UrlStatus
+    from megadloader.processor import CHECK_SECONDS, ProcessorUpdate
+
+    def check_counts():
+        return {
+            labels['check']: value
+            for name, labels, value in CHECK_SECONDS.samples()
+            if name.endswith('_count')
+        }
+
+    url_model = db.add_url('https://mega.nz/#F!a')
+    done, failed = db.create_files(url_model, [
+        (str(tmp_path / 'a.bin'), fake_mega.MegaNode('a.bin', 10)),
+        (str(tmp_path / 'b.bin'), fake_mega.MegaNode('b.bin', 10)),
+    ])
+    with open(done.path, 'wb') as f:
+        f.write(b'x' * 10)
+    db.update_files_progress({done.id: {'is_finished': True}})
+    db.update_url(url_model, 'test', UrlStatus.done)
+    url_id, failed_id = url_model.id, failed.id
+
+    # run on its own thread, which closes its session when it's done
+    processor = _processor(tmp_path)
+    counts = check_counts()
+    processor._check_files(time.time())
+    kind, file_ids = processor._updates.get_nowait()
+    assert kind == ProcessorUpdate.VERIFIED
+    assert file_ids == [failed_id]
+
+    # reported per check, as they run beside the main loop's states
+    assert check_counts() == {
+        'clean': counts.get('clean', 0) + 1,
+        'verify': counts.get('verify', 0) + 1,
+    }
+
+    processor._reset_files(file_ids)
+    assert db.get_url(url_id).status == UrlStatus.idle.value
+
+
+def test_resume_url_from_file_rows(tmp_path, fake_mega, db):
+    from megadloader.models import UrlStatus
+    from megadloader.processor import IndexRun
+
+    url_model = db.add_url('https://mega.nz/#F!a')
+    files = db.create_files(url_model, [
+        (str(tmp_path / f'{i}.bin'), fake_mega.MegaNode(f'{i}.bin', 10))
+        for i in range(5)
+    ])
+    db.update_files_progress({files[0].id: {'is_finished': True}})
+    pending = [file_model.id for file_model in files[1:]]
+
+    processor = _processor(tmp_path, index_batch_size=2)
+    claimed = processor.db.claim_next_url('test', 30)
+    run = IndexRun(claimed.id)
+    processor._indexing[claimed.id] = claimed
+    processor._index_runs[claimed.id] = run
+    processor._resuming.add(claimed.id)
+
+    # pages of 2 and the final hand-over, taken as they come
+    thread = threading.Thread(target=processor._resume_url, args=(run,))
+    thread.start()
+    while thread.is_alive() or not processor._indexed.empty():
+        processor._take_indexed()
+        time.sleep(0.01)
+    thread.join()
+
+    assert [w.file_model.id for w in processor.get_files()] == pending
+    assert processor._remaining[claimed.id] == 4
+    assert claimed.id not in processor._indexing
+    assert claimed.id not in processor._resuming
+    assert processor.db.get_url(claimed.id).status == \
+        UrlStatus.processing.value
+
+
+def test_resume_url_without_node(tmp_path, fake_mega, db):
+    from megadloader.models import File, UrlStatus
+    from megadloader.processor import IndexRun
+
+    url_model = db.add_url('https://mega.nz/#F!a')
+    file_model, = db.create_files(
+        url_model,
+        [(str(tmp_path / 'a.bin'), fake_mega.MegaNode('a.bin', 10))],
+    )
+    db.session.query(File).update({File.node: None})
+    db.session.commit()
+
+    processor = _processor(tmp_path)
+    claimed = processor.db.claim_next_url('test', 30)
+    url_id = claimed.id
+    run = IndexRun(url_id)
+    processor._indexing[url_id] = claimed
+    processor._index_runs[url_id] = run
+    processor._resuming.add(url_id)
+
+    processor._resume_url(run)
+    processor._take_indexed()
+
+    url_model = processor.db.get_url(url_id)
+    assert url_model.status == UrlStatus.error.value
+    assert url_model.message.startswith('no usable node stored for')
+    assert not processor._active_url_ids()
+
+
+def test_indexed_after_complete_walk(tmp_path, fake_mega, db):
+    from megadloader.models import UrlStatus
+    from megadloader.processor import IndexRun
+
+    fake_mega.add_folder(
+        'https://mega.nz/#F!a', fake_mega.synthetic_folder('a', 3, 10),
+    )
+    db.add_url('https://mega.nz/#F!a')
+    db.add_url('https://mega.nz/#F!missing')
+
+    processor = _processor(tmp_path, index_batch_size=100)
+    runs = []
+    for _ in range(2):
+        claimed = processor.db.claim_next_url(
+            'test', 30, exclude=processor._indexing,
+        )
+        run = processor._index_runs[claimed.id] = IndexRun(claimed.id)
+        processor._indexing[claimed.id] = claimed
+        runs.append((run, claimed.url))
+
+    # its only batch, then the final hand-over
+    processor._index_url(*runs[0])
+    batch = processor._indexed.get_nowait()
+    final = processor._indexed.get_nowait()
+
+    processor._indexed.put(batch)
+    processor._take_indexed()
+    url_id = runs[0][0].url_id
+    assert len(processor.db.get_files(url_id)) == 3
+    assert not processor.db.get_url(url_id).indexed
+
+    processor._indexed.put(final)
+    processor._take_indexed()
+    assert processor.db.get_url(url_id).indexed
+
+    # a walk that fails doesn't count
+    processor._index_url(*runs[1])
+    processor._take_indexed()
+    url_model = processor.db.get_url(runs[1][0].url_id)
+    assert url_model.status == UrlStatus.error.value
+    assert not url_model.indexed
+
+
+def test_sync_url(tmp_path, fake_mega, db):
+    from megadloader.models import UrlStatus
+    from megadloader.processor import SyncReport
+
+    processor = _processor(tmp_path)
+    destination = processor.destination
+    url_model = db.add_url('https://mega.nz/#F!a')
+    kept, gone = [
+        fake_mega.MegaNode(name, 10) for name in ['kept.bin', 'gone.bin']
+    ]
+    files = db.create_files(url_model, [
+        (os.path.join(destination, 'kept.bin'), kept),
+        (os.path.join(destination, 'gone.bin'), gone),
+    ])
+    db.update_files_progress({f.id: {'is_finished': True} for f in files})
+    db.request_sync(url_model)
+
+    claimed = processor.db.claim_next_url('test', 30)
+    assert claimed.sync
+    processor._indexing[claimed.id] = claimed
+    report = processor._syncs[claimed.id] = SyncReport()
+    sent = []
+    processor.channel = types.SimpleNamespace(send=sent.append)
+
+    added = fake_mega.MegaNode('added.bin', 10)
+    processor._process_file_nodes(
+        claimed, [('kept.bin', kept), ('added.bin', added)],
+    )
+    # only what's new or changed is downloaded
+    assert [w.path for w in processor.get_files()] == \
+        [os.path.join(destination, 'added.bin')]
+
+    processor._finish_sync(claimed, report)
+    assert sent[-1]['type'] == 'url_synced'
+    assert sent[-1]['last_sync'] == \
+        {'added': 1, 'changed': 0, 'removed': 1, 'unchanged': 1}
+
+    url_model = processor.db.get_url(claimed.id)
+    assert not url_model.sync
+    assert url_model.status == UrlStatus.processing.value
+    assert len(processor.db.get_files(claimed.id)) == 2
@@ -0,0 +1,120 @@
+def _drain(pending, fast_lane=False):
+    items = []
+    while pending:
+        items.append(pending.pop(fast_lane))
+    return items
+
+
+def _drain_fair(pending):
+    items = []
+    while True:
+        item = pending.pop()
+        if item is None:
+            return items
+        items.append(item)
+
+
+def test_transfer_order():
+    from megadloader.queues import PendingQueue, TransferOrder
+
+    sizes = {'a.mkv': 900, 'b.srt': 2, 'c.mkv': 700, 'd.txt': 1}
+
+    for order, expected in [
+        (TransferOrder.fifo, ['a.mkv', 'b.srt', 'c.mkv', 'd.txt']),
+        (TransferOrder.smallest, ['d.txt', 'b.srt', 'c.mkv', 'a.mkv']),
+        (TransferOrder.largest, ['a.mkv', 'c.mkv', 'b.srt', 'd.txt']),
+    ]:
+        pending = PendingQueue(order)
+        for name, size in sizes.items():
+            pending.push(name, size)
+
+        assert len(pending) == 4
+        assert list(pending) == expected
+        assert _drain(pending) == expected
+
+
+def test_custom_order():
+    from megadloader.queues import PendingQueue
+
+    pending = PendingQueue(lambda size, seq: (-seq,))
+    for index in range(3):
+        pending.push(index, 0)
+
+    assert _drain(pending) == [2, 1, 0]
+
+
+def test_fast_lane():
+    from megadloader.queues import PendingQueue, TransferOrder
+
+    pending = PendingQueue(TransferOrder.fifo, fast_lane_threshold=10)
+    pending.push('a.mkv', 900)
+    pending.push('b.srt', 2)
+    pending.push('c.mkv', 700)
+
+    assert pending.has_small()
+    assert pending.pop(fast_lane=True) == 'b.srt'
+    assert not pending.has_small()
+    assert _drain(pending) == ['a.mkv', 'c.mkv']
+
+
+def test_remove():
+    from megadloader.queues import PendingQueue, TransferOrder
+
+    pending = PendingQueue(TransferOrder.smallest, fast_lane_threshold=10)
+    pending.push('a.mkv', 900)
+    pending.push('b.srt', 2)
+    pending.push('c.mkv', 700)
+
+    pending.remove(lambda name: name.endswith('.srt'))
+
+    assert len(pending) == 2
+    assert not pending.has_small()
+    assert _drain(pending) == ['c.mkv', 'a.mkv']
+
+
+def test_fair_queue_shares():
+    from megadloader.queues import ClassLimit, FairQueue
+
+    pending = FairQueue()
+    pending.limits = {'tv': ClassLimit(share=70)}
+    for index in range(20):
+        pending.push(f'tv{index}', 1, 'tv')
+        pending.push(f'misc{index}', 1, None)
+
+    active = {'tv': 0, None: 0}
+    for _ in range(10):
+        item = pending.pop(active=active)
+        active['tv' if item.startswith('tv') else None] += 1
+
+    assert active == {'tv': 7, None: 3}
+
+
+def test_fair_queue_max_transfers():
+    from megadloader.queues import ClassLimit, FairQueue
+
+    pending = FairQueue(fast_lane_threshold=10)
+    pending.limits = {'tv': ClassLimit(max_transfers=1)}
+    pending.push('a.mkv', 900, 'tv')
+    pending.push('b.srt', 2, 'tv')
+
+    assert pending.pop(active={'tv': 0}) == 'a.mkv'
+    assert pending.pop(active={'tv': 1}) is None
+    assert not pending.has_small(active={'tv': 1})
+    assert pending.has_small(active={'tv': 0})
+
+
+def test_fair_queue_regroup():
+    from megadloader.queues import ClassLimit, FairQueue
+
+    pending = FairQueue()
+    for name in ['a.mkv', 'b.srt', 'c.mkv']:
+        pending.push(name, 1)
+
+    pending.limits = {'mkv': ClassLimit(max_transfers=0)}
+    pending.regroup(lambda name: 'mkv' if name.endswith('.mkv') else None)
+
+    assert list(pending) == ['a.mkv', 'b.srt', 'c.mkv']
+    assert pending.count_startable() == 1
+    assert _drain_fair(pending) == ['b.srt']
+    assert len(pending) == 2
+    assert pending.count_startable() == 0
@@ -0,0 +1,33 @@
+def test_traced(tmp_path):
+    import json
+    from megadloader.tracing import TRACER, trace_methods, traced
+
+    @trace_methods
+    class Thing:
+        def public(self):
+            return 1
+
+        def _private(self):
+            return 2
+
+    @traced
+    def function():
+        return Thing().public() + Thing()._private()
+
+    path = tmp_path / 'trace.jsonl'
+    TRACER.configure(str(path), max_bytes=1024, backup_count=1)
+    assert function() == 3
+    assert not path.exists()
+
+    TRACER.toggle()
+    try:
+        assert function() == 3
+    finally:
+        TRACER.toggle()
+
+    spans = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [span['name'] for span in spans] == [
+        'test_traced.<locals>.Thing.public',
+        'test_traced.<locals>.function',
+    ]
+    assert all(span['ph'] == 'X' and span['dur'] >= 0 for span in spans)
@@ -15,3 +15,46 @@ Key: IWQ4bEI5eUFuVWNsN0JyaE9rbnd5VEE=
 K: !tZHr-4oKGpHmoVx8lpo8PA''')
     assert url == 'https://mega.nz/#F!KiBG0Y6Y!tZHr-4oKGpHmoVx8lpo8PA'
 
+
+def test_extract_urls():
+    from megadloader import extract_urls
+    entries = extract_urls('''
+https://mega.nz/#F!m2wgnAJR!t1kLXa7x073kOAXb4PPWKw
+not a link
+
+Link: aHR0cHM6Ly9tZWdhLm56LyNGIUNieGltQWdC
+Key: IWQ4bEI5eUFuVWNsN0JyaE9rbnd5VEE=
+M: #F!KiBG0Y6Y
+K: !tZHr-4oKGpHmoVx8lpo8PA
+''')
+    assert [url for _, url in entries] == [
+        'https://mega.nz/#F!m2wgnAJR!t1kLXa7x073kOAXb4PPWKw',
+        None,
+        'https://mega.nz/#F!CbximAgB!d8lB9yAnUcl7BrhOknwyTA',
+        'https://mega.nz/#F!KiBG0Y6Y!tZHr-4oKGpHmoVx8lpo8PA',
+    ]
+    assert entries[1][0] == 'not a link'
+
+
+def test_extract_urls_from_text():
+    from megadloader import extract_urls, iter_urls
+    text = '''Some links (old and new style):
+http://www.mega.co.nz/#!m2wgnAJR!t1kLXa7x, and
+mirror aHR0cHM6Ly9tZWdhLm56L2ZvbGRlci9tMndnbkFKUiN0MWtMWGE3eA==
+https://mega.nz/folder/m2wgnAJR#t1kLXa7x/file/b1JUSa4J.
+'''
+    assert list(iter_urls(text)) == [
+        'https://mega.nz/#!m2wgnAJR!t1kLXa7x',
+        'https://mega.nz/folder/m2wgnAJR#t1kLXa7x',
+        'https://mega.nz/folder/m2wgnAJR#t1kLXa7x/file/b1JUSa4J',
+    ]
+    assert extract_urls(text)[0] == ('Some links (old and new style):', None)
+    assert len(extract_urls(text)) == 4
+
+
+def test_is_file_url():
+    from megadloader import is_file_url
+    assert is_file_url('https://mega.nz/#!m2wgnAJR!t1kLXa7x')
+    assert is_file_url('https://mega.nz/file/m2wgnAJR#t1kLXa7x')
+    assert not is_file_url('https://mega.nz/#F!m2wgnAJR!t1kLXa7x')
+    assert not is_file_url('https://mega.nz/folder/m2wgnAJR#F1kLXa7x')
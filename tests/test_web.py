@@ -0,0 +1,110 @@
+import json
+
+import pytest
+import webob
+
+
+@pytest.fixture
+def app(db, tmp_path):
+    from bench_processor import make_app
+
+    return make_app(f'sqlite:///{tmp_path / "test.db"}')
+
+
+def _get(app, path, **headers):
+    return webob.Request.blank(path, headers=headers).get_response(app)
+
+
+def _create_files(db, url_model, sizes, mega):
+    return db.create_files(url_model, [
+        (f'/downloads/{index}.bin', mega.MegaNode(f'{index}.bin', size))
+        for index, size in enumerate(sizes)
+    ])
+
+
+def test_status_not_modified(app, db):
+    db.add_url('https://mega.nz/#F!a')
+
+    response = _get(app, '/api/status')
+    assert response.status_code == 200
+    etag = response.etag
+    assert etag == str(json.loads(response.body)['cursor'])
+
+    response = _get(app, '/api/status', **{'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 304
+    assert response.etag == etag
+
+    db.add_url('https://mega.nz/#F!b')
+    response = _get(app, '/api/status', **{'If-None-Match': f'"{etag}"'})
+    assert response.status_code == 200
+    assert response.etag != etag
+
+
+def test_status_since(app, db, fake_mega):
+    from megadloader.models import UrlStatus
+
+    first = db.add_url('https://mega.nz/#F!a')
+    second = db.add_url('https://mega.nz/#F!b')
+    first_id, second_id = first.id, second.id
+    file_ids = [f.id for f in _create_files(db, first, [10, 20], fake_mega)]
+
+    cursor = json.loads(_get(app, '/api/status').body)['cursor']
+
+    db.mark_file_status(file_ids[1], True)
+    db.update_url(db.get_url(second_id), '', UrlStatus.error, 'failed')
+
+    response = _get(app, f'/api/status?since={cursor}')
+    assert response.status_code == 200
+    body = json.loads(response.body)
+
+    assert body['cursor'] > cursor
+    assert body['queue_ids'] == [str(first_id), str(second_id)]
+    # the first url's summary changed with its file
+    assert [u['queue_id'] for u in body['urls']] == [
+        str(first_id), str(second_id),
+    ]
+    assert [f['file_id'] for f in body['files']] == [file_ids[1]]
+
+    body = json.loads(_get(app, f'/api/status?since={body["cursor"]}').body)
+    assert body['queue_ids'] == [str(first_id), str(second_id)]
+    assert body['urls'] == []
+    assert body['files'] == []
+
+
+def test_status_invalid_cursor(app, db):
+    response = _get(app, '/api/status?since=abc')
+    assert response.status_code == 400
+    assert json.loads(response.body) == {'code': 'invalid_cursor'}
+
+
+def test_status_url_summaries(app, db, fake_mega):
+    url_model = db.add_url('https://mega.nz/#F!a')
+    empty_id = db.add_url('https://mega.nz/#F!b').id
+    url_id = url_model.id
+    file_ids = [
+        f.id for f in _create_files(db, url_model, [10, 20, 30], fake_mega)
+    ]
+
+    db.update_files_progress({
+        file_ids[0]: {'transferred_bytes': 10, 'is_finished': True},
+        file_ids[1]: {'transferred_bytes': 5, 'is_processing': True},
+    })
+
+    body = json.loads(_get(app, '/api/status').body)
+    summaries = {u['queue_id']: u for u in body['urls']}
+    assert list(summaries) == [str(url_id), str(empty_id)]
+
+    summary = summaries[str(url_id)]
+    assert summary['file_count'] == 3
+    assert summary['finished_count'] == 1
+    assert summary['transferred_size'] == 15
+    assert summary['total_size'] == 60
+    assert summary['active_count'] == 1
+    assert 'files' not in summary
+
+    summary = summaries[str(empty_id)]
+    assert summary['file_count'] == 0
+    assert summary['finished_count'] == 0
+    assert summary['transferred_size'] == 0
+    assert summary['total_size'] == 0
+    assert summary['active_count'] == 0